@@ -2,7 +2,7 @@ from django.contrib import admin
 from .models import (
     Role, User, Permission, Category, Course, UserCourse,
     Chapter, Lesson, Document, Payment, LessonProgress,
-    Forum, Comment
+    Forum, Comment, EmailOutbox, PendingUpload, OutboxEvent
 )
 
 
@@ -93,3 +93,22 @@ class CommentAdmin(admin.ModelAdmin):
     list_display = ("id", "user", "forum", "parent", "content", "created_at")
     list_filter = ("forum",)
     search_fields = ("user__username", "content")
+
+
+@admin.register(EmailOutbox)
+class EmailOutboxAdmin(admin.ModelAdmin):
+    list_display = ("id", "to_email", "subject", "status", "attempts", "next_attempt_at", "sent_at", "expires_at")
+    list_filter = ("status",)
+    search_fields = ("to_email", "subject")
+
+
+@admin.register(PendingUpload)
+class PendingUploadAdmin(admin.ModelAdmin):
+    list_display = ("id", "model_label", "object_id", "field_name", "status", "attempts", "next_attempt_at")
+    list_filter = ("status", "model_label")
+
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ("id", "event_type", "attempts", "processed_at", "created_at")
+    list_filter = ("event_type",)
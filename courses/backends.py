@@ -0,0 +1,13 @@
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth import get_user_model
+
+
+class RoleAwareModelBackend(ModelBackend):
+    def get_user(self, user_id):
+        # Session-authenticated requests load the role with the user
+        UserModel = get_user_model()
+        try:
+            user = UserModel._default_manager.select_related('user_role').get(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
@@ -0,0 +1,81 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+# Namespaces of the public catalog responses
+COURSES = 'courses'
+CATEGORIES = 'categories'
+TEACHERS = 'teachers'
+
+
+def _incr(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Key missing (first use or evicted)
+        if cache.add(key, 1, timeout=None):
+            return 1
+        return cache.incr(key)
+
+
+def get_generation(namespace):
+    generation = cache.get(f'catalog:{namespace}:generation')
+    if generation is None:
+        cache.add(f'catalog:{namespace}:generation', 1, timeout=None)
+        generation = cache.get(f'catalog:{namespace}:generation', 1)
+    return generation
+
+
+def bump_generation(*namespaces):
+    """Invalidate every cached response of the namespaces; old entries simply expire"""
+    for namespace in namespaces:
+        _incr(f'catalog:{namespace}:generation')
+
+
+def get_stats(*namespaces):
+    namespaces = namespaces or (COURSES, CATEGORIES, TEACHERS)
+    stats = {}
+    for namespace in namespaces:
+        hits = cache.get(f'catalog:{namespace}:hits', 0)
+        misses = cache.get(f'catalog:{namespace}:misses', 0)
+        stats[namespace] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            'generation': get_generation(namespace),
+        }
+    return stats
+
+
+def response_cache_key(request, namespace, params):
+    # Only the whitelisted params change the response; drop empties so ?level= and no level share an entry
+    normalized = sorted(
+        (name, request.query_params.get(name).strip())
+        for name in params
+        if request.query_params.get(name, '').strip()
+    )
+    # Pagination links are absolute, so the host is part of the response
+    raw = f'{request.scheme}://{request.get_host()}{request.path}?{normalized}'
+    digest = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+    return f'catalog:{namespace}:v{get_generation(namespace)}:{digest}'
+
+
+def cached_response(request, namespace, build, params=()):
+    """Return the cached data of a public GET endpoint, calling build() on a miss"""
+    key = response_cache_key(request, namespace, params)
+    data = cache.get(key)
+    if data is not None:
+        _incr(f'catalog:{namespace}:hits')
+        response = Response(data)
+        response['X-Cache'] = 'HIT'
+        return response
+
+    _incr(f'catalog:{namespace}:misses')
+    response = build()
+    if response.status_code == status.HTTP_200_OK:
+        cache.set(key, response.data, timeout=settings.CATALOG_CACHE_TIMEOUT)
+    response['X-Cache'] = 'MISS'
+    return response
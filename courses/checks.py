@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+
+@register(Tags.caches)
+def check_progress_buffer(app_configs, **kwargs):
+    """PROGRESS_WRITE_BEHIND needs the shared Redis buffer; caught by migrate/check at deploy time"""
+    if settings.PROGRESS_WRITE_BEHIND and not settings.CACHES['default']['BACKEND'].startswith('django_redis'):
+        # A per-process buffer would be out of the flusher's reach: heartbeats accepted, never written
+        return [Error(
+            'PROGRESS_WRITE_BEHIND requires a django-redis default cache.',
+            hint='Set REDIS_URL, or turn PROGRESS_WRITE_BEHIND off.',
+            id='courses.E001',
+        )]
+    return []
@@ -0,0 +1,93 @@
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.db import connections
+from django.test import override_settings
+
+from coursesapp.db import MODES, connection_profile
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(server):
+    try:
+        server.serve_forever()
+    finally:
+        # The serving thread owns its connection
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = ('Measures per-request latency of an endpoint under each DB_CONN_MODE profile. '
+            'Requests go over HTTP to a WSGI server started for each mode, so the '
+            'request_started/finished connection handling (CONN_MAX_AGE) applies as in production')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/categories/', help='Endpoint to request')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per mode')
+        parser.add_argument('--modes', nargs='+', default=['default', 'persistent'], choices=MODES)
+        parser.add_argument('--conn-max-age', type=int, default=60)
+        parser.add_argument('--with-cache', action='store_true',
+                            help='Keep the catalog response cache on (by default every request reaches the database)')
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor != 'postgresql':
+            raise CommandError('Benchmark the PostgreSQL database the app runs against')
+
+        # Connections opened by the server thread are built from this dict
+        db_settings = connections.settings['default']
+        original = dict(db_settings)
+        application = get_wsgi_application()
+        # A timeout of 0 stores nothing, so cached catalog endpoints keep querying
+        no_cache = override_settings(CATALOG_CACHE_TIMEOUT=0)
+        if not options['with_cache']:
+            no_cache.enable()
+        try:
+            for mode in options['modes']:
+                db_settings.update(connection_profile(mode, conn_max_age=options['conn_max_age']))
+                self.stdout.write(self.run_mode(mode, application, options['path'], options['requests']))
+        finally:
+            if not options['with_cache']:
+                no_cache.disable()
+            db_settings.clear()
+            db_settings.update(original)
+
+    def run_mode(self, mode, application, path, requests):
+        # A fresh server thread per mode, so no connection is carried over from the previous profile
+        server = make_server('127.0.0.1', 0, application, server_class=WSGIServer, handler_class=QuietHandler)
+        thread = threading.Thread(target=serve, args=(server,), daemon=True)
+        thread.start()
+        url = f'http://127.0.0.1:{server.server_port}{path}'
+        try:
+            # Warm-up request: imports, first connection
+            self.fetch(url)
+            timings = []
+            for _ in range(requests):
+                started = time.perf_counter()
+                self.fetch(url)
+                timings.append((time.perf_counter() - started) * 1000)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        timings.sort()
+        return (f'{mode:<11} mean {statistics.mean(timings):7.2f} ms  '
+                f'p50 {timings[len(timings) // 2]:7.2f} ms  '
+                f'p95 {timings[int(len(timings) * 0.95) - 1]:7.2f} ms')
+
+    def fetch(self, url):
+        try:
+            with urllib.request.urlopen(url) as response:
+                response.read()
+        except urllib.error.HTTPError as e:
+            raise CommandError(f'{url} answered {e.code}')
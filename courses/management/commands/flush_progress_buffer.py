@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from courses.services.progress import recompute_course_progress, upsert_lesson_progress
+from courses.services.progress_buffer import get_progress_buffer
+
+
+class Command(BaseCommand):
+    help = 'Writes buffered lesson-progress heartbeats (PROGRESS_WRITE_BEHIND) to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Seconds between flushes; 0 flushes once and exits')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per upsert statement')
+
+    def handle(self, *args, **options):
+        while True:
+            flushed = self.flush(options['batch_size'])
+            if flushed or not options['interval']:
+                self.stdout.write(f'Flushed {flushed} heartbeats')
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
+
+    def flush(self, batch_size):
+        buffer = get_progress_buffer()
+        entries = buffer.claim()
+
+        for start in range(0, len(entries), batch_size):
+            batch = entries[start:start + batch_size]
+            upsert_lesson_progress({
+                (entry['user_id'], entry['lesson_id']): entry for entry in batch
+            })
+            recompute_course_progress((entry['user_id'], entry['course_id']) for entry in batch)
+
+        buffer.ack()
+        return len(entries)
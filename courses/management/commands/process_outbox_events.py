@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from courses.services.outbox import process_pending
+
+
+class Command(BaseCommand):
+    help = 'Runs the handlers of pending outbox events (enrollment activation, ...)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Seconds to wait when nothing is pending; 0 drains once and exits')
+        parser.add_argument('--batch-size', type=int, default=200, help='Events per transaction')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = failed = 0
+            while True:
+                batch_processed, batch_failed = process_pending(options['batch_size'])
+                processed += batch_processed
+                failed += batch_failed
+                # Failed events stay pending; stop instead of retrying them in a tight loop
+                if batch_failed or batch_processed < options['batch_size']:
+                    break
+            if processed or failed or not options['interval']:
+                self.stdout.write(f'Processed {processed} events, failed {failed}')
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
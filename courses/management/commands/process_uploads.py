@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from courses.services.uploads import process_pending
+
+
+class Command(BaseCommand):
+    help = 'Uploads staged images (avatars, course images) and saves their URLs on the models'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Seconds to wait when nothing is due; 0 drains once and exits')
+        parser.add_argument('--batch-size', type=int, default=20, help='Uploads claimed per batch')
+
+    def handle(self, *args, **options):
+        while True:
+            totals = [0, 0, 0]
+            while True:
+                batch = process_pending(options['batch_size'])
+                totals = [total + count for total, count in zip(totals, batch)]
+                if sum(batch) < options['batch_size']:
+                    break
+            done, retried, failed = totals
+            if done or retried or failed or not options['interval']:
+                self.stdout.write(f'Uploaded {done}, retrying {retried}, failed {failed}')
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,62 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+from oauth2_provider.models import AccessToken, RefreshToken
+from oauth2_provider.settings import oauth2_settings
+
+
+class Command(BaseCommand):
+    help = ('Deletes expired OAuth2 access tokens and stale refresh tokens in primary-key ranges '
+            '(same rules as oauth2_provider cleartokens). Schedule it, e.g. hourly from cron')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Width of each primary-key range')
+        parser.add_argument('--sleep', type=float, default=0.1, help='Seconds to pause between batches')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows that would be deleted')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        targets = []
+
+        refresh_expire_seconds = oauth2_settings.REFRESH_TOKEN_EXPIRE_SECONDS
+        if refresh_expire_seconds:
+            # Refresh tokens outlive their access token by REFRESH_TOKEN_EXPIRE_SECONDS
+            refresh_expire_at = now - timedelta(seconds=refresh_expire_seconds)
+            targets.append(('refresh tokens', RefreshToken, Q(revoked__lt=refresh_expire_at) |
+                            Q(access_token__expires__lt=refresh_expire_at)))
+        else:
+            self.stdout.write('REFRESH_TOKEN_EXPIRE_SECONDS is not set, refresh tokens are kept')
+
+        # Access tokens still holding a refresh token are needed to refresh; they go with it
+        targets.append(('access tokens', AccessToken, Q(refresh_token__isnull=True, expires__lt=now)))
+
+        for label, model, condition in targets:
+            if options['dry_run']:
+                self.stdout.write(f'{model.objects.filter(condition).count()} {label} would be deleted')
+                continue
+
+            started = time.monotonic()
+            deleted = self.purge(model, condition, options['batch_size'], options['sleep'])
+            elapsed = time.monotonic() - started
+            rate = deleted / elapsed if elapsed else 0
+            self.stdout.write(self.style.SUCCESS(
+                f'Deleted {deleted} {label} in {elapsed:.1f}s ({rate:.0f} rows/s)'))
+
+    def purge(self, model, condition, batch_size, sleep):
+        bounds = model.objects.filter(condition).aggregate(low=Min('pk'), high=Max('pk'))
+        if bounds['low'] is None:
+            return 0
+
+        deleted = 0
+        start = bounds['low']
+        while start <= bounds['high']:
+            # Each batch is an index range scan on the primary key, so locks stay short
+            _, per_model = model.objects.filter(condition, pk__gte=start, pk__lt=start + batch_size).delete()
+            deleted += per_model.get(model._meta.label, 0)
+            start += batch_size
+            if sleep and start <= bounds['high']:
+                time.sleep(sleep)
+        return deleted
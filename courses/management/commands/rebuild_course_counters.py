@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from courses import cache as catalog_cache
+from courses.models import Course, Chapter, Lesson
+from courses.services import course_detail
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the stored lessons_count / total_duration counters of chapters and courses'
+
+    def handle(self, *args, **kwargs):
+        # Counters are maintained by courses.signals; QuerySet.update(), bulk_create()
+        # and raw SQL bypass them, so run this after such imports.
+        lessons = Lesson.objects.filter(chapter=OuterRef('pk')).order_by().values('chapter')
+        chapters = Chapter.objects.filter(course=OuterRef('pk')).order_by().values('course')
+
+        with transaction.atomic():
+            chapter_rows = Chapter.objects.update(
+                lessons_count=Coalesce(
+                    Subquery(lessons.annotate(c=Count('pk')).values('c'), output_field=IntegerField()), 0),
+                total_duration=Coalesce(
+                    Subquery(lessons.annotate(d=Sum('duration')).values('d'), output_field=IntegerField()), 0),
+            )
+            course_rows = Course.objects.update(
+                lessons_count=Coalesce(
+                    Subquery(chapters.annotate(c=Sum('lessons_count')).values('c'), output_field=IntegerField()), 0),
+                total_duration=Coalesce(
+                    Subquery(chapters.annotate(d=Sum('total_duration')).values('d'), output_field=IntegerField()), 0),
+            )
+
+        # update() sends no signals: drop the cached listings and syllabi showing the counters
+        catalog_cache.bump_generation(catalog_cache.COURSES)
+        course_detail.invalidate(*Course.objects.values_list('pk', flat=True))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt counters for {chapter_rows} chapters and {course_rows} courses'))
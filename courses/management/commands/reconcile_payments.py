@@ -0,0 +1,47 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from courses.services.reconciliation import reconcile_batch, stale_payments
+
+
+class Command(BaseCommand):
+    help = ('Asks MoMo for the status of PENDING payments older than --older-than seconds and settles '
+            'them with their enrollments. Schedule it, e.g. every 15 minutes from cron')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=settings.MOMO_RECONCILE_AFTER,
+                            help='Only payments created at least this many seconds ago')
+        parser.add_argument('--batch-size', type=int, default=100, help='Payments per batch')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to pause between batches')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(seconds=options['older_than'])
+        checked = paid = failed = pending = errors = 0
+        started = time.monotonic()
+
+        after = None
+        while True:
+            batch = stale_payments(cutoff, after, options['batch_size'])
+            if not batch:
+                break
+            after = batch[-1]
+            batch_paid, batch_failed, batch_pending, batch_errors = reconcile_batch([pk for _, pk in batch])
+            checked += len(batch)
+            paid += batch_paid
+            failed += batch_failed
+            pending += batch_pending
+            errors += batch_errors
+            if len(batch) < options['batch_size']:
+                break
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        elapsed = time.monotonic() - started
+        rate = checked / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Checked {checked} payments in {elapsed:.1f}s ({rate:.0f} rows/s): {paid} paid, {failed} failed, '
+            f'{pending} still pending, {errors} not answered'))
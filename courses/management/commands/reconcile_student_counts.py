@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from courses import cache as catalog_cache
+from courses.models import Course, UserCourse, STUDENT_COUNT_STATUSES
+
+
+class Command(BaseCommand):
+    help = 'Recomputes Course.student_count from the enrollment table and fixes drifted rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report drifted courses')
+
+    def handle(self, *args, **options):
+        enrolled = Coalesce(Subquery(
+            UserCourse.objects.filter(course=OuterRef('pk'), status__in=STUDENT_COUNT_STATUSES)
+            .order_by().values('course').annotate(c=Count('pk')).values('c'),
+            output_field=IntegerField()
+        ), 0)
+        drifted = Course.objects.filter(~Q(student_count=enrolled))
+
+        if options['dry_run']:
+            for course_id, stored, actual in drifted.annotate(actual=enrolled).values_list(
+                    'id', 'student_count', 'actual'):
+                self.stdout.write(f'Course {course_id}: stored {stored}, actual {actual}')
+            return
+
+        fixed = drifted.update(student_count=enrolled)
+        if fixed:
+            # Course listings show total_student
+            catalog_cache.bump_generation(catalog_cache.COURSES)
+        self.stdout.write(self.style.SUCCESS(f'Reconciled student_count for {fixed} courses'))
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from courses.services.mailer import deliver_pending
+
+
+class Command(BaseCommand):
+    help = 'Delivers queued emails from the EmailOutbox table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Seconds to wait when the outbox is empty; 0 drains once and exits')
+        parser.add_argument('--batch-size', type=int, default=100, help='Emails per SMTP connection')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                sent, retried, failed, deferred = self.drain(options['batch_size'])
+            except Exception as e:
+                if not options['interval']:
+                    raise
+                # e.g. the database went away: keep the worker alive and try again later
+                self.stderr.write(f'Delivery failed: {e}')
+                time.sleep(options['interval'])
+                continue
+            if sent or retried or failed or deferred or not options['interval']:
+                self.stdout.write(f'Sent {sent}, retrying {retried}, failed {failed}, rate-limited {deferred}')
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
+
+    def drain(self, batch_size):
+        totals = [0, 0, 0, 0]
+        while True:
+            batch = deliver_pending(batch_size)
+            totals = [total + count for total, count in zip(totals, batch)]
+            # A short batch means nothing else is due right now
+            if sum(batch) < batch_size:
+                return totals
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.23 on 2026-10-16 23:35
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    Course = apps.get_model('courses', 'Course')
+    Chapter = apps.get_model('courses', 'Chapter')
+    Lesson = apps.get_model('courses', 'Lesson')
+
+    lessons = Lesson.objects.filter(chapter=OuterRef('pk')).order_by().values('chapter')
+    Chapter.objects.update(
+        lessons_count=Coalesce(Subquery(lessons.annotate(c=Count('pk')).values('c'), output_field=IntegerField()), 0),
+        total_duration=Coalesce(Subquery(lessons.annotate(d=Sum('duration')).values('d'), output_field=IntegerField()), 0),
+    )
+    chapters = Chapter.objects.filter(course=OuterRef('pk')).order_by().values('course')
+    Course.objects.update(
+        lessons_count=Coalesce(Subquery(chapters.annotate(c=Sum('lessons_count')).values('c'), output_field=IntegerField()), 0),
+        total_duration=Coalesce(Subquery(chapters.annotate(d=Sum('total_duration')).values('d'), output_field=IntegerField()), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0021_rename_userrole_user_user_role_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chapter',
+            name='lessons_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chapter',
+            name='total_duration',
+            field=models.IntegerField(default=0, editable=False, help_text='Total lesson duration in minutes'),
+        ),
+        migrations.AddField(
+            model_name='course',
+            name='lessons_count',
+            field=models.IntegerField(db_index=True, default=0, editable=False, help_text='Total lessons in the course, maintained by courses.signals'),
+        ),
+        migrations.AddField(
+            model_name='course',
+            name='total_duration',
+            field=models.IntegerField(db_index=True, default=0, editable=False, help_text='Total lesson duration in minutes, maintained by courses.signals'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
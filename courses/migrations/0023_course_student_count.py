@@ -0,0 +1,30 @@
+# Generated by Django 4.2.23 on 2026-10-16 23:36
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_student_count(apps, schema_editor):
+    Course = apps.get_model('courses', 'Course')
+    UserCourse = apps.get_model('courses', 'UserCourse')
+
+    enrolled = UserCourse.objects.filter(course=OuterRef('pk')).exclude(status='PAYMENT_FAILED') \
+        .order_by().values('course').annotate(c=Count('pk')).values('c')
+    Course.objects.update(student_count=Coalesce(Subquery(enrolled, output_field=IntegerField()), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0022_course_lesson_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='course',
+            name='student_count',
+            field=models.IntegerField(db_index=True, default=0, editable=False, help_text='Enrollments in STUDENT_COUNT_STATUSES, maintained by courses.signals'),
+        ),
+        migrations.RunPython(fill_student_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.23 on 2026-10-16 23:52
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0024_email_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingUpload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, null=True)),
+                ('model_label', models.CharField(max_length=100)),
+                ('object_id', models.CharField(max_length=64)),
+                ('field_name', models.CharField(max_length=100)),
+                ('folder', models.CharField(default='uploads', max_length=100)),
+                ('staged_path', models.CharField(max_length=500)),
+                ('status', models.CharField(choices=[('PENDING', 'Đang chờ upload'), ('DONE', 'Đã upload'), ('FAILED', 'Upload thất bại')], default='PENDING', max_length=20)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('result_url', models.URLField(blank=True, default='', max_length=500)),
+                ('last_error', models.TextField(blank=True, default='')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='courses_pen_status_dc3b21_idx'), models.Index(fields=['model_label', 'object_id', 'field_name'], name='courses_pen_model_l_bab652_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.23 on 2026-10-16 23:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0027_outbox_event'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('status', 'PENDING')), fields=['created_at', 'id'], name='payment_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.23 on 2026-10-17 00:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0028_payment_pending_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailoutbox',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='emailoutbox',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Đang chờ gửi'), ('SENT', 'Đã gửi'), ('FAILED', 'Gửi thất bại'), ('EXPIRED', 'Hết hạn trước khi gửi')], default='PENDING', max_length=20),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-17 00:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0029_email_outbox_expiry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='pay_url',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from cloudinary.models import CloudinaryField
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.utils import timezone
 
 
 class CourseStatus(models.TextChoices):
@@ -12,6 +13,16 @@ class CourseStatus(models.TextChoices):
     PAYMENT_FAILED = 'PAYMENT_FAILED', "Thanh toán thất bại"
 
 
+# Enrollments in these statuses are counted in Course.student_count
+STUDENT_COUNT_STATUSES = [
+    CourseStatus.PENDING,
+    CourseStatus.IN_PROGRESS,
+    CourseStatus.FAILED,
+    CourseStatus.COMPLETE,
+    CourseStatus.INACTIVE,
+]
+
+
 class PaymentStatus(models.TextChoices):
     PENDING = 'PENDING', 'Đang chờ thanh toán'
     SUCCESS = 'SUCCESS', 'Thanh toán thành công'
@@ -27,6 +38,24 @@ class BaseModel(models.Model):
         abstract = True
 
 
+class CounterFieldsMixin:
+    """
+    counter_fields are maintained by F() updates in courses.signals: saving an existing row never
+    writes them back, or the stale in-memory values would undo concurrent increments
+    """
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not kwargs.get('force_insert'):
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                deferred = self.get_deferred_fields()
+                update_fields = [field.name for field in self._meta.concrete_fields
+                                 if not field.primary_key and field.attname not in deferred]
+            kwargs['update_fields'] = [name for name in update_fields if name not in self.counter_fields]
+        super().save(*args, **kwargs)
+
+
 class Role(BaseModel):
     name = models.CharField(max_length=100, default='')
     description = models.TextField(default='')
@@ -64,7 +93,7 @@ class Category(BaseModel):
         return self.name
 
 
-class Course(BaseModel):
+class Course(CounterFieldsMixin, BaseModel):
     class Level(models.TextChoices):
         SO_CAP = "so_cap", "Sơ cấp"
         TRUNG_CAP = "trung_cap", "Trung cấp"
@@ -87,27 +116,18 @@ class Course(BaseModel):
     duration = models.IntegerField(help_text="Duration in minutes", default=0)
     learning_outcomes = models.TextField(default='', help_text="Learning outcomes in HTML format")
     requirements = models.TextField(default='', help_text="Course requirements in HTML format")
+    lessons_count = models.IntegerField(default=0, db_index=True, editable=False,
+                                        help_text="Total lessons in the course, maintained by courses.signals")
+    total_duration = models.IntegerField(default=0, db_index=True, editable=False,
+                                         help_text="Total lesson duration in minutes, maintained by courses.signals")
+    student_count = models.IntegerField(default=0, db_index=True, editable=False,
+                                        help_text="Enrollments in STUDENT_COUNT_STATUSES, maintained by courses.signals")
+
+    counter_fields = ('lessons_count', 'total_duration', 'student_count')
 
     def __str__(self):
         return self.name
 
-    @property
-    def total_duration(self):
-        """Calculate total duration of the course in minutes from all lessons"""
-        # We sum all durations of lessons in this course's chapters
-        total = self.chapters.all().aggregate(
-            total=models.Sum('lessons__duration')
-        )['total']
-        return total if total else 0
-
-    @property
-    def lessons_count(self):
-        """Count total lessons in the course"""
-        total = 0
-        for chapter in self.chapters.all():
-            total += chapter.lessons.count()
-        return total
-
 
 class UserCourse(BaseModel):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="user_course")
@@ -118,11 +138,15 @@ class UserCourse(BaseModel):
         unique_together = ['user', 'course']
 
 
-class Chapter(BaseModel):
+class Chapter(CounterFieldsMixin, BaseModel):
     course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name="chapters", null=True, blank=True)
     name = models.CharField(max_length=255, default='')
     description = models.TextField(default='')
     is_published = models.BooleanField(default=False)
+    lessons_count = models.IntegerField(default=0, editable=False)
+    total_duration = models.IntegerField(default=0, editable=False, help_text="Total lesson duration in minutes")
+
+    counter_fields = ('lessons_count', 'total_duration')
 
 
 class Lesson(BaseModel):
@@ -149,6 +173,23 @@ class Payment(BaseModel):
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     method = models.CharField(max_length=50, default='Momo')
     status = models.CharField(max_length=50, choices=PaymentStatus.choices, default=PaymentStatus.PENDING)
+    # Link MoMo của đơn, dùng lại khi học viên bấm đăng ký lần nữa trong lúc đơn còn mở
+    pay_url = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            # Keyset scan of `manage.py reconcile_payments`
+            models.Index(fields=['created_at', 'id'], condition=models.Q(status=PaymentStatus.PENDING),
+                         name='payment_pending_idx'),
+        ]
+
+
+class PaymentNotification(BaseModel):
+    """Ledger of processed MoMo results (IPN or redirect); the unique key makes retries no-ops"""
+    trans_id = models.CharField(max_length=100, unique=True)
+    order_id = models.CharField(max_length=36, db_index=True)
+    result_code = models.IntegerField()
+    source = models.CharField(max_length=20)
 
 
 class LessonProgressStatus(models.TextChoices):
@@ -195,39 +236,46 @@ class CourseProgress(BaseModel):
     def update_progress(self):
         """Update course progress based on lesson progress and sync UserCourse status"""
         from .models import Lesson, UserCourse, CourseStatus
-        
-        # Get all lessons in this course
-        all_lessons = Lesson.objects.filter(chapter__course=self.course)
-        self.total_lessons = all_lessons.count()
-        
-        # Get lesson progress for this user and course
-        lesson_progresses = LessonProgress.objects.filter(
-            user=self.user,
-            lesson__chapter__course=self.course
-        )
 
-        self.completed_lessons = lesson_progresses.filter(status=LessonProgressStatus.COMPLETED).count()
-        self.total_watch_time = sum(lp.watch_time for lp in lesson_progresses)
-
-        if self.total_lessons > 0:
-            self.completion_percentage = (self.completed_lessons / self.total_lessons) * 100
-        else:
-            self.completion_percentage = 0
+        # One statement: every lesson of the course LEFT JOINed to this user's progress row
+        stats = Lesson.objects.filter(chapter__course_id=self.course_id).annotate(
+            own_progress=models.FilteredRelation('progress', condition=models.Q(progress__user_id=self.user_id))
+        ).aggregate(
+            total_lessons=models.Count('pk'),
+            completed_lessons=models.Count(
+                'own_progress', filter=models.Q(own_progress__status=LessonProgressStatus.COMPLETED)),
+            total_watch_time=models.Sum('own_progress__watch_time'),
+        )
 
-        # Sync with UserCourse status
-        try:
-            user_course = UserCourse.objects.get(user=self.user, course=self.course)
+        total_lessons = stats['total_lessons']
+        completed_lessons = stats['completed_lessons']
+        values = {
+            'total_lessons': total_lessons,
+            'completed_lessons': completed_lessons,
+            'total_watch_time': stats['total_watch_time'] or 0,
+            'completion_percentage': (completed_lessons / total_lessons) * 100 if total_lessons > 0 else 0,
+        }
+
+        changed = [field for field, value in values.items() if getattr(self, field) != value]
+        if not changed and self.pk:
+            return
+
+        for field in changed:
+            setattr(self, field, values[field])
+
+        # Sync with UserCourse status; conditional UPDATEs write nothing when already in sync
+        if 'completion_percentage' in changed or not self.pk:
+            user_courses = UserCourse.objects.filter(user_id=self.user_id, course_id=self.course_id)
             if self.completion_percentage >= 100:
-                user_course.status = CourseStatus.COMPLETE
+                user_courses.exclude(status=CourseStatus.COMPLETE).update(status=CourseStatus.COMPLETE)
             else:
                 # If they were complete but added more lessons, move back to IN_PROGRESS
-                if user_course.status == CourseStatus.COMPLETE:
-                    user_course.status = CourseStatus.IN_PROGRESS
-            user_course.save()
-        except UserCourse.DoesNotExist:
-            pass
+                user_courses.filter(status=CourseStatus.COMPLETE).update(status=CourseStatus.IN_PROGRESS)
 
-        self.save()
+        if self.pk:
+            self.save(update_fields=changed + ['updated_at'])
+        else:
+            self.save()
 
 
 class Forum(BaseModel):
@@ -270,3 +318,77 @@ class Comment(BaseModel):
 
     def __str__(self):
         return self.user.username
+
+
+class EmailStatus(models.TextChoices):
+    PENDING = 'PENDING', 'Đang chờ gửi'
+    SENT = 'SENT', 'Đã gửi'
+    FAILED = 'FAILED', 'Gửi thất bại'
+    EXPIRED = 'EXPIRED', 'Hết hạn trước khi gửi'
+
+
+class EmailOutbox(BaseModel):
+    """Emails waiting for `manage.py send_outbox_emails`; requests only insert a row"""
+    to_email = models.EmailField(db_index=True)
+    from_email = models.CharField(max_length=255)
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    status = models.CharField(max_length=20, choices=EmailStatus.choices, default=EmailStatus.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    # Mail chỉ có ý nghĩa trong thời gian ngắn (OTP): quá hạn thì bỏ, không gửi nữa
+    expires_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f'{self.subject} -> {self.to_email}'
+
+
+class UploadStatus(models.TextChoices):
+    PENDING = 'PENDING', 'Đang chờ upload'
+    DONE = 'DONE', 'Đã upload'
+    FAILED = 'FAILED', 'Upload thất bại'
+
+
+class PendingUpload(BaseModel):
+    """A staged file waiting for `manage.py process_uploads` to upload it and set <model>.<field_name>"""
+    model_label = models.CharField(max_length=100)
+    object_id = models.CharField(max_length=64)
+    field_name = models.CharField(max_length=100)
+    folder = models.CharField(max_length=100, default='uploads')
+    staged_path = models.CharField(max_length=500)
+    status = models.CharField(max_length=20, choices=UploadStatus.choices, default=UploadStatus.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    result_url = models.URLField(max_length=500, blank=True, default='')
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+            models.Index(fields=['model_label', 'object_id', 'field_name']),
+        ]
+
+    def __str__(self):
+        return f'{self.model_label}#{self.object_id}.{self.field_name}'
+
+
+class OutboxEvent(BaseModel):
+    """Side effects of a committed change, written in the same transaction and handled by `manage.py process_outbox_events`"""
+    event_type = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(processed_at__isnull=True), name='outbox_event_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.event_type} #{self.pk}'
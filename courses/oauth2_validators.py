@@ -0,0 +1,84 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import DEFERRED
+from django.utils import timezone
+from oauth2_provider.models import AccessToken, Application
+from oauth2_provider.oauth2_validators import OAuth2Validator
+
+from courses.models import Role, User
+
+auth_cache = caches['auth']
+
+
+def token_cache_key(token_checksum):
+    return f'oauth2:token:{token_checksum}'
+
+
+def forget_tokens(token_checksums):
+    """Drop cached tokens; called by courses.signals when a token, its user or role changes"""
+    keys = [token_cache_key(checksum) for checksum in token_checksums if checksum]
+    if keys:
+        auth_cache.delete_many(keys)
+
+
+# Only these columns go to the cache: never the password hash nor the application's secret.
+# Anything else is deferred and loaded on first access.
+TOKEN_FIELDS = ('id', 'user_id', 'application_id', 'expires', 'scope')
+USER_FIELDS = ('id', 'username', 'email', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_superuser',
+               'user_role_id')
+ROLE_FIELDS = ('id', 'name')
+APPLICATION_FIELDS = ('id', 'client_id', 'name', 'client_type', 'authorization_grant_type')
+
+
+def light_instance(model, fields, values):
+    """An instance with only `fields` loaded, as .only() would give"""
+    loaded = dict(zip(fields, values))
+    return model.from_db('default', [f.attname for f in model._meta.concrete_fields],
+                         [loaded.get(f.attname, DEFERRED) for f in model._meta.concrete_fields])
+
+
+def dump_access_token(access_token):
+    user, role = access_token.user, access_token.user.user_role
+    return (
+        tuple(getattr(access_token, f) for f in TOKEN_FIELDS),
+        tuple(getattr(user, f) for f in USER_FIELDS),
+        tuple(getattr(role, f) for f in ROLE_FIELDS) if role else None,
+        tuple(getattr(access_token.application, f) for f in APPLICATION_FIELDS) if access_token.application_id else None,
+    )
+
+
+def load_access_token(token, token_checksum, cached):
+    token_values, user_values, role_values, application_values = cached
+    access_token = light_instance(AccessToken, TOKEN_FIELDS, token_values)
+    access_token.token, access_token.token_checksum = token, token_checksum
+    user = light_instance(User, USER_FIELDS, user_values)
+    user.user_role = light_instance(Role, ROLE_FIELDS, role_values) if role_values else None
+    access_token.user = user
+    access_token.application = (light_instance(Application, APPLICATION_FIELDS, application_values)
+                                if application_values else None)
+    return access_token
+
+
+class RoleAwareOAuth2Validator(OAuth2Validator):
+    def _load_access_token(self, token):
+        token_checksum = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        key = token_cache_key(token_checksum)
+        cached = auth_cache.get(key)
+        if cached is not None:
+            return load_access_token(token, token_checksum, cached)
+
+        # Load the user's role with the token so permission checks need no extra query
+        access_token = (
+            AccessToken.objects.select_related("application", "user", "user__user_role")
+            .filter(token_checksum=token_checksum)
+            .first()
+        )
+        if access_token is not None:
+            # Never keep a token in the cache past its expiry
+            timeout = min(settings.OAUTH2_TOKEN_CACHE_TIMEOUT,
+                          int((access_token.expires - timezone.now()).total_seconds()))
+            if timeout > 0:
+                auth_cache.set(key, dump_access_token(access_token), timeout=timeout)
+        return access_token
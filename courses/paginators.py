@@ -1,11 +1,133 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
 
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
-class CoursePagination(PageNumberPagination):
+
+def is_cursor_requested(request):
+    return 'cursor' in request.query_params or request.query_params.get('pagination') == 'cursor'
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination: each page filters on the ordering values of the last row
+    of the previous page, so there is no COUNT(*) and no OFFSET scan on deep pages.
+    Select it with ?pagination=cursor and follow the returned `next` links.
+    """
+    ordering = ('-id',)
+    page_size = 20
+    cursor_query_param = 'cursor'
+    # Only paginate when the client asks for cursor mode; plain list otherwise
+    opt_in = False
+
+    def __init__(self, ordering=None, page_size=None):
+        if ordering:
+            self.ordering = ordering
+        if page_size:
+            self.page_size = page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.opt_in and not is_cursor_requested(request):
+            return None
+
+        self.request = request
+        self.model = queryset.model
+        queryset = queryset.order_by(*self.ordering)
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded:
+            queryset = queryset.filter(self.after(self.decode_cursor(encoded)))
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def after(self, values):
+        """(a, b, c) > (x, y, z) expanded as a > x OR (a = x AND b > y) OR ..., honouring each direction"""
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            step = Q(**{f'{name}__{lookup}': values[i]})
+            for prev_field, prev_value in zip(self.ordering[:i], values[:i]):
+                step &= Q(**{prev_field.lstrip('-'): prev_value})
+            condition |= step
+        return condition
+
+    def encode_cursor(self, obj):
+        values = []
+        for field in self.ordering:
+            value = getattr(obj, field.lstrip('-'))
+            values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, encoded):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            if len(values) != len(self.ordering) or None in values:
+                raise ValueError
+            return [self.model._meta.get_field(field.lstrip('-')).to_python(value)
+                    for field, value in zip(self.ordering, values)]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound('Invalid cursor')
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        url = replace_query_param(self.request.build_absolute_uri(), 'pagination', 'cursor')
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data
+        })
+
+
+class KeysetOptInPagination(PageNumberPagination):
+    """Page-number pagination, switching to KeysetPagination when cursor mode is requested"""
+    keyset_ordering = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.keyset_ordering and is_cursor_requested(request):
+            self.keyset = KeysetPagination(ordering=self.keyset_ordering, page_size=self.page_size)
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+
+class CoursePagination(KeysetOptInPagination):
     page_size = 8
+    keyset_ordering = ('-id',)
 
 class ChapterPagination(PageNumberPagination):
     page_size = 6
 
 class LessonPagination(PageNumberPagination):
-    page_size = 8
\ No newline at end of file
+    page_size = 8
+
+class EnrollmentPagination(KeysetPagination):
+    page_size = 8
+    ordering = ('-id',)
+    opt_in = True
+
+class TopicPagination(KeysetPagination):
+    page_size = 10
+    ordering = ('-is_pinned', '-last_activity', 'id')
+    opt_in = True
+
+class CommentPagination(KeysetPagination):
+    page_size = 20
+    ordering = ('created_at', 'id')
+    opt_in = True
@@ -1,22 +1,54 @@
+from django.conf import settings
 from rest_framework import permissions
 
+from courses.services import permission_matrix
+
+
+def get_role_name(request):
+    """Lower-cased role name of the authenticated user, resolved once per request ('' when none)"""
+    role_name = getattr(request, '_role_name', None)
+    if role_name is None:
+        user = request.user
+        role_name = ''
+        if user and user.is_authenticated and getattr(user, 'user_role_id', None):
+            role_name = user.user_role.name.lower()
+        request._role_name = role_name
+    return role_name
+
 
 class IsTeacher(permissions.IsAuthenticated):
     def has_permission(self, request, view):
-        return super().has_permission(request, view) and request.user.user_role.name.lower() == 'teacher'
+        return super().has_permission(request, view) and get_role_name(request) == 'teacher'
 
 
 class IsStudent(permissions.IsAuthenticated):
     def has_permission(self, request, view):
-        return super().has_permission(request, view) and request.user.user_role.name.lower() == 'student'
+        return super().has_permission(request, view) and get_role_name(request) == 'student'
 
 
 class IsAdmin(permissions.IsAuthenticated):
     def has_permission(self, request, view):
-        return super().has_permission(request, view) and request.user.user_role.name.lower() == 'admin'
+        return super().has_permission(request, view) and get_role_name(request) == 'admin'
 
 
 class IsTeacherOrAdmin(permissions.IsAuthenticated):
     def has_permission(self, request, view):
-        return super().has_permission(request,
-                                      view) and (request.user.user_role.name.lower() == 'teacher' or request.user.user_role.name.lower() == 'admin')
+        return super().has_permission(request, view) and get_role_name(request) in ('teacher', 'admin')
+
+
+class PermissionMatrixMixin:
+    """
+    Enforces the Permission table (role, method, path) on top of the view's own permissions
+    when settings.PERMISSION_MATRIX_ENFORCED is on. Anonymous requests and superusers are
+    left to the view's permission classes.
+    """
+    def check_permissions(self, request):
+        super().check_permissions(request)
+        if not settings.PERMISSION_MATRIX_ENFORCED or request.method == 'OPTIONS':
+            return
+
+        user = request.user
+        if not user or not user.is_authenticated or user.is_superuser:
+            return
+        if not permission_matrix.is_allowed(get_role_name(request), request.method, request.path):
+            self.permission_denied(request, message="Vai trò của bạn không có quyền truy cập chức năng này")
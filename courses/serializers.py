@@ -1,33 +1,26 @@
 from courses.models import Category, Course, User, UserCourse, Forum, Comment, Chapter, Lesson, Document, \
-    LessonProgress, CourseProgress, LessonProgressStatus, Topic
+    LessonProgress, CourseProgress, LessonProgressStatus, Topic, CourseStatus
 from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
-import cloudinary
-import cloudinary.uploader
+from courses.services import enrollments, uploads
 
 
 class BaseSerializer(serializers.ModelSerializer):
-    def upload_to_cloudinary(self, image_file, folder="uploads"):
-        try:
-            upload_result = cloudinary.uploader.upload(
-                image_file,
-                folder=folder,
-                resource_type="image",
-                transformation=[
-                    {'width': 500, 'height': 500, 'crop': 'limit'},
-                    {'quality': 'auto'}
-                ]
-            )
-            return upload_result.get('secure_url')
-        except Exception as e:
-            raise serializers.ValidationError(f"Lỗi khi upload ảnh: {str(e)}")
-
-    def handle_image_upload(self, validated_data, field_name, folder="uploads"):
-        if field_name in validated_data and validated_data[field_name]:
-            image_file = validated_data[field_name]
-            secure_url = self.upload_to_cloudinary(image_file, folder)
-            validated_data[field_name] = secure_url
-        return validated_data
+    def stage_image_upload(self, validated_data, field_name):
+        """
+        Move an uploaded file out of validated_data into the staging area and return its path;
+        the field keeps its current value until `manage.py process_uploads` uploads the file.
+        A URL / public id given as a string is saved as it is.
+        """
+        value = validated_data.get(field_name)
+        if value is not None and hasattr(value, 'chunks'):
+            validated_data.pop(field_name)
+            return uploads.stage_file(value)
+        return None
+
+    def enqueue_image_upload(self, instance, field_name, staged_path, folder="uploads"):
+        if staged_path:
+            uploads.enqueue_upload(instance, field_name, staged_path, folder)
 
 
 class CategorySerializer(serializers.ModelSerializer):
@@ -42,13 +35,13 @@ class TeacherSerializer(serializers.ModelSerializer):
         fields = ['id', 'first_name', 'last_name']
 
 
-class ItemSerializer(serializers.ModelSerializer):
+class ItemSerializer(BaseSerializer):
     def to_representation(self, instance):
         data = super().to_representation(instance)
 
         data['image'] = instance.image.url
         
-        # If it's a course, use the dynamic total_duration and lessons_count
+        # If it's a course, expose the stored total_duration and lessons_count counters
         if hasattr(instance, 'total_duration'):
             data['duration'] = instance.total_duration
         
@@ -73,7 +66,7 @@ class CourseSerializer(ItemSerializer):
         return obj.lecturer.last_name + " " + obj.lecturer.first_name
 
     def get_total_student(self, obj):
-        return getattr(obj, 'total_student_count', obj.user_course.count())
+        return obj.student_count
 
     def get_category_name(self, obj):
         if hasattr(obj, 'category') and obj.category:
@@ -90,6 +83,14 @@ class CourseSerializer(ItemSerializer):
 
         return extra_kwargs
 
+    def update(self, instance, validated_data):
+        # A new course image is uploaded in the background; the current one stays until then.
+        # On create the image is still uploaded inline, the course needs one to be listed.
+        staged_image = self.stage_image_upload(validated_data, 'image')
+        instance = super().update(instance, validated_data)
+        self.enqueue_image_upload(instance, 'image', staged_image, 'courses')
+        return instance
+
 
 class ChapterSerializer(BaseSerializer):
     class Meta:
@@ -129,13 +130,14 @@ class UserRegistrationSerializer(BaseSerializer):
         return value
 
     def create(self, validated_data):
-        validated_data = self.handle_image_upload(validated_data, 'avatar', 'avatars')
+        staged_avatar = self.stage_image_upload(validated_data, 'avatar')
         validated_data.pop('confirm_password')
         password = validated_data.pop('password')
 
         user = User.objects.create(**validated_data)
         user.set_password(password)
         user.save()
+        self.enqueue_image_upload(user, 'avatar', staged_avatar, 'avatars')
         return user
 
 
@@ -147,7 +149,7 @@ class UserUpdateSerializer(BaseSerializer):
         fields = ('first_name', 'last_name', 'username', 'email', 'avatar', 'address', 'introduce', 'password', 'phone')
 
     def update(self, instance, validated_data):
-        validated_data = self.handle_image_upload(validated_data, 'avatar', 'avatars')
+        staged_avatar = self.stage_image_upload(validated_data, 'avatar')
         password = validated_data.pop('password', None)
 
         for attr, value in validated_data.items():
@@ -157,6 +159,7 @@ class UserUpdateSerializer(BaseSerializer):
             instance.set_password(password)
 
         instance.save()
+        self.enqueue_image_upload(instance, 'avatar', staged_avatar, 'avatars')
         return instance
 
 
@@ -205,13 +208,12 @@ class UserCourseSerializer(BaseSerializer):
     def create(self, validated_data):
         user = self.context['request'].user
         course = validated_data.get('course')
-        
-        # Check if user is already enrolled
-        if UserCourse.objects.filter(user=user, course=course).exists():
+
+        enrollment, self.created = enrollments.enroll(user, course, validated_data.get('status', CourseStatus.PENDING))
+        # Đăng ký lại khi đang chờ thanh toán: trả về enrollment cũ để tiếp tục thanh toán
+        if not self.created and enrollment.status != CourseStatus.PENDING:
             raise serializers.ValidationError("Bạn đã đăng ký khóa học này rồi.")
-            
-        validated_data['user'] = user
-        return super().create(validated_data)
+        return enrollment
 
 
 class UserNameMixin:
@@ -358,48 +360,42 @@ class ChapterDetailSerializer(serializers.ModelSerializer):
                   'lessons']
 
 
-class CourseDetailSerializer(serializers.ModelSerializer):
+def personalize_course_detail(data, is_enrolled, is_free, student_count):
+    """Apply the live and per-viewer parts (student count, is_enrolled flag, paywall) to a course syllabus document"""
+    data = dict(data)
+    data['students_count'] = data['total_student'] = student_count
+    data['is_enrolled'] = is_enrolled
+
+    # Hide chapters/lessons if not enrolled/lecturer AND not a free course
+    if not is_enrolled and not is_free:
+        data['chapters'] = []
+    return data
+
+
+class CourseSyllabusSerializer(serializers.ModelSerializer):
+    """
+    Viewer-independent course detail, cached per course by courses.services.course_detail.
+    The student count changes with every enrollment, so personalize_course_detail adds it.
+    """
     lecturer = LecturerSerializer(read_only=True)
-    students_count = serializers.SerializerMethodField(read_only=True)
     chapters = ChapterDetailSerializer(many=True, read_only=True)
     lecturer_name = serializers.SerializerMethodField(read_only=True)
-    is_enrolled = serializers.SerializerMethodField(read_only=True)
     subject_name = serializers.CharField(source='subject', read_only=True)
 
     class Meta:
         model = Course
         fields = ['id', 'name', 'description', 'price', 'level', 'duration', 'lessons_count', 'thumbnail_url', 'image', 'learning_outcomes',
-                  'requirements', 'video_url', 'lecturer', 'lecturer_name', 'students_count', 'chapters', 'subject_name', 'is_enrolled']
-
-    def get_is_enrolled(self, obj):
-        request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            if obj.lecturer == request.user:
-                return True
-            return UserCourse.objects.filter(user=request.user, course=obj).exists()
-        return False
+                  'requirements', 'video_url', 'lecturer', 'lecturer_name', 'chapters', 'subject_name']
 
     def get_lecturer_name(self, obj):
         if obj.lecturer:
             return f"{obj.lecturer.last_name} {obj.lecturer.first_name}"
         return ""
 
-    def get_students_count(self, obj):
-        return obj.user_course.count()
-
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        request = self.context.get('request')
-        
-        # Check if user is enrolled or is lecturer
-        is_enrolled = self.get_is_enrolled(instance)
-        is_free = instance.price == 0
-        
-        # Hide chapters/lessons if not enrolled/lecturer AND not a free course
-        if not is_enrolled and not is_free:
-            data['chapters'] = []  # Hide lessons for paid courses if not enrolled
-            
-        # Convert total dynamic duration to minutes
+
+        # Stored total lesson duration in minutes
         data['duration'] = instance.total_duration
         # Add lessons count
         data['lessons_count'] = instance.lessons_count
@@ -409,11 +405,25 @@ class CourseDetailSerializer(serializers.ModelSerializer):
         if instance.image:
             data['image'] = instance.image.url
             
-        data['total_student'] = instance.user_course.count()
-            
         return data
 
 
+class CourseDetailSerializer(CourseSyllabusSerializer):
+    def get_is_enrolled(self, obj):
+        request = self.context.get('request')
+        if request and request.user.is_authenticated:
+            if obj.lecturer_id == request.user.id:
+                return True
+            return UserCourse.objects.filter(user=request.user, course=obj).exists()
+        return False
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # Check if user is enrolled or is lecturer
+        return personalize_course_detail(data, self.get_is_enrolled(instance), instance.price == 0,
+                                         instance.student_count)
+
+
 class LessonProgressSerializer(serializers.ModelSerializer):
     lesson_name = serializers.CharField(source='lesson.name', read_only=True)
     lesson_duration = serializers.IntegerField(source='lesson.duration', read_only=True)
@@ -481,8 +491,42 @@ class LessonProgressUpdateSerializer(serializers.ModelSerializer):
         return instance
 
 
+class LessonProgressEventSerializer(serializers.Serializer):
+    lesson_id = serializers.IntegerField()
+    watch_time = serializers.IntegerField(min_value=0, default=0, help_text="Thời gian xem (giây)")
+    completion_percentage = serializers.FloatField(min_value=0, max_value=100, default=0,
+                                                   help_text="Phần trăm hoàn thành (0-100)")
+    client_ts = serializers.DateTimeField(required=False, help_text="Thời điểm ghi nhận trên thiết bị")
+
+
+class LessonProgressBatchSerializer(serializers.Serializer):
+    events = LessonProgressEventSerializer(many=True, allow_empty=False, max_length=500)
+
+
+class PasswordResetEmailSerializer(serializers.Serializer):
+    email = serializers.EmailField()
+
+    def validate_email(self, value):
+        # OTP và trạng thái verify được lưu theo email viết thường
+        return value.strip().lower()
+
+
+class VerifyOTPSerializer(PasswordResetEmailSerializer):
+    otp = serializers.RegexField(r'^\d{6}$')
+
+
+class ResetPasswordSerializer(PasswordResetEmailSerializer):
+    password = serializers.CharField()
+
+
+class EnrolledCourseDetailSerializer(CourseDetailSerializer):
+    def get_is_enrolled(self, obj):
+        # Only rendered for the requester's own active enrollments
+        return True
+
+
 class EnrolledCourseSerializer(serializers.ModelSerializer):
-    course = CourseDetailSerializer(read_only=True)
+    course = EnrolledCourseDetailSerializer(read_only=True)
     progress = serializers.SerializerMethodField()
     status_display = serializers.CharField(source='get_status_display', read_only=True)
 
@@ -492,22 +536,21 @@ class EnrolledCourseSerializer(serializers.ModelSerializer):
 
     def get_progress(self, obj):
         """
-        Lấy CourseProgress từ prefetched data và cập nhật lại tiến độ mới nhất
+        Chỉ đọc: CourseProgress được cập nhật khi ghi tiến độ bài học (lesson-progress)
         """
-        # Sử dụng prefetched data
-        if hasattr(obj.course, 'user_course_progress'):
-            progress_list = obj.course.user_course_progress
-            if progress_list:
-                # Lấy progress đầu tiên (chỉ có 1 vì filter theo user)
-                progress = progress_list[0]
-                # Luôn cập nhật lại tiến độ để đảm bảo tính chính xác nhất quán với learning area
-                progress.update_progress()
-                return CourseProgressSerializer(progress).data
-
-        # Fallback: Lấy hoặc tạo progress mới nếu chưa có
-        progress, created = CourseProgress.objects.get_or_create(
-            user=obj.user,
-            course=obj.course
-        )
-        progress.update_progress()
-        return CourseProgressSerializer(progress).data
+        # Sử dụng prefetched data (chỉ có 1 vì filter theo user)
+        progress_list = getattr(obj.course, 'user_course_progress', None)
+        if progress_list:
+            progress = progress_list[0]
+        else:
+            # Chưa học bài nào: trả về tiến độ rỗng, không tạo bản ghi trong GET
+            progress = CourseProgress(user_id=obj.user_id, course=obj.course)
+
+        data = CourseProgressSerializer(progress).data
+        # Lessons may have been added since the last write; use the course's stored counter
+        total_lessons = obj.course.lessons_count
+        completed_lessons = min(progress.completed_lessons, total_lessons)
+        data['total_lessons'] = total_lessons
+        data['completed_lessons'] = completed_lessons
+        data['completion_percentage'] = (completed_lessons / total_lessons) * 100 if total_lessons else 0
+        return data
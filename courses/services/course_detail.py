@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef, Value
+
+from courses import cache as catalog_cache
+from courses.models import Course, UserCourse
+from courses.serializers import CourseSyllabusSerializer, personalize_course_detail
+
+
+def generation_namespace(course_id):
+    return f'course_detail:{course_id}'
+
+
+def document_key(course_id):
+    # invalidate() bumps the generation, so a rebuild that read the old rows lands on a key nobody reads
+    generation = catalog_cache.get_generation(generation_namespace(course_id))
+    return f'course_detail:{course_id}:v{generation}'
+
+
+def build_document(course_id, key=None):
+    """Serialize the viewer-independent syllabus of an active course and store it in the cache"""
+    key = key or document_key(course_id)
+    course = Course.objects.select_related('lecturer', 'lecturer__user_role').prefetch_related(
+        'chapters__lessons__documents'
+    ).get(pk=course_id, active=True)
+
+    document = {
+        'data': CourseSyllabusSerializer(course).data,
+        'lecturer_id': course.lecturer_id,
+        'is_free': course.price == 0,
+    }
+    cache.set(key, document, timeout=settings.COURSE_DETAIL_CACHE_TIMEOUT)
+    return document
+
+
+def get_document(course_id):
+    # Generation read before the rows: an invalidation during the build makes this key stale
+    key = document_key(course_id)
+    document = cache.get(key)
+    if document is None:
+        document = build_document(course_id, key)
+    return document
+
+
+def invalidate(*course_ids):
+    catalog_cache.bump_generation(*[generation_namespace(course_id) for course_id in course_ids if course_id])
+
+
+def get_course_detail(course_id, user):
+    """Cached syllabus plus the live student count, per-user is_enrolled flag and paywall; raises Course.DoesNotExist"""
+    course_id = int(course_id)
+    document = get_document(course_id)
+
+    # One query for both live parts, so enrollments never evict the cached syllabus
+    live = Course.objects.filter(pk=course_id)
+    if user.is_authenticated:
+        live = live.annotate(enrolled=Exists(UserCourse.objects.filter(user=user, course_id=OuterRef('pk'))))
+    else:
+        live = live.annotate(enrolled=Value(False))
+    student_count, enrolled = live.values_list('student_count', 'enrolled').first() or (0, False)
+
+    is_enrolled = enrolled or (user.is_authenticated and document['lecturer_id'] == user.id)
+    return personalize_course_detail(document['data'], is_enrolled, document['is_free'], student_count)
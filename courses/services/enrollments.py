@@ -0,0 +1,17 @@
+"""
+Enrollment creation that tolerates a repeated request (double click, retry): the insert runs in a
+savepoint and a conflict on (user, course) returns the existing row instead of an IntegrityError,
+without the exists() round trip in front of every insert.
+"""
+from django.db import IntegrityError, transaction
+
+from courses.models import UserCourse
+
+
+def enroll(user, course, status):
+    """Returns (enrollment, created); a normal save(), so the post_save bookkeeping runs as usual"""
+    try:
+        with transaction.atomic():
+            return UserCourse.objects.create(user=user, course=course, status=status), True
+    except IntegrityError:
+        return UserCourse.objects.select_related('course').get(user=user, course=course), False
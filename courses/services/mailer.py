@@ -0,0 +1,129 @@
+"""
+Email outbox: views enqueue, `manage.py send_outbox_emails` delivers.
+
+A worker leases a batch of due emails in a short transaction and sends them over one SMTP
+connection with no transaction open. A failed email is retried with exponential backoff until
+EMAIL_OUTBOX_MAX_ATTEMPTS, and a recipient who already received EMAIL_OUTBOX_RECIPIENT_LIMIT
+emails within EMAIL_OUTBOX_RECIPIENT_WINDOW seconds is deferred. Expiring emails (OTP) skip that
+limit and are dropped once expired instead of being sent late.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from courses.models import EmailOutbox, EmailStatus
+
+
+def enqueue_email(to_email, subject, body, from_email=None, expires_in=None):
+    """`expires_in` (seconds) for mail that is useless once late, e.g. an OTP with the same lifetime"""
+    expires_at = timezone.now() + timedelta(seconds=expires_in) if expires_in else None
+    return EmailOutbox.objects.create(to_email=to_email, subject=subject, body=body,
+                                      from_email=from_email or settings.DEFAULT_FROM_EMAIL, expires_at=expires_at)
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(settings.EMAIL_OUTBOX_BACKOFF * 2 ** (attempts - 1), settings.EMAIL_OUTBOX_MAX_BACKOFF))
+
+
+def recent_deliveries(recipients, now):
+    since = now - timedelta(seconds=settings.EMAIL_OUTBOX_RECIPIENT_WINDOW)
+    return dict(
+        EmailOutbox.objects.filter(to_email__in=recipients, status=EmailStatus.SENT, sent_at__gte=since,
+                                   expires_at__isnull=True)
+        .values_list('to_email').annotate(c=Count('pk')).values_list('to_email', 'c')
+    )
+
+
+def record_failure(email, error, now):
+    """Record a failed attempt (counted when the email was claimed); returns True when the email is given up"""
+    email.last_error = str(error)
+    if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS or (email.expires_at and email.expires_at <= now):
+        email.status = EmailStatus.FAILED
+        return True
+    email.next_attempt_at = now + retry_delay(email.attempts)
+    return False
+
+
+def claim_batch(batch_size, now):
+    """
+    Sort due emails in a short transaction; returns (to_send, deferred, expired).
+    Emails to send are leased: attempts counts this run and next_attempt_at moves past
+    EMAIL_OUTBOX_LEASE, so other workers skip them and a crashed worker's emails come back later.
+    """
+    with transaction.atomic():
+        # Several workers can run side by side: each takes rows nobody else holds
+        emails = list(
+            EmailOutbox.objects.select_for_update(skip_locked=True)
+            .filter(status=EmailStatus.PENDING, next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'pk')[:batch_size]
+        )
+        to_send, deferred, expired = [], [], []
+        delivered = recent_deliveries({email.to_email for email in emails if not email.expires_at}, now)
+        for email in emails:
+            if email.expires_at:
+                if email.expires_at <= now:
+                    email.status = EmailStatus.EXPIRED
+                    expired.append(email)
+                    continue
+            elif delivered.get(email.to_email, 0) >= settings.EMAIL_OUTBOX_RECIPIENT_LIMIT:
+                email.next_attempt_at = now + timedelta(seconds=settings.EMAIL_OUTBOX_RECIPIENT_WINDOW)
+                deferred.append(email)
+                continue
+            else:
+                delivered[email.to_email] = delivered.get(email.to_email, 0) + 1
+            email.attempts += 1
+            email.next_attempt_at = now + timedelta(seconds=settings.EMAIL_OUTBOX_LEASE)
+            to_send.append(email)
+        EmailOutbox.objects.bulk_update(emails, ['status', 'attempts', 'next_attempt_at'])
+    return to_send, deferred, expired
+
+
+def deliver_pending(batch_size=100):
+    """
+    Send one batch of due emails; returns (sent, retried, failed, deferred).
+    Expired emails count as failed.
+    """
+    now = timezone.now()
+    emails, deferred, expired = claim_batch(batch_size, now)
+    sent = retried = 0
+    failed = len(expired)
+    if not emails:
+        return sent, retried, failed, len(deferred)
+
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        # SMTP unreachable: one attempt for the whole batch, retried with backoff
+        for email in emails:
+            if record_failure(email, e, now):
+                failed += 1
+            else:
+                retried += 1
+    else:
+        try:
+            for email in emails:
+                try:
+                    EmailMessage(email.subject, email.body, email.from_email, [email.to_email],
+                                 connection=connection).send()
+                except Exception as e:
+                    if record_failure(email, e, now):
+                        failed += 1
+                    else:
+                        retried += 1
+                    continue
+
+                email.status = EmailStatus.SENT
+                email.sent_at = timezone.now()
+                email.last_error = ''
+                sent += 1
+        finally:
+            connection.close()
+
+    # The rows are leased to this worker, so no lock is needed to record the outcome
+    EmailOutbox.objects.bulk_update(emails, ['status', 'next_attempt_at', 'sent_at', 'last_error'])
+    return sent, retried, failed, len(deferred)
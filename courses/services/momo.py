@@ -1,16 +1,25 @@
+import asyncio
 import json
+import threading
+import time
 import uuid
 
 import requests
 import hmac
 import hashlib
+from requests.adapters import HTTPAdapter
 
-from courses.models import UserCourse, CourseStatus, Course, Payment
+from courses.models import UserCourse, CourseStatus, Payment, PaymentStatus, PaymentNotification
+from courses.services import outbox
+from courses.signals import apply_student_delta
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
 
 # parameters send to MoMo get get payUrl
-endpoint = "https://test-payment.momo.vn/v2/gateway/api/create"
 partnerCode = "MOMO"
 accessKey = "F8BBA842ECF85"
 secretKey = "K951B6PE1waDMi640xX08PD3vg6EkVlz"
@@ -21,65 +30,351 @@ ipnUrl = f"{settings.MOMO_IPN_URL}/payment/momo/ipn/"
 requestType = "captureWallet"
 
 
+class GatewayUnavailable(Exception):
+    """MoMo could not be reached (after retries) or the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failed calls; while open, calls fail
+    immediately. After `reset_timeout` seconds one trial call is let through (half-open):
+    success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_running or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.trial_running = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class MomoGateway:
+    """
+    MoMo API client: one keep-alive connection pool per process, connect/read timeouts,
+    retries on connection errors, timeouts and 5xx answers. Retries resend the same body,
+    so orderId/requestId stay the same and MoMo can de-duplicate the order.
+    """
+
+    def __init__(self, base_url, connect_timeout=3.05, read_timeout=10, max_retries=2, backoff=0.3,
+                 pool_maxsize=10, breaker=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.session = requests.Session()
+        # Retries are handled in post() so they are counted by the breaker
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def post(self, path, payload):
+        if not self.breaker.allow():
+            raise GatewayUnavailable('MoMo circuit breaker is open')
+
+        body = json.dumps(payload)
+        error = None
+        try:
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                try:
+                    response = self.session.post(f'{self.base_url}{path}', data=body, timeout=self.timeout,
+                                                 headers={'Content-Type': 'application/json'})
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+                    continue
+                if response.status_code >= 500:
+                    error = GatewayUnavailable(f'MoMo answered {response.status_code}')
+                    continue
+                try:
+                    result = response.json()
+                except ValueError as e:
+                    # e.g. a proxy's HTML error page; not worth retrying
+                    raise GatewayUnavailable(f'MoMo answered {response.status_code} without JSON') from e
+                self.breaker.record_success()
+                return result
+        except Exception as e:
+            # Every way out that is not a success counts, or a half-open breaker would stay stuck
+            self.breaker.record_failure()
+            if isinstance(e, requests.RequestException):
+                raise GatewayUnavailable(str(e)) from e
+            raise
+
+        self.breaker.record_failure()
+        raise GatewayUnavailable(str(error)) from error
+
+    def create_payment(self, order_id, request_id, amount, extra_data):
+        amount = str(int(amount))
+        extra_data = str(extra_data) if extra_data else ""
+
+        #tạo chuỗi đúng thứ tự
+        rawSignature = (
+                "accessKey=" + accessKey +
+                "&amount=" + amount +
+                "&extraData=" + extra_data +
+                "&ipnUrl=" + ipnUrl +
+                "&orderId=" + order_id +
+                "&orderInfo=" + orderInfo +
+                "&partnerCode=" + partnerCode +
+                "&redirectUrl=" + redirectUrl +
+                "&requestId=" + request_id +
+                "&requestType=" + requestType
+        )
+
+        #tạo chữ ký số
+        h = hmac.new(bytes(secretKey, 'ascii'),
+                     bytes(rawSignature, 'ascii'),
+                     hashlib.sha256)
+        signature = h.hexdigest()
+
+        return self.post('/create', {
+            'partnerCode': partnerCode,
+            'partnerName': "Test",
+            'storeId': "MomoTestStore",
+            'requestId': request_id,
+            'amount': amount,
+            'orderId': order_id,
+            'orderInfo': orderInfo,
+            'redirectUrl': redirectUrl,
+            'ipnUrl': ipnUrl,
+            'lang': "vi",
+            'extraData': extra_data,
+            'requestType': requestType,
+            'signature': signature
+        })
+
+    def query_payment(self, order_id, request_id):
+        """Status of an order from MoMo's query API; the answer carries resultCode/transId like an IPN"""
+        rawSignature = (
+                "accessKey=" + accessKey +
+                "&orderId=" + order_id +
+                "&partnerCode=" + partnerCode +
+                "&requestId=" + request_id
+        )
+        signature = hmac.new(bytes(secretKey, 'ascii'), bytes(rawSignature, 'ascii'), hashlib.sha256).hexdigest()
+
+        return self.post('/query', {
+            'partnerCode': partnerCode,
+            'requestId': request_id,
+            'orderId': order_id,
+            'lang': "vi",
+            'signature': signature
+        })
+
+    async def acreate_payment(self, order_id, request_id, amount, extra_data):
+        """Async variant for ASGI views; the pooled blocking call runs in a worker thread"""
+        return await asyncio.to_thread(self.create_payment, order_id, request_id, amount, extra_data)
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = MomoGateway(
+                    settings.MOMO_API_URL,
+                    connect_timeout=settings.MOMO_CONNECT_TIMEOUT,
+                    read_timeout=settings.MOMO_READ_TIMEOUT,
+                    max_retries=settings.MOMO_MAX_RETRIES,
+                    breaker=CircuitBreaker(settings.MOMO_BREAKER_THRESHOLD, settings.MOMO_BREAKER_RESET),
+                )
+    return _gateway
+
+
+def pay_url_key(user_course_id):
+    return f'momo:pay_url:{user_course_id}'
+
+
+def get_cached_pay_url(user_course_id):
+    return cache.get(pay_url_key(user_course_id))
+
+
 def create_momo_payment(user, amount, extraData, course_id):
     orderId = str(uuid.uuid4())
     requestId = str(uuid.uuid4())
-    amount = str(int(amount))
-    extraData = str(extraData) if extraData else ""
-
-    #tạo chuỗi đúng thứ tự
-    rawSignature = (
-            "accessKey=" + accessKey +
-            "&amount=" + amount +
-            "&extraData=" + extraData +
-            "&ipnUrl=" + ipnUrl +
-            "&orderId=" + orderId +
-            "&orderInfo=" + orderInfo +
-            "&partnerCode=" + partnerCode +
-            "&redirectUrl=" + redirectUrl +
-            "&requestId=" + requestId +
-            "&requestType=" + requestType
-    )
 
-    #tạo chữ ký số
-    h = hmac.new(bytes(secretKey, 'ascii'),
-                 bytes(rawSignature, 'ascii'),
-                 hashlib.sha256)
-    signature = h.hexdigest()
-
-    data = {
-        'partnerCode': partnerCode,
-        'partnerName': "Test",
-        'storeId': "MomoTestStore",
-        'requestId': requestId,
-        'amount': amount,
-        'orderId': orderId,
-        'orderInfo': orderInfo,
-        'redirectUrl': redirectUrl,
-        'ipnUrl': ipnUrl,
-        'lang': "vi",
-        'extraData': extraData,
-        'requestType': requestType,
-        'signature': signature
-    }
-    data = json.dumps(data)
-    response = requests.post(endpoint, data=data,
-                             headers={'Content-Type': 'application/json',
-                                      'Content-Length': str(len(data))})
-    resp = response.json()
+    resp = get_gateway().create_payment(orderId, requestId, amount, extraData)
     pay_url = resp.get('payUrl')
-    payment = Payment.objects.create(
+    Payment.objects.create(
         id=orderId,
         user=user,
         course_id=course_id,
-        amount=amount,
+        amount=str(int(amount)),
+        pay_url=pay_url or '',
     )
     if pay_url:
-        payment.save()
+        # A repeated enrollment request reuses the link instead of opening another order
+        cache.set(pay_url_key(extraData), pay_url, timeout=settings.MOMO_PAY_URL_TIMEOUT)
+    else:
+        result_code = int(resp.get('resultCode', -1))
+        # MoMo refused the order: nothing can be paid, so do not leave it (and the enrollment) PENDING.
+        # A pending or unclear answer stays PENDING for the reconciler; 0 without a payUrl is unclear too.
+        if result_code != 0 and is_final_result(result_code):
+            settle_payments({orderId: (result_code, None)}, 'create')
     return pay_url
 
 
-def update_status_user_course(id, status):
-    user_course = UserCourse.objects.get(id=id)
-    user_course.status = status
-    user_course.save()
+# Fields of a MoMo result (IPN body or redirect query string) covered by its signature, in order
+RESULT_SIGNATURE_FIELDS = ('amount', 'extraData', 'message', 'orderId', 'orderInfo', 'orderType', 'partnerCode',
+                           'payType', 'requestId', 'responseTime', 'resultCode', 'transId')
+
+# resultCode values of an order that is still in progress (initiated, processing, authorized)
+PENDING_RESULT_CODES = {1000, 7000, 7002, 9000}
+ORDER_NOT_FOUND = 42
+
+# Outcomes of apply_payment_result()
+APPLIED = 'applied'
+DUPLICATE = 'duplicate'
+ALREADY_FINAL = 'already_final'
+NOT_FOUND = 'not_found'
+
+
+def verify_result_signature(data):
+    raw_signature = f"accessKey={accessKey}" + "".join(
+        f"&{field}={data.get(field)}" for field in RESULT_SIGNATURE_FIELDS)
+    signature = hmac.new(bytes(secretKey, 'utf-8'), bytes(raw_signature, 'utf-8'), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature, str(data.get('signature', '')))
+
+
+def ledger_key(trans_id, order_id, result_code):
+    # Some failed payments come without a MoMo transaction id
+    trans_id = str(trans_id or '')
+    return trans_id if trans_id not in ('', '0') else f'{order_id}:{result_code}'
+
+
+def apply_payment_result(order_id, user_course_id, trans_id, result_code, source):
+    """
+    Record a MoMo result once, move the Payment out of PENDING and settle its enrollment.
+    A repeated notification costs one indexed lookup; concurrent copies are stopped by the
+    ledger's unique key, and the Payment update only matches a row that is still PENDING.
+    """
+    key = ledger_key(trans_id, order_id, result_code)
+    if PaymentNotification.objects.filter(trans_id=key).exists():
+        return DUPLICATE
+
+    paid = result_code == 0
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            PaymentNotification.objects.create(trans_id=key, order_id=order_id, result_code=result_code,
+                                               source=source)
+            updated = Payment.objects.filter(pk=order_id, status=PaymentStatus.PENDING).update(
+                status=PaymentStatus.SUCCESS if paid else PaymentStatus.FAILED, updated_at=now)
+            if not updated:
+                return ALREADY_FINAL if Payment.objects.filter(pk=order_id).exists() else NOT_FOUND
+
+            settle_enrollment(Q(pk=user_course_id), paid, order_id, now)
+    except IntegrityError:
+        # The same notification is being processed concurrently
+        return DUPLICATE
+
+    return APPLIED
+
+
+def settle_enrollment(enrollment_filter, paid, order_id, now):
+    """
+    Apply a settled order to its enrollment. One enrollment can have several orders (a new
+    order once the old payUrl expired), so a paid order activates it from PENDING or
+    PAYMENT_FAILED, while a failed one only gives up on it when no other order of the
+    same user and course is still PENDING or paid. Call inside the transaction that settled the Payment.
+    """
+    enrollment = (UserCourse.objects.select_for_update().filter(enrollment_filter)
+                  .only('id', 'user_id', 'course_id', 'status').first())
+    if enrollment is None:
+        return
+
+    if paid:
+        if enrollment.status not in (CourseStatus.PENDING, CourseStatus.PAYMENT_FAILED):
+            return
+        UserCourse.objects.filter(pk=enrollment.pk).update(status=CourseStatus.IN_PROGRESS, updated_at=now)
+        # update() skips the signals: PAYMENT_FAILED enrollments are not counted in student_count
+        if enrollment.status == CourseStatus.PAYMENT_FAILED:
+            apply_student_delta(enrollment.course_id, 1)
+        # Progress rows, cache warm-up and the receipt run in `manage.py process_outbox_events`
+        outbox.publish(outbox.ENROLLMENT_ACTIVATED, {
+            'order_id': order_id, 'user_course_id': enrollment.pk,
+            'user_id': enrollment.user_id, 'course_id': enrollment.course_id,
+        })
+    else:
+        if enrollment.status != CourseStatus.PENDING or Payment.objects.filter(
+                user_id=enrollment.user_id, course_id=enrollment.course_id,
+                status__in=[PaymentStatus.PENDING, PaymentStatus.SUCCESS]).exists():
+            return
+        UserCourse.objects.filter(pk=enrollment.pk).update(status=CourseStatus.PAYMENT_FAILED, updated_at=now)
+        apply_student_delta(enrollment.course_id, -1)
+
+
+def is_final_result(result_code):
+    """
+    Whether a query/create answer settles the order. Codes from 1000 up describe the transaction;
+    lower ones describe the request itself (bad signature, maintenance, ...) and settle nothing,
+    except "order not found" for an order MoMo never received.
+    """
+    if result_code == 0 or result_code == ORDER_NOT_FOUND:
+        return True
+    return result_code >= 1000 and result_code not in PENDING_RESULT_CODES
+
+
+def settle_payments(results, source):
+    """
+    Bulk counterpart of apply_payment_result() for results that did not come from a notification:
+    `results` maps order id -> (result_code, trans_id). Payments locked by a concurrent IPN are
+    skipped; the next run sees them settled. Returns (paid, failed).
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        payments = list(
+            Payment.objects.select_for_update(skip_locked=True)
+            .filter(pk__in=list(results), status=PaymentStatus.PENDING)
+            .only('id', 'user_id', 'course_id', 'status', 'updated_at')
+        )
+        if not payments:
+            return 0, 0
+
+        PaymentNotification.objects.bulk_create([
+            PaymentNotification(trans_id=ledger_key(results[payment.pk][1], payment.pk, results[payment.pk][0]),
+                                order_id=payment.pk, result_code=results[payment.pk][0], source=source)
+            for payment in payments
+        ], ignore_conflicts=True)
+
+        for payment in payments:
+            payment.status = PaymentStatus.SUCCESS if results[payment.pk][0] == 0 else PaymentStatus.FAILED
+            payment.updated_at = now
+        Payment.objects.bulk_update(payments, ['status', 'updated_at'])
+
+        # Enrollments follow once every Payment of the batch is settled, so a failed order sees a paid sibling
+        for payment in payments:
+            settle_enrollment(Q(user_id=payment.user_id, course_id=payment.course_id),
+                              payment.status == PaymentStatus.SUCCESS, payment.pk, now)
+
+    paid = sum(payment.status == PaymentStatus.SUCCESS for payment in payments)
+    return paid, len(payments) - paid
@@ -0,0 +1,102 @@
+"""
+Transactional outbox: publish() inside the transaction that makes the change, and
+`manage.py process_outbox_events` runs the handlers in batches afterwards.
+
+Handlers receive every pending event of their type in the batch and must be idempotent:
+a failed batch is retried as a whole.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from courses.models import Course, CourseProgress, EmailOutbox, OutboxEvent, Payment, User
+from courses.services import course_detail
+
+ENROLLMENT_ACTIVATED = 'enrollment.activated'
+
+
+def publish(event_type, payload):
+    return OutboxEvent.objects.create(event_type=event_type, payload=payload)
+
+
+def publish_many(event_type, payloads):
+    return OutboxEvent.objects.bulk_create([OutboxEvent(event_type=event_type, payload=payload)
+                                            for payload in payloads])
+
+
+def handle_enrollment_activated(events):
+    payloads = [event.payload for event in events]
+    courses = Course.objects.only('id', 'name', 'lessons_count').in_bulk({p['course_id'] for p in payloads})
+    users = User.objects.only('id', 'email', 'username').in_bulk({p['user_id'] for p in payloads})
+    payments = Payment.objects.only('id', 'amount').in_bulk({p['order_id'] for p in payloads})
+
+    # Progress rows the enrolled-courses list would otherwise create lazily
+    CourseProgress.objects.bulk_create([
+        CourseProgress(user_id=p['user_id'], course_id=p['course_id'], total_lessons=courses[p['course_id']].lessons_count)
+        for p in payloads if p['course_id'] in courses
+    ], ignore_conflicts=True)
+
+    EmailOutbox.objects.bulk_create([
+        EmailOutbox(
+            to_email=users[p['user_id']].email,
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            subject=f"Payment receipt - {courses[p['course_id']].name}",
+            body=(f"Thank you {users[p['user_id']].username}! We received your payment of {payments[p['order_id']].amount:,.0f} VND "
+                  f"for \"{courses[p['course_id']].name}\" (order {p['order_id']}). You can start learning now."),
+        )
+        for p in payloads
+        if p['course_id'] in courses and p['user_id'] in users and p['order_id'] in payments
+        and users[p['user_id']].email
+    ])
+
+    # The new students open the course right away
+    for course_id in courses:
+        try:
+            course_detail.get_document(course_id)
+        except Course.DoesNotExist:
+            pass
+
+
+HANDLERS = {
+    ENROLLMENT_ACTIVATED: handle_enrollment_activated,
+}
+
+
+def process_pending(batch_size=200):
+    """Handle one batch of pending events; returns (processed, failed)"""
+    processed = failed = 0
+    now = timezone.now()
+
+    with transaction.atomic():
+        events = list(
+            OutboxEvent.objects.select_for_update(skip_locked=True)
+            .filter(processed_at__isnull=True).order_by('pk')[:batch_size]
+        )
+        by_type = defaultdict(list)
+        for event in events:
+            by_type[event.event_type].append(event)
+
+        for event_type, group in by_type.items():
+            try:
+                with transaction.atomic():
+                    HANDLERS[event_type](group)
+            except Exception as e:
+                for event in group:
+                    event.attempts += 1
+                    event.last_error = str(e)
+                    # Give up after OUTBOX_MAX_ATTEMPTS; the row keeps the error for inspection
+                    if event.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                        event.processed_at = now
+                failed += len(group)
+                continue
+
+            for event in group:
+                event.processed_at = now
+                event.last_error = ''
+            processed += len(group)
+
+        OutboxEvent.objects.bulk_update(events, ['attempts', 'processed_at', 'last_error'])
+
+    return processed, failed
@@ -0,0 +1,97 @@
+"""
+Role -> method -> path authorization compiled from the Permission table.
+
+Each worker keeps the compiled matrix in memory and reloads it when the version key in
+the shared cache changes (bumped by courses.signals on Permission/Role writes). The key
+is read at most once every PERMISSION_MATRIX_CHECK_INTERVAL seconds, so a check is
+normally a dict lookup plus one regex match.
+"""
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from courses.models import Permission
+
+VERSION_KEY = 'permission_matrix:version'
+ANY_METHOD = ('*', 'ALL')
+PLACEHOLDER = re.compile(r'\{[^/{}]+\}|<[^/<>]+>')
+
+
+def compile_path(path):
+    """'/courses/{id}/detail/' or '/courses/<int:pk>/' -> regex; '*' matches the rest of the path"""
+    path = '/' + path.strip().strip('/')
+    pattern = ''
+    position = 0
+    for match in PLACEHOLDER.finditer(path):
+        pattern += re.escape(path[position:match.start()]) + '[^/]+'
+        position = match.end()
+    pattern += re.escape(path[position:])
+    pattern = pattern.replace(re.escape('*'), '.*')
+    return pattern.rstrip('/') + '/?'
+
+
+class PermissionMatrix:
+    def __init__(self, rows):
+        patterns = {}
+        for role_name, method, path in rows:
+            method = method.strip().upper()
+            methods = patterns.setdefault(role_name.lower(), {})
+            methods.setdefault('*' if method in ANY_METHOD else method, []).append(compile_path(path))
+
+        self.routes = {
+            role_name: {
+                method: re.compile('|'.join(f'(?:{p})' for p in method_patterns))
+                for method, method_patterns in methods.items()
+            }
+            for role_name, methods in patterns.items()
+        }
+
+    def is_allowed(self, role_name, method, path):
+        methods = self.routes.get(role_name)
+        if not methods:
+            return False
+        method = 'GET' if method == 'HEAD' else method
+        return any(
+            matcher.fullmatch(path)
+            for matcher in (methods.get(method), methods.get('*'))
+            if matcher is not None
+        )
+
+    @classmethod
+    def load(cls):
+        return cls(Permission.objects.filter(active=True, role__active=True)
+                   .values_list('role__name', 'method', 'path'))
+
+
+_lock = threading.Lock()
+_state = {'matrix': None, 'version': None, 'checked_at': 0.0}
+
+
+def get_matrix():
+    now = time.monotonic()
+    if _state['matrix'] is not None and now - _state['checked_at'] < settings.PERMISSION_MATRIX_CHECK_INTERVAL:
+        return _state['matrix']
+
+    with _lock:
+        version = cache.get(VERSION_KEY, 0)
+        if _state['matrix'] is None or version != _state['version']:
+            _state['matrix'] = PermissionMatrix.load()
+            _state['version'] = version
+        _state['checked_at'] = now
+        return _state['matrix']
+
+
+def invalidate():
+    """Make every worker reload the matrix on its next check"""
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, timeout=None)
+    _state['checked_at'] = 0.0
+
+
+def is_allowed(role_name, method, path):
+    return get_matrix().is_allowed(role_name, method, path)
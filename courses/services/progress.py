@@ -0,0 +1,106 @@
+from django.utils import timezone
+
+from courses.models import CourseProgress, LessonProgress, LessonProgressStatus
+
+LESSON_PROGRESS_UPSERT_FIELDS = ['status', 'watch_time', 'completion_percentage', 'started_at', 'completed_at',
+                                 'last_watched_at', 'updated_at']
+
+
+def progress_status_for(completion_percentage):
+    """Determine progress status based on completion percentage"""
+    if completion_percentage >= 90:
+        return LessonProgressStatus.COMPLETED
+    elif completion_percentage > 0:
+        return LessonProgressStatus.IN_PROGRESS
+    return LessonProgressStatus.NOT_STARTED
+
+
+def coalesce_events(events):
+    """
+    Merge heartbeats per lesson: the latest event (by client_ts, then arrival order) wins,
+    completion_percentage keeps the maximum seen.
+    """
+    merged = {}
+    for order, event in enumerate(events):
+        lesson_id = event['lesson_id']
+        key = (event.get('client_ts') or timezone.now(), order)
+        current = merged.get(lesson_id)
+        if current is None or key >= current['_key']:
+            completion = max(event['completion_percentage'], current['completion_percentage'] if current else 0)
+            merged[lesson_id] = {**event, 'completion_percentage': completion, '_key': key}
+        else:
+            current['completion_percentage'] = max(current['completion_percentage'], event['completion_percentage'])
+
+    for event in merged.values():
+        event.pop('_key')
+    return merged
+
+
+def upsert_lesson_progress(events):
+    """
+    Upsert LessonProgress rows in a single statement.
+    events maps (user_id, lesson_id) to {'watch_time', 'completion_percentage'}; watch_time and
+    completion_percentage never go below the stored values and a COMPLETED lesson stays COMPLETED.
+    """
+    if not events:
+        return
+
+    now = timezone.now()
+    existing = {
+        (user_id, lesson_id): (stored_status, stored_watch_time, stored_completion, started_at, completed_at)
+        for user_id, lesson_id, stored_status, stored_watch_time, stored_completion, started_at, completed_at
+        in LessonProgress.objects.filter(
+            user_id__in={user_id for user_id, _ in events},
+            lesson_id__in={lesson_id for _, lesson_id in events},
+        ).values_list('user_id', 'lesson_id', 'status', 'watch_time', 'completion_percentage', 'started_at',
+                      'completed_at')
+    }
+
+    rows = []
+    for (user_id, lesson_id), event in events.items():
+        stored_status, stored_watch_time, stored_completion, started_at, completed_at = existing.get(
+            (user_id, lesson_id), (None, 0, 0, None, None))
+        # A late heartbeat (buffered before a synchronous completion, left by a crashed flush, or carried
+        # by a later flush than a newer one) must not lower the progress or take a lesson out of COMPLETED
+        watch_time = max(event['watch_time'], stored_watch_time)
+        completion_percentage = max(event['completion_percentage'], stored_completion)
+        progress_status = progress_status_for(completion_percentage)
+        if stored_status == LessonProgressStatus.COMPLETED:
+            progress_status = LessonProgressStatus.COMPLETED
+        if progress_status == LessonProgressStatus.IN_PROGRESS and not started_at:
+            started_at = now
+        if progress_status == LessonProgressStatus.COMPLETED and not completed_at:
+            completed_at = now
+
+        rows.append(LessonProgress(
+            user_id=user_id,
+            lesson_id=lesson_id,
+            status=progress_status,
+            watch_time=watch_time,
+            completion_percentage=completion_percentage,
+            started_at=started_at,
+            completed_at=completed_at,
+            last_watched_at=now,
+        ))
+
+    LessonProgress.objects.bulk_create(rows, update_conflicts=True, unique_fields=['lesson', 'user'],
+                                       update_fields=LESSON_PROGRESS_UPSERT_FIELDS)
+
+
+def recompute_course_progress(user_courses):
+    """Recompute CourseProgress once per (user_id, course_id) pair"""
+    course_progresses = []
+    for user_id, course_id in set(user_courses):
+        course_progress, created = CourseProgress.objects.get_or_create(user_id=user_id, course_id=course_id)
+        course_progress.update_progress()
+        course_progresses.append(course_progress)
+    return course_progresses
+
+
+def apply_lesson_progress(user_id, events_by_lesson, course_by_lesson):
+    """
+    Write the coalesced heartbeats of one user (from coalesce_events()) and recompute
+    each affected CourseProgress once.
+    """
+    upsert_lesson_progress({(user_id, lesson_id): event for lesson_id, event in events_by_lesson.items()})
+    return recompute_course_progress((user_id, course_by_lesson[lesson_id]) for lesson_id in events_by_lesson)
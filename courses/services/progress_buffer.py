@@ -0,0 +1,118 @@
+"""
+Write-behind buffer for lesson-progress heartbeats (settings.PROGRESS_WRITE_BEHIND).
+
+Heartbeats are coalesced per (user, lesson): the latest client timestamp wins and
+completion_percentage keeps the maximum. The flush_progress_buffer command drains
+the buffer into LessonProgress / CourseProgress in batches. Run a single flusher.
+The buffer lives in Redis so web workers and the flusher share it; write-behind
+needs a django-redis default cache (REDIS_URL).
+"""
+import json
+import threading
+
+
+PENDING_KEY = 'progress:pending'
+FLUSHING_KEY = 'progress:flushing'
+
+# Same rules as merge_entry(), applied atomically inside Redis
+MERGE_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+local entry = cjson.decode(ARGV[2])
+if current then
+    local old = cjson.decode(current)
+    local completion = math.max(old.completion_percentage, entry.completion_percentage)
+    if old.client_ts > entry.client_ts then
+        entry = old
+    end
+    entry.completion_percentage = completion
+end
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(entry))
+return 1
+"""
+
+
+def entry_field(user_id, lesson_id):
+    return f'{user_id}:{lesson_id}'
+
+
+def merge_entry(old, new):
+    entry = old if old and old['client_ts'] > new['client_ts'] else new
+    if old:
+        entry = {**entry, 'completion_percentage': max(old['completion_percentage'], new['completion_percentage'])}
+    return entry
+
+
+class RedisProgressBuffer:
+    """Shared across workers; entries live in one Redis hash until flushed"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.merge = connection.register_script(MERGE_SCRIPT)
+
+    def add(self, entry):
+        self.merge(keys=[PENDING_KEY], args=[entry_field(entry['user_id'], entry['lesson_id']), json.dumps(entry)])
+
+    def discard(self, user_id, lesson_id):
+        self.connection.hdel(PENDING_KEY, entry_field(user_id, lesson_id))
+
+    def claim(self):
+        """Move pending entries aside and return them; a batch left by a crashed flush is returned first"""
+        if not self.connection.exists(FLUSHING_KEY):
+            if not self.connection.exists(PENDING_KEY):
+                return []
+            self.connection.renamenx(PENDING_KEY, FLUSHING_KEY)
+        return [json.loads(value) for value in self.connection.hvals(FLUSHING_KEY)]
+
+    def ack(self):
+        self.connection.delete(FLUSHING_KEY)
+
+
+class LocalProgressBuffer:
+    """In-process stand-in for tests; never shared with the flush_progress_buffer process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.flushing = {}
+
+    def add(self, entry):
+        field = entry_field(entry['user_id'], entry['lesson_id'])
+        with self.lock:
+            self.pending[field] = merge_entry(self.pending.get(field), entry)
+
+    def discard(self, user_id, lesson_id):
+        with self.lock:
+            self.pending.pop(entry_field(user_id, lesson_id), None)
+
+    def claim(self):
+        with self.lock:
+            if not self.flushing:
+                self.flushing, self.pending = self.pending, {}
+            return list(self.flushing.values())
+
+    def ack(self):
+        with self.lock:
+            self.flushing = {}
+
+
+_buffer = None
+
+
+def get_progress_buffer():
+    global _buffer
+    if _buffer is None:
+        # The Redis cache is required by the courses.E001 system check
+        from django_redis import get_redis_connection
+        _buffer = RedisProgressBuffer(get_redis_connection('default'))
+    return _buffer
+
+
+def buffer_heartbeat(user_id, lesson_id, course_id, watch_time, completion_percentage, client_ts):
+    get_progress_buffer().add({
+        'user_id': user_id,
+        'lesson_id': lesson_id,
+        'course_id': course_id,
+        'watch_time': watch_time,
+        'completion_percentage': completion_percentage,
+        'client_ts': client_ts.timestamp(),
+    })
@@ -0,0 +1,57 @@
+"""
+Settles MoMo payments left PENDING because their IPN never arrived: `manage.py reconcile_payments`
+walks old PENDING payments in keyset order, asks MoMo for each order's status and applies the
+final ones in bulk (see momo.settle_payments). A repeated enrollment request uses the same
+path for the orders of one student (open_order).
+"""
+import uuid
+
+from django.db.models import Q
+
+from courses.models import Payment, PaymentStatus
+from courses.services.momo import GatewayUnavailable, get_gateway, is_final_result, settle_payments
+
+
+def stale_payments(cutoff, after=None, batch_size=100):
+    """(created_at, id) of PENDING payments created before `cutoff`, following the `after` key"""
+    payments = Payment.objects.filter(status=PaymentStatus.PENDING, created_at__lt=cutoff)
+    if after is not None:
+        created_at, pk = after
+        payments = payments.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, pk__gt=pk))
+    return list(payments.order_by('created_at', 'pk').values_list('created_at', 'pk')[:batch_size])
+
+
+def reconcile_batch(order_ids, gateway=None):
+    """Query and settle the given orders; returns (paid, failed, pending, errors)"""
+    gateway = gateway or get_gateway()
+    results = {}
+    pending = errors = 0
+    for order_id in order_ids:
+        try:
+            response = gateway.query_payment(order_id, str(uuid.uuid4()))
+            result_code = int(response.get('resultCode', -1))
+        except (GatewayUnavailable, ValueError):
+            errors += 1
+            continue
+        if is_final_result(result_code):
+            results[order_id] = (result_code, response.get('transId'))
+        else:
+            pending += 1
+
+    paid, failed = settle_payments(results, 'reconcile') if results else (0, 0)
+    # Orders settled meanwhile by an IPN are neither paid nor failed here
+    return paid, failed, pending, errors
+
+
+def open_order(user_id, course_id, gateway=None):
+    """
+    The student's order for a course that MoMo still holds open, or None when a new one may be created.
+    Every PENDING order is queried first, so orders that ended (expired, paid meanwhile) are settled.
+    """
+    orders = Payment.objects.filter(user_id=user_id, course_id=course_id, status=PaymentStatus.PENDING)
+    order_ids = list(orders.values_list('pk', flat=True))
+    if not order_ids:
+        return None
+    reconcile_batch(order_ids, gateway)
+    # Also the orders MoMo did not answer for: they may still be paid
+    return orders.only('id', 'pay_url').order_by('-created_at').first()
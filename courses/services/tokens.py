@@ -0,0 +1,54 @@
+"""
+Issue OAuth2 tokens for logins that do not go through the /o/token/ endpoint (Google login).
+
+Older tokens of the user are left alone: they stay valid until they expire (so logging in on
+a second device does not sign out the first) and are removed by `manage.py purge_expired_tokens`,
+keeping the login path to two inserts.
+"""
+from datetime import timedelta
+
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+from oauth2_provider.models import AccessToken, Application, RefreshToken
+from oauth2_provider.settings import oauth2_settings
+from oauthlib.common import generate_token
+
+LOGIN_APPLICATION_KEY = 'oauth2:login_application'
+LOGIN_APPLICATION_TIMEOUT = 3600
+
+auth_cache = caches['auth']
+
+
+def get_login_application():
+    """The application Google logins issue tokens for (the first one, as before); None if not configured"""
+    application = auth_cache.get(LOGIN_APPLICATION_KEY)
+    if application is None:
+        application = Application.objects.order_by('pk').first()
+        if application is not None:
+            auth_cache.set(LOGIN_APPLICATION_KEY, application, timeout=LOGIN_APPLICATION_TIMEOUT)
+    return application
+
+
+def forget_login_application():
+    auth_cache.delete(LOGIN_APPLICATION_KEY)
+
+
+def issue_tokens(user, application, scope='read write'):
+    """Create an access token and its refresh token together; returns (access_token, refresh_token)"""
+    expires_in = oauth2_settings.ACCESS_TOKEN_EXPIRE_SECONDS
+    with transaction.atomic():
+        access_token = AccessToken.objects.create(
+            user=user,
+            application=application,
+            token=generate_token(),
+            expires=timezone.now() + timedelta(seconds=expires_in),
+            scope=scope
+        )
+        refresh_token = RefreshToken.objects.create(
+            user=user,
+            application=application,
+            token=generate_token(),
+            access_token=access_token
+        )
+    return access_token, refresh_token
@@ -0,0 +1,150 @@
+"""
+Background image uploads.
+
+Requests only copy the uploaded file into UPLOAD_STAGING_DIR and record a PendingUpload;
+`manage.py process_uploads` pushes staged files to the storage backend (UPLOAD_BACKEND)
+and saves the resulting URL on the target model field. The staging directory must be
+shared by the web and worker processes (same host or a mounted volume).
+"""
+import os
+import shutil
+import uuid
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from courses.models import PendingUpload, UploadStatus
+
+
+class CloudinaryBackend:
+    transformation = [
+        {'width': 500, 'height': 500, 'crop': 'limit'},
+        {'quality': 'auto'}
+    ]
+
+    def upload(self, path, folder):
+        import cloudinary.uploader
+        result = cloudinary.uploader.upload(path, folder=folder, resource_type="image",
+                                            transformation=self.transformation)
+        return result['secure_url']
+
+
+class LocalBackend:
+    """Stand-in for tests and offline development: copies into UPLOAD_LOCAL_DIR"""
+
+    def upload(self, path, folder):
+        target_dir = os.path.join(settings.UPLOAD_LOCAL_DIR, folder)
+        os.makedirs(target_dir, exist_ok=True)
+        target = os.path.join(target_dir, os.path.basename(path))
+        shutil.copyfile(path, target)
+        return f'{settings.UPLOAD_LOCAL_URL.rstrip("/")}/{folder}/{os.path.basename(path)}'
+
+
+def get_upload_backend():
+    return import_string(settings.UPLOAD_BACKEND)()
+
+
+def stage_file(uploaded_file):
+    """Copy an uploaded file into the staging directory; returns the staged path"""
+    os.makedirs(settings.UPLOAD_STAGING_DIR, exist_ok=True)
+    extension = os.path.splitext(getattr(uploaded_file, 'name', '') or '')[1].lower()
+    path = os.path.join(settings.UPLOAD_STAGING_DIR, f'{uuid.uuid4().hex}{extension}')
+    with open(path, 'wb') as staged:
+        for chunk in uploaded_file.chunks():
+            staged.write(chunk)
+    return path
+
+
+def discard_staged(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def enqueue_upload(instance, field_name, staged_path, folder):
+    """Queue a staged file for `instance.<field_name>`; an older pending upload of the same field is dropped"""
+    target = dict(model_label=instance._meta.label, object_id=str(instance.pk), field_name=field_name)
+    superseded = PendingUpload.objects.filter(status=UploadStatus.PENDING, **target)
+    for path in superseded.values_list('staged_path', flat=True):
+        discard_staged(path)
+    superseded.delete()
+    return PendingUpload.objects.create(staged_path=staged_path, folder=folder, **target)
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(settings.UPLOAD_BACKOFF * 2 ** (attempts - 1), settings.UPLOAD_MAX_BACKOFF))
+
+
+def apply_upload(upload, url):
+    model = apps.get_model(upload.model_label)
+    instance = model.objects.filter(pk=upload.object_id).first()
+    if instance is not None:
+        setattr(instance, upload.field_name, url)
+        # save() rather than update() so cache invalidation signals run
+        instance.save(update_fields=[upload.field_name])
+
+
+def claim_batch(batch_size, now):
+    """
+    Lease due uploads in a short transaction: attempts counts this run and next_attempt_at moves past
+    the lease, so other workers skip them and a crashed worker's uploads come back later
+    """
+    with transaction.atomic():
+        uploads = list(
+            PendingUpload.objects.select_for_update(skip_locked=True)
+            .filter(status=UploadStatus.PENDING, next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'pk')[:batch_size]
+        )
+        for upload in uploads:
+            upload.attempts += 1
+            upload.next_attempt_at = now + timedelta(seconds=settings.UPLOAD_LEASE)
+        PendingUpload.objects.bulk_update(uploads, ['attempts', 'next_attempt_at'])
+    return uploads
+
+
+def finish_upload(upload, url):
+    """Save the URL on the target and mark the upload done; False when a newer upload replaced it meanwhile"""
+    with transaction.atomic():
+        if not PendingUpload.objects.select_for_update().filter(pk=upload.pk, status=UploadStatus.PENDING).exists():
+            return False
+        apply_upload(upload, url)
+        PendingUpload.objects.filter(pk=upload.pk).update(status=UploadStatus.DONE, result_url=url, last_error='')
+    return True
+
+
+def process_pending(batch_size=20):
+    """
+    Upload one batch of due files; returns (done, retried, failed).
+    No transaction is open during the network calls: each result is applied in its own short one,
+    so a slow upload never holds a lock on the user or course row.
+    """
+    done = retried = failed = 0
+    backend = get_upload_backend()
+
+    for upload in claim_batch(batch_size, timezone.now()):
+        try:
+            url = backend.upload(upload.staged_path, upload.folder)
+            finished = finish_upload(upload, url)
+        except Exception as e:
+            # update() rather than save(): the row may have been superseded and deleted meanwhile
+            if upload.attempts >= settings.UPLOAD_MAX_ATTEMPTS or not os.path.exists(upload.staged_path):
+                PendingUpload.objects.filter(pk=upload.pk, status=UploadStatus.PENDING).update(
+                    status=UploadStatus.FAILED, last_error=str(e))
+                discard_staged(upload.staged_path)
+                failed += 1
+            else:
+                PendingUpload.objects.filter(pk=upload.pk, status=UploadStatus.PENDING).update(
+                    next_attempt_at=timezone.now() + retry_delay(upload.attempts), last_error=str(e))
+                retried += 1
+            continue
+
+        discard_staged(upload.staged_path)
+        if finished:
+            done += 1
+
+    return done, retried, failed
@@ -0,0 +1,274 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from oauth2_provider.models import AccessToken, Application
+
+from courses import cache as catalog_cache
+from courses.models import Category, Course, Chapter, Lesson, Document, User, UserCourse, Permission, Role, \
+    STUDENT_COUNT_STATUSES
+from courses.oauth2_validators import forget_tokens
+from courses.services import course_detail, permission_matrix, tokens
+
+
+def invalidate_course_detail_on_commit(*course_ids):
+    # Clearing before commit would let a concurrent read cache the old rows again
+    course_ids = list(course_ids)
+    transaction.on_commit(lambda: course_detail.invalidate(*course_ids))
+
+
+def bump_catalog_on_commit(*namespaces):
+    transaction.on_commit(lambda: catalog_cache.bump_generation(*namespaces))
+
+
+def apply_lesson_delta(chapter_id, count, duration):
+    """Shift the stored lesson counters of a chapter and of the course owning it"""
+    if not chapter_id or (not count and not duration):
+        return
+
+    Chapter.objects.filter(pk=chapter_id).update(
+        lessons_count=F('lessons_count') + count,
+        total_duration=F('total_duration') + duration
+    )
+    Course.objects.filter(chapters__pk=chapter_id).update(
+        lessons_count=F('lessons_count') + count,
+        total_duration=F('total_duration') + duration
+    )
+
+
+@receiver(pre_save, sender=Lesson)
+def remember_lesson_counters(sender, instance, raw=False, **kwargs):
+    # Keep the values stored in the database so post_save can compute the delta
+    instance._stored_counters = None
+    if instance.pk and not raw:
+        instance._stored_counters = Lesson.objects.filter(pk=instance.pk).values_list(
+            'chapter_id', 'duration').first()
+
+
+@receiver(post_save, sender=Lesson)
+def update_counters_on_lesson_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    duration = instance.duration or 0
+    stored = getattr(instance, '_stored_counters', None)
+    if created or stored is None:
+        apply_lesson_delta(instance.chapter_id, 1, duration)
+        return
+
+    old_chapter_id, old_duration = stored
+    old_duration = old_duration or 0
+    if old_chapter_id != instance.chapter_id:
+        # Lesson moved to another chapter (possibly of another course)
+        apply_lesson_delta(old_chapter_id, -1, -old_duration)
+        apply_lesson_delta(instance.chapter_id, 1, duration)
+    else:
+        apply_lesson_delta(instance.chapter_id, 0, duration - old_duration)
+
+
+@receiver(post_delete, sender=Lesson)
+def update_counters_on_lesson_delete(sender, instance, **kwargs):
+    apply_lesson_delta(instance.chapter_id, -1, -(instance.duration or 0))
+
+
+@receiver(pre_save, sender=Chapter)
+def remember_chapter_course(sender, instance, raw=False, **kwargs):
+    instance._stored_counters = None
+    if instance.pk and not raw:
+        instance._stored_counters = Chapter.objects.filter(pk=instance.pk).values_list(
+            'course_id', 'lessons_count', 'total_duration').first()
+
+
+@receiver(post_save, sender=Chapter)
+def update_counters_on_chapter_move(sender, instance, created, raw=False, **kwargs):
+    stored = getattr(instance, '_stored_counters', None)
+    if raw or created or stored is None:
+        return
+
+    old_course_id, lessons_count, total_duration = stored
+    if old_course_id == instance.course_id or not lessons_count:
+        return
+
+    # Chapter moved to another course: carry its lessons over
+    Course.objects.filter(pk=old_course_id).update(
+        lessons_count=F('lessons_count') - lessons_count,
+        total_duration=F('total_duration') - total_duration
+    )
+    Course.objects.filter(pk=instance.course_id).update(
+        lessons_count=F('lessons_count') + lessons_count,
+        total_duration=F('total_duration') + total_duration
+    )
+    bump_catalog_on_commit(catalog_cache.COURSES)
+
+
+def apply_student_delta(course_id, delta):
+    if course_id and delta:
+        Course.objects.filter(pk=course_id).update(student_count=F('student_count') + delta)
+        # update() sends no signal: course listings show total_student
+        bump_catalog_on_commit(catalog_cache.COURSES)
+
+
+@receiver(pre_save, sender=UserCourse)
+def remember_enrollment_status(sender, instance, raw=False, **kwargs):
+    instance._stored_enrollment = None
+    if instance.pk and not raw:
+        instance._stored_enrollment = UserCourse.objects.filter(pk=instance.pk).values_list(
+            'course_id', 'status').first()
+
+
+@receiver(post_save, sender=UserCourse)
+def update_student_count_on_enrollment_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    counted = instance.status in STUDENT_COUNT_STATUSES
+    stored = getattr(instance, '_stored_enrollment', None)
+    if created or stored is None:
+        apply_student_delta(instance.course_id, 1 if counted else 0)
+        return
+
+    old_course_id, old_status = stored
+    was_counted = old_status in STUDENT_COUNT_STATUSES
+    if old_course_id != instance.course_id:
+        apply_student_delta(old_course_id, -1 if was_counted else 0)
+        apply_student_delta(instance.course_id, 1 if counted else 0)
+    elif was_counted != counted:
+        apply_student_delta(instance.course_id, 1 if counted else -1)
+
+
+@receiver(post_delete, sender=UserCourse)
+def update_student_count_on_enrollment_delete(sender, instance, **kwargs):
+    if instance.status in STUDENT_COUNT_STATUSES:
+        apply_student_delta(instance.course_id, -1)
+
+
+@receiver([post_save, post_delete], sender=Course)
+@receiver([post_save, post_delete], sender=Lesson)
+def invalidate_course_catalog(sender, **kwargs):
+    if not kwargs.get('raw'):
+        bump_catalog_on_commit(catalog_cache.COURSES)
+
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_category_catalog(sender, **kwargs):
+    if not kwargs.get('raw'):
+        # Course listings embed category_name
+        bump_catalog_on_commit(catalog_cache.CATEGORIES, catalog_cache.COURSES)
+
+
+# User columns shown publicly: the teacher listing, lecturer_name in course listings and
+# the lecturer block of the course detail. Saves touching none of them (last_login, password) are free.
+TEACHER_LISTING_FIELDS = {'first_name', 'last_name', 'user_role_id'}
+LECTURER_NAME_FIELDS = {'first_name', 'last_name'}
+LECTURER_DETAIL_FIELDS = ('username', 'email', 'first_name', 'last_name', 'avatar', 'address', 'introduce', 'phone',
+                          'date_joined', 'user_role_id', 'is_active')
+
+
+@receiver(pre_save, sender=User)
+def remember_public_user_fields(sender, instance, raw=False, update_fields=None, **kwargs):
+    instance._stored_public = None
+    if not instance.pk or raw:
+        return
+    if update_fields is not None:
+        attnames = {User._meta.get_field(name).attname for name in update_fields}
+        if not attnames & set(LECTURER_DETAIL_FIELDS):
+            return
+    instance._stored_public = User.objects.filter(pk=instance.pk).values(*LECTURER_DETAIL_FIELDS).first()
+
+
+def changed_public_fields(instance, created):
+    if created:
+        return set(LECTURER_DETAIL_FIELDS)
+    stored = getattr(instance, '_stored_public', None)
+    if stored is None:
+        return set()
+    fields = {field.attname: field for field in User._meta.concrete_fields}
+    return {
+        name for name, value in stored.items()
+        if fields[name].get_prep_value(getattr(instance, name)) != fields[name].get_prep_value(value)
+    }
+
+
+@receiver(post_save, sender=User)
+def invalidate_public_user_caches(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    changed = changed_public_fields(instance, created)
+    if changed & TEACHER_LISTING_FIELDS:
+        bump_catalog_on_commit(catalog_cache.TEACHERS)
+    if changed and not created:
+        course_ids = list(Course.objects.filter(lecturer=instance).values_list('pk', flat=True))
+        if course_ids:
+            invalidate_course_detail_on_commit(*course_ids)
+            if changed & LECTURER_NAME_FIELDS:
+                bump_catalog_on_commit(catalog_cache.COURSES)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_teacher_catalog(sender, **kwargs):
+    bump_catalog_on_commit(catalog_cache.TEACHERS)
+
+
+@receiver([post_save, post_delete], sender=Course)
+def invalidate_course_detail(sender, instance, **kwargs):
+    invalidate_course_detail_on_commit(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Chapter)
+def invalidate_chapter_course_detail(sender, instance, **kwargs):
+    stored = getattr(instance, '_stored_counters', None)
+    invalidate_course_detail_on_commit(instance.course_id, stored[0] if stored else None)
+
+
+@receiver([post_save, post_delete], sender=Lesson)
+def invalidate_lesson_course_detail(sender, instance, **kwargs):
+    stored = getattr(instance, '_stored_counters', None)
+    chapter_ids = [instance.chapter_id] + ([stored[0]] if stored else [])
+    invalidate_course_detail_on_commit(*Chapter.objects.filter(pk__in=chapter_ids).values_list('course_id', flat=True))
+
+
+@receiver([post_save, post_delete], sender=Document)
+def invalidate_document_course_detail(sender, instance, **kwargs):
+    invalidate_course_detail_on_commit(*Course.objects.filter(chapters__lessons__pk=instance.lesson_id).values_list('pk', flat=True))
+
+
+@receiver([post_save, post_delete], sender=Permission)
+@receiver([post_save, post_delete], sender=Role)
+def invalidate_permission_matrix(sender, **kwargs):
+    # After commit, or a worker could reload the old rows under the new version
+    transaction.on_commit(permission_matrix.invalidate)
+
+
+def forget_tokens_on_commit(token_checksums):
+    token_checksums = list(token_checksums)
+    if token_checksums:
+        transaction.on_commit(lambda: forget_tokens(token_checksums))
+
+
+# User fields a cached token depends on; other saves (last_login, profile) leave the cache alone
+TOKEN_USER_FIELDS = {'is_active', 'user_role', 'user_role_id'}
+
+
+@receiver([post_save, post_delete], sender=AccessToken)
+def invalidate_cached_token(sender, instance, **kwargs):
+    forget_tokens_on_commit([instance.token_checksum])
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    # Cached tokens carry the user (is_active, role) along
+    if raw or created or (update_fields is not None and not TOKEN_USER_FIELDS & set(update_fields)):
+        return
+    forget_tokens_on_commit(AccessToken.objects.filter(user=instance).values_list('token_checksum', flat=True))
+
+
+@receiver(post_save, sender=Role)
+def invalidate_role_tokens(sender, instance, raw=False, **kwargs):
+    if not raw:
+        forget_tokens_on_commit(
+            AccessToken.objects.filter(user__user_role=instance).values_list('token_checksum', flat=True))
+
+
+@receiver([post_save, post_delete], sender=Application)
+def invalidate_login_application(sender, **kwargs):
+    tokens.forget_login_application()
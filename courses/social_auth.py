@@ -1,24 +1,96 @@
-from google.oauth2 import id_token
-from google.auth.transport import requests
+import logging
+import re
+import threading
+import time
+
+import requests
 from django.conf import settings
-from rest_framework import exceptions
-import os
+from google.auth import jwt
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def verify_google_token(token):
-    try:
-        # Lấy Client ID từ environment hoặc settings
-        client_id = os.getenv('GOOGLE_CLIENT_ID')
-        
-        # Xác thực token với Google (thêm clock_skew_in_seconds để fix lỗi lệch giờ giữa các server)
-        idinfo = id_token.verify_oauth2_token(token, requests.Request(), client_id, clock_skew_in_seconds=10)
-
-        # Kiểm tra issuer
-        if idinfo['iss'] not in ['accounts.google.com', 'https://accounts.google.com']:
-            raise ValueError('Wrong issuer.')
+logger = logging.getLogger('courses.auth')
+
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+def build_session():
+    """Pooled keep-alive session; the certs endpoint is retried on transient errors"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=10,
+                          max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504)))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class GoogleTokenVerifier:
+    """
+    Verifies Google ID tokens locally against Google's signing certificates.
+    The certificates are kept in the process for the Cache-Control max-age Google sends,
+    and re-fetched early (at most once per `refresh_interval`) when a token is signed
+    with a key we have not seen yet.
+    """
+
+    def __init__(self, certs_url, session=None, default_max_age=300, refresh_interval=30, timeout=(3.05, 5)):
+        self.certs_url = certs_url
+        self.session = session or build_session()
+        self.default_max_age = default_max_age
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.certs = {}
+        self.expires_at = 0.0
+        self.fetched_at = float('-inf')
+
+    def fetch_certs(self):
+        response = self.session.get(self.certs_url, timeout=self.timeout)
+        response.raise_for_status()
+        match = MAX_AGE.search(response.headers.get('Cache-Control', ''))
+        max_age = int(match.group(1)) if match else self.default_max_age
 
-        # ID token is valid. Get the user's Google ID from the decoded token.
+        now = time.monotonic()
+        self.certs = response.json()
+        self.expires_at = now + max_age
+        self.fetched_at = now
+        logger.info('google_certs_fetched', extra={'keys': len(self.certs), 'max_age': max_age})
+
+    def get_certs(self, key_id=None):
+        with self.lock:
+            now = time.monotonic()
+            rotated = key_id and key_id not in self.certs and now - self.fetched_at >= self.refresh_interval
+            if now >= self.expires_at or rotated:
+                self.fetch_certs()
+            return self.certs
+
+    def verify(self, token, audience=None, clock_skew_in_seconds=10):
+        key_id = jwt.decode_header(token).get('kid')
+        idinfo = jwt.decode(token, certs=self.get_certs(key_id), audience=audience,
+                            clock_skew_in_seconds=clock_skew_in_seconds)
+        if idinfo.get('iss') not in GOOGLE_ISSUERS:
+            raise ValueError('Wrong issuer.')
         return idinfo
+
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+
+def get_google_verifier():
+    global _verifier
+    if _verifier is None:
+        with _verifier_lock:
+            if _verifier is None:
+                _verifier = GoogleTokenVerifier(settings.GOOGLE_CERTS_URL)
+    return _verifier
+
+
+def verify_google_token(token):
+    try:
+        # Xác thực token với Google (clock skew 10s để fix lỗi lệch giờ giữa các server)
+        return get_google_verifier().verify(token, audience=settings.GOOGLE_CLIENT_ID)
     except Exception as e:
         error_msg = str(e)
-        print(f"Google token verification error: {error_msg}")
+        logger.warning('google_token_rejected', extra={'error': error_msg})
         return {"error": error_msg}
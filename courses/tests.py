@@ -1,10 +1,39 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import connection
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework.test import APIClient
 from rest_framework import status
-from courses.models import User, Role, Course, Category, UserCourse, CourseStatus, Chapter, Lesson, Payment
+from courses.models import User, Role, Course, Category, UserCourse, CourseStatus, Chapter, Lesson, Payment, \
+    Forum, Topic, LessonProgress, LessonProgressStatus, CourseProgress, Permission, EmailOutbox, EmailStatus, \
+    PendingUpload, UploadStatus, PaymentStatus, PaymentNotification, OutboxEvent
 from django.contrib.auth.hashers import make_password
 from unittest.mock import patch, MagicMock
-from oauth2_provider.models import Application, AccessToken
+from oauth2_provider.models import Application, AccessToken, RefreshToken
+from courses import cache as catalog_cache
+from courses.checks import check_progress_buffer
+from courses.oauth2_validators import token_cache_key
+from courses.services import course_detail, enrollments, mailer, momo, outbox, permission_matrix, uploads
+from courses.social_auth import GoogleTokenVerifier
+from coursesapp.db import connection_profile
+from courses.services.progress_buffer import LocalProgressBuffer, get_progress_buffer
 
 class CoursePermissionTests(TestCase):
     def setUp(self):
@@ -90,13 +119,12 @@ class PaymentTests(TestCase):
         self.student_role, _ = Role.objects.get_or_create(name='Student')
         self.student = User.objects.create(username='student_pay', user_role=self.student_role)
         self.course = Course.objects.create(name='Paid Course', price=50000)
+        caches['default'].clear()
 
-    @patch('courses.services.momo.requests.post')
-    def test_create_payment_flow(self, mock_post):
+    @patch('courses.services.momo.MomoGateway.create_payment')
+    def test_create_payment_flow(self, mock_create_payment):
         # Mock Momo response
-        mock_response = MagicMock()
-        mock_response.json.return_value = {'payUrl': 'http://momo.vn/pay'}
-        mock_post.return_value = mock_response
+        mock_create_payment.return_value = {'payUrl': 'http://momo.vn/pay'}
 
         self.client.force_authenticate(user=self.student)
         
@@ -119,6 +147,91 @@ class PaymentTests(TestCase):
         self.assertTrue(UserCourse.objects.filter(user=self.student, course=self.course).exists())
         self.assertTrue(Payment.objects.filter(user=self.student, course_id=self.course.id).exists())
 
+    @patch('courses.services.momo.MomoGateway.create_payment')
+    def test_repeated_enrollment_reuses_the_pay_url(self, mock_create_payment):
+        mock_create_payment.return_value = {'payUrl': 'http://momo.vn/pay'}
+        self.client.force_authenticate(user=self.student)
+
+        self.assertEqual(self.client.post('/enrollments/create/', {'course': self.course.id}).status_code,
+                         status.HTTP_201_CREATED)
+        response = self.client.post('/enrollments/create/', {'course': self.course.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['payUrl'], 'http://momo.vn/pay')
+
+        # No second order, no second seat
+        self.assertEqual(mock_create_payment.call_count, 1)
+        self.assertEqual(Payment.objects.filter(user=self.student).count(), 1)
+        self.assertEqual(UserCourse.objects.filter(user=self.student).count(), 1)
+        self.course.refresh_from_db()
+        self.assertEqual(self.course.student_count, 1)
+
+    @patch('courses.services.momo.MomoGateway.query_payment')
+    @patch('courses.services.momo.MomoGateway.create_payment')
+    def test_expired_pay_url_reuses_the_open_order(self, mock_create_payment, mock_query_payment):
+        mock_create_payment.side_effect = lambda order_id, *args: {'payUrl': f'http://momo.vn/pay/{order_id}'}
+        self.client.force_authenticate(user=self.student)
+        first = self.client.post('/enrollments/create/', {'course': self.course.id}).data['payUrl']
+        caches['default'].clear()
+
+        # MoMo still holds the order open: same link, no second order
+        mock_query_payment.return_value = {'resultCode': 1000}
+        response = self.client.post('/enrollments/create/', {'course': self.course.id})
+        self.assertEqual((response.status_code, response.data['payUrl']), (status.HTTP_200_OK, first))
+        self.assertEqual(mock_create_payment.call_count, 1)
+
+        # The order expired at MoMo: it is settled, then a new one is opened
+        mock_query_payment.return_value = {'resultCode': 1005}
+        response = self.client.post('/enrollments/create/', {'course': self.course.id})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotEqual(response.data['payUrl'], first)
+        self.assertEqual(sorted(Payment.objects.values_list('status', flat=True)),
+                         [PaymentStatus.FAILED, PaymentStatus.PENDING])
+        self.assertEqual(UserCourse.objects.get(user=self.student).status, CourseStatus.PENDING)
+        self.course.refresh_from_db()
+        self.assertEqual(self.course.student_count, 1)
+
+    @patch('courses.services.momo.MomoGateway.create_payment')
+    def test_enrolling_again_after_payment_is_rejected(self, mock_create_payment):
+        UserCourse.objects.create(user=self.student, course=self.course, status=CourseStatus.IN_PROGRESS)
+        self.client.force_authenticate(user=self.student)
+
+        response = self.client.post('/enrollments/create/', {'course': self.course.id})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_create_payment.assert_not_called()
+
+    def test_enroll_twice(self):
+        enrollment, created = enrollments.enroll(self.student, self.course, CourseStatus.PENDING)
+        again, created_again = enrollments.enroll(self.student, self.course, CourseStatus.PENDING)
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(again.pk, enrollment.pk)
+        self.course.refresh_from_db()
+        self.assertEqual(self.course.student_count, 1)
+
+    @patch('courses.services.momo.MomoGateway.create_payment')
+    def test_refused_order_is_not_left_pending(self, mock_create_payment):
+        mock_create_payment.return_value = {'resultCode': 1002, 'message': 'Transaction rejected by the issuer'}
+        self.client.force_authenticate(user=self.student)
+
+        response = self.client.post('/enrollments/create/', {'course': self.course.id})
+        self.assertEqual(response.status_code, status.HTTP_502_BAD_GATEWAY)
+        self.assertEqual(Payment.objects.get(user=self.student).status, PaymentStatus.FAILED)
+        self.assertEqual(UserCourse.objects.get(user=self.student).status, CourseStatus.PAYMENT_FAILED)
+        self.course.refresh_from_db()
+        self.assertEqual(self.course.student_count, 0)
+
+
+    @patch('courses.services.momo.MomoGateway.create_payment')
+    def test_unclear_answer_without_pay_url_is_left_to_the_reconciler(self, mock_create_payment):
+        self.client.force_authenticate(user=self.student)
+        for i, answer in enumerate([{'resultCode': 7000}, {'resultCode': 99, 'message': 'Unknown error'},
+                                    {'resultCode': 0}, {}]):
+            course = Course.objects.create(name=f'Unclear {i}', price=50000)
+            mock_create_payment.return_value = answer
+            response = self.client.post('/enrollments/create/', {'course': course.id})
+            self.assertEqual(response.status_code, status.HTTP_502_BAD_GATEWAY)
+            self.assertEqual(Payment.objects.get(course=course).status, PaymentStatus.PENDING)
+            self.assertEqual(UserCourse.objects.get(course=course).status, CourseStatus.PENDING)
 
 class ModelLogicTests(TestCase):
     def test_user_role_assignment(self):
@@ -160,3 +273,1261 @@ class GoogleLoginTests(TestCase):
         user = User.objects.get(email='googleuser@example.com')
         self.assertEqual(user.first_name, 'Google')
         self.assertEqual(user.user_role.name, 'Student')
+
+    @patch('courses.views.verify_google_token')
+    def test_repeat_login_issues_new_tokens_without_deleting(self, mock_verify):
+        mock_verify.return_value = {'email': 'repeat@example.com', 'iss': 'accounts.google.com'}
+        first = self.client.post('/auth/google/', {'token': 'valid_google_token'})
+        second = self.client.post('/auth/google/', {'token': 'valid_google_token'})
+
+        self.assertNotEqual(first.data['access_token'], second.data['access_token'])
+        user = User.objects.get(email='repeat@example.com')
+        self.assertEqual(AccessToken.objects.filter(user=user).count(), 2)
+        self.assertEqual(RefreshToken.objects.filter(user=user).count(), 2)
+
+    @patch('courses.views.verify_google_token')
+    def test_success_is_logged_at_info_level(self, mock_verify):
+        mock_verify.return_value = {'email': 'logged@example.com', 'iss': 'accounts.google.com'}
+        with self.assertLogs('courses.auth', level='INFO') as logs:
+            response = self.client.post('/auth/google/', {'token': 'valid_google_token'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        record = logs.records[-1]
+        self.assertEqual((record.getMessage(), record.user_created), ('google_login_succeeded', True))
+
+
+class CourseCounterTests(TestCase):
+    def setUp(self):
+        self.course = Course.objects.create(name='Counter Course')
+        self.other_course = Course.objects.create(name='Other Course')
+        self.chapter = Chapter.objects.create(course=self.course, name='Chapter 1')
+        self.other_chapter = Chapter.objects.create(course=self.other_course, name='Chapter 2')
+
+    def assertCounters(self, obj, lessons_count, total_duration):
+        obj.refresh_from_db()
+        self.assertEqual((obj.lessons_count, obj.total_duration), (lessons_count, total_duration))
+
+    def test_counters_follow_lesson_changes(self):
+        lesson = Lesson.objects.create(chapter=self.chapter, name='L1', duration=10)
+        Lesson.objects.create(chapter=self.chapter, name='L2', duration=5)
+        self.assertCounters(self.course, 2, 15)
+        self.assertCounters(self.chapter, 2, 15)
+
+        lesson.duration = 20
+        lesson.save()
+        self.assertCounters(self.course, 2, 25)
+
+        lesson.chapter = self.other_chapter
+        lesson.save()
+        self.assertCounters(self.course, 1, 5)
+        self.assertCounters(self.other_course, 1, 20)
+
+        lesson.delete()
+        self.assertCounters(self.other_course, 0, 0)
+        self.assertCounters(self.other_chapter, 0, 0)
+
+    def test_full_save_keeps_concurrent_counter_updates(self):
+        course = Course.objects.get(pk=self.course.pk)
+        chapter = Chapter.objects.get(pk=self.chapter.pk)
+        # Another request adds a lesson after both rows were loaded
+        Lesson.objects.create(chapter=self.chapter, name='L1', duration=10)
+        UserCourse.objects.create(user=User.objects.create(username='counted', email='counted@test.com'),
+                                  course=self.course)
+
+        course.name = 'Renamed'
+        course.save()
+        chapter.name = 'Renamed'
+        chapter.save()
+        self.assertCounters(course, 1, 10)
+        self.assertEqual((course.name, course.student_count), ('Renamed', 1))
+        self.assertCounters(chapter, 1, 10)
+
+    def test_rebuild_command(self):
+        Lesson.objects.create(chapter=self.chapter, name='L1', duration=10)
+        Course.objects.update(lessons_count=0, total_duration=0)
+
+        call_command('rebuild_course_counters', stdout=StringIO())
+        self.assertCounters(self.course, 1, 10)
+
+
+class StudentCountTests(TestCase):
+    def setUp(self):
+        self.student = User.objects.create(username='counted', email='counted@test.com')
+        self.course = Course.objects.create(name='Counted Course', price=100000)
+
+    def test_student_count_follows_enrollments(self):
+        enrollment = UserCourse.objects.create(user=self.student, course=self.course)
+        self.course.refresh_from_db()
+        self.assertEqual(self.course.student_count, 1)
+
+        enrollment.status = CourseStatus.PAYMENT_FAILED
+        enrollment.save()
+        self.course.refresh_from_db()
+        self.assertEqual(self.course.student_count, 0)
+
+        enrollment.status = CourseStatus.IN_PROGRESS
+        enrollment.save()
+        enrollment.delete()
+        self.course.refresh_from_db()
+        self.assertEqual(self.course.student_count, 0)
+
+    def test_reconcile_command(self):
+        UserCourse.objects.create(user=self.student, course=self.course)
+        Course.objects.update(student_count=42)
+
+        call_command('reconcile_student_counts', stdout=StringIO())
+        self.course.refresh_from_db()
+        self.assertEqual(self.course.student_count, 1)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.teacher = User.objects.create(username='keyset_teacher', email='keyset@test.com')
+        for i in range(10):
+            Course.objects.create(name=f'Course {i}', lecturer=self.teacher, image='sample')
+
+    def test_course_cursor_mode(self):
+        response = self.client.get('/courses/', {'pagination': 'cursor'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('count', response.data)
+        first_page = [c['id'] for c in response.data['results']]
+        self.assertEqual(len(first_page), 8)
+
+        response = self.client.get(response.data['next'])
+        second_page = [c['id'] for c in response.data['results']]
+        self.assertEqual(len(second_page), 2)
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(first_page + second_page, sorted(first_page + second_page, reverse=True))
+
+    def test_page_number_mode_is_default(self):
+        response = self.client.get('/courses/')
+        self.assertEqual(response.data['count'], 10)
+
+    def test_topic_composite_ordering(self):
+        forum = Forum.objects.create(user=self.teacher, name='Forum')
+        pinned = Topic.objects.create(forum=forum, user=self.teacher, title='Pinned', is_pinned=True)
+        others = [Topic.objects.create(forum=forum, user=self.teacher, title=f'T{i}') for i in range(11)]
+        for i, topic in enumerate(others):
+            Topic.objects.filter(pk=topic.pk).update(last_activity=timezone.now() + timedelta(minutes=i))
+        self.client.force_authenticate(user=self.teacher)
+
+        response = self.client.get('/topics/', {'pagination': 'cursor'})
+        ids = [t['id'] for t in response.data['results']]
+        response = self.client.get(response.data['next'])
+        ids += [t['id'] for t in response.data['results']]
+
+        self.assertEqual(ids, [pinned.id] + [t.id for t in reversed(others)])
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.teacher = User.objects.create(username='cache_teacher', email='cache@test.com')
+        self.category = Category.objects.create(name='Cached Category')
+        Course.objects.create(name='Cached Course', lecturer=self.teacher, category=self.category, image='sample')
+
+    def test_course_list_is_cached_until_course_write(self):
+        self.assertEqual(self.client.get('/courses/', {'level': 'so_cap'})['X-Cache'], 'MISS')
+        with self.assertNumQueries(0):
+            response = self.client.get('/courses/', {'level': 'so_cap', 'unrelated': '1'})
+        self.assertEqual(response['X-Cache'], 'HIT')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Course.objects.create(name='New Course', lecturer=self.teacher, image='sample')
+        response = self.client.get('/courses/', {'level': 'so_cap'})
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['count'], 2)
+
+        stats = catalog_cache.get_stats(catalog_cache.COURSES)['courses']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_category_write_invalidates_categories(self):
+        self.client.get('/categories/')
+        self.category.name = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.save()
+        response = self.client.get('/categories/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data[0]['name'], 'Renamed')
+
+
+    def test_only_public_user_changes_bump_the_listings(self):
+        self.client.get('/teachers/')
+        self.client.get('/courses/')
+        self.teacher.set_password('new-pass')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.teacher.save()
+        self.assertEqual(self.client.get('/teachers/')['X-Cache'], 'HIT')
+        self.assertEqual(self.client.get('/courses/')['X-Cache'], 'HIT')
+
+        self.teacher.first_name = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.teacher.save()
+        self.assertEqual(self.client.get('/teachers/')['X-Cache'], 'MISS')
+        response = self.client.get('/courses/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertTrue(response.data['results'][0]['lecturer_name'].endswith('Renamed'))
+
+    def test_enrollment_refreshes_total_student(self):
+        self.client.get('/courses/')
+        student = User.objects.create(username='cache_student', email='cache_student@test.com')
+        with self.captureOnCommitCallbacks(execute=True):
+            UserCourse.objects.create(user=student, course=Course.objects.get(), status=CourseStatus.IN_PROGRESS)
+        response = self.client.get('/courses/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['results'][0]['total_student'], 1)
+
+class CourseDetailDocumentTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.teacher = User.objects.create(username='detail_teacher', email='detail_teacher@test.com')
+        self.student = User.objects.create(username='detail_student', email='detail_student@test.com')
+        self.course = Course.objects.create(name='Detail Course', lecturer=self.teacher, price=100000, image='sample')
+        self.chapter = Chapter.objects.create(course=self.course, name='Chapter 1')
+        Lesson.objects.create(chapter=self.chapter, name='Lesson 1', duration=10)
+
+    def test_cached_document_with_per_user_paywall(self):
+        self.client.force_authenticate(user=self.student)
+        response = self.client.get(f'/courses/{self.course.id}/detail/')
+        self.assertFalse(response.data['is_enrolled'])
+        self.assertEqual(response.data['chapters'], [])
+        self.assertEqual(response.data['lessons_count'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            UserCourse.objects.create(user=self.student, course=self.course)
+        self.client.get(f'/courses/{self.course.id}/detail/')
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/courses/{self.course.id}/detail/')
+        self.assertTrue(response.data['is_enrolled'])
+        self.assertEqual(len(response.data['chapters']), 1)
+        self.assertEqual(response.data['total_student'], 1)
+
+    def test_lesson_change_rebuilds_document(self):
+        self.client.get(f'/courses/{self.course.id}/detail/')
+        with self.captureOnCommitCallbacks() as callbacks:
+            Lesson.objects.create(chapter=self.chapter, name='Lesson 2', duration=5)
+            # Not before commit: a concurrent read would cache the old syllabus again
+            self.assertIsNotNone(cache.get(course_detail.document_key(self.course.id)))
+        for callback in callbacks:
+            callback()
+
+        self.client.force_authenticate(user=self.teacher)
+        response = self.client.get(f'/courses/{self.course.id}/detail/')
+        self.assertEqual(response.data['lessons_count'], 2)
+        self.assertEqual(len(response.data['chapters'][0]['lessons']), 2)
+
+    def test_late_rebuild_cannot_outlive_invalidation(self):
+        # A rebuild reads the rows, then the course changes and is invalidated before the rebuild writes
+        key = course_detail.document_key(self.course.id)
+        stale = course_detail.build_document(self.course.id, key)
+        Course.objects.filter(pk=self.course.id).update(name='Renamed Course')
+        course_detail.invalidate(self.course.id)
+        cache.set(key, stale)
+
+        response = self.client.get(f'/courses/{self.course.id}/detail/')
+        self.assertEqual(response.data['name'], 'Renamed Course')
+
+    def test_enrollment_keeps_the_document(self):
+        self.client.get(f'/courses/{self.course.id}/detail/')
+        key = course_detail.document_key(self.course.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            UserCourse.objects.create(user=self.student, course=self.course, status=CourseStatus.IN_PROGRESS)
+        self.assertEqual(course_detail.document_key(self.course.id), key)
+        self.assertIsNotNone(cache.get(key))
+
+        response = self.client.get(f'/courses/{self.course.id}/detail/')
+        self.assertEqual((response.data['students_count'], response.data['total_student']), (1, 1))
+
+    def test_missing_course(self):
+        response = self.client.get('/courses/999999/detail/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class EnrolledCoursesTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.teacher = User.objects.create(username='enrolled_teacher', email='enrolled_teacher@test.com')
+        self.student = User.objects.create(username='enrolled_student', email='enrolled_student@test.com')
+        self.client.force_authenticate(user=self.student)
+
+    def enroll_in_new_course(self, name):
+        course = Course.objects.create(name=name, lecturer=self.teacher, price=100000, image='sample')
+        chapter = Chapter.objects.create(course=course, name='Chapter')
+        lesson = Lesson.objects.create(chapter=chapter, name='Lesson', duration=10)
+        UserCourse.objects.create(user=self.student, course=course, status=CourseStatus.IN_PROGRESS)
+        return lesson
+
+    def fetch(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/enrolled-courses/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, queries
+
+    def test_listing_is_a_bounded_pure_read(self):
+        lesson = self.enroll_in_new_course('Course 1')
+        LessonProgress.objects.create(user=self.student, lesson=lesson, status=LessonProgressStatus.COMPLETED)
+        CourseProgress.objects.create(user=self.student, course=lesson.chapter.course, completed_lessons=1)
+        _, single = self.fetch()
+
+        for i in range(2, 5):
+            self.enroll_in_new_course(f'Course {i}')
+        response, many = self.fetch()
+
+        self.assertEqual(len(response.data), 4)
+        self.assertEqual(len(single), len(many))
+        self.assertFalse([q['sql'] for q in many if not q['sql'].lstrip().upper().startswith('SELECT')])
+        self.assertFalse(CourseProgress.objects.filter(course__name='Course 2').exists())
+
+        progress = {item['course']['name']: item['progress'] for item in response.data}
+        self.assertEqual(progress['Course 1']['completion_percentage'], 100)
+        self.assertEqual(progress['Course 2']['completion_percentage'], 0)
+
+
+class CourseProgressUpdateTests(TestCase):
+    def setUp(self):
+        self.student = User.objects.create(username='progress_student', email='progress_student@test.com')
+        self.course = Course.objects.create(name='Progress Course')
+        chapter = Chapter.objects.create(course=self.course, name='Chapter')
+        self.lessons = [Lesson.objects.create(chapter=chapter, name=f'L{i}', duration=10) for i in range(2)]
+        self.enrollment = UserCourse.objects.create(user=self.student, course=self.course,
+                                                    status=CourseStatus.IN_PROGRESS)
+        self.progress = CourseProgress.objects.create(user=self.student, course=self.course)
+
+    def test_aggregates_and_status_sync(self):
+        for lesson in self.lessons:
+            LessonProgress.objects.create(user=self.student, lesson=lesson, watch_time=30,
+                                          status=LessonProgressStatus.COMPLETED)
+        self.progress.update_progress()
+
+        self.progress.refresh_from_db()
+        self.enrollment.refresh_from_db()
+        self.assertEqual((self.progress.total_lessons, self.progress.completed_lessons), (2, 2))
+        self.assertEqual(self.progress.total_watch_time, 60)
+        self.assertEqual(self.progress.completion_percentage, 100)
+        self.assertEqual(self.enrollment.status, CourseStatus.COMPLETE)
+
+    def test_unchanged_progress_is_a_single_read(self):
+        LessonProgress.objects.create(user=self.student, lesson=self.lessons[0], watch_time=30)
+        self.progress.update_progress()
+
+        with self.assertNumQueries(1):
+            self.progress.update_progress()
+
+        LessonProgress.objects.filter(lesson=self.lessons[0]).update(watch_time=45)
+        with self.assertNumQueries(2):
+            self.progress.update_progress()
+
+
+class BulkLessonProgressTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.student = User.objects.create(username='bulk_student', email='bulk_student@test.com')
+        self.course = Course.objects.create(name='Bulk Course')
+        self.other_course = Course.objects.create(name='Not Enrolled Course')
+        chapter = Chapter.objects.create(course=self.course, name='Chapter')
+        self.lessons = [Lesson.objects.create(chapter=chapter, name=f'L{i}', duration=10) for i in range(2)]
+        other_chapter = Chapter.objects.create(course=self.other_course, name='Chapter')
+        self.other_lesson = Lesson.objects.create(chapter=other_chapter, name='Other', duration=10)
+        UserCourse.objects.create(user=self.student, course=self.course, status=CourseStatus.IN_PROGRESS)
+        self.client.force_authenticate(user=self.student)
+
+    def test_bulk_heartbeats(self):
+        first, second = self.lessons
+        LessonProgress.objects.create(user=self.student, lesson=first, watch_time=5, completion_percentage=10)
+        events = [
+            {'lesson_id': first.id, 'watch_time': 60, 'completion_percentage': 50, 'client_ts': '2026-01-01T10:00:05Z'},
+            {'lesson_id': first.id, 'watch_time': 30, 'completion_percentage': 20, 'client_ts': '2026-01-01T10:00:00Z'},
+            {'lesson_id': second.id, 'watch_time': 600, 'completion_percentage': 95},
+            {'lesson_id': self.other_lesson.id, 'watch_time': 10, 'completion_percentage': 10},
+            {'lesson_id': 999999, 'watch_time': 10, 'completion_percentage': 10},
+        ]
+        response = self.client.post('/lesson-progress/bulk-update-progress/', {'events': events}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(response.data['updated']), [first.id, second.id])
+        self.assertEqual(len(response.data['rejected']), 2)
+
+        first_progress = LessonProgress.objects.get(user=self.student, lesson=first)
+        self.assertEqual((first_progress.watch_time, first_progress.completion_percentage), (60, 50))
+        self.assertEqual(first_progress.status, LessonProgressStatus.IN_PROGRESS)
+        self.assertIsNotNone(first_progress.started_at)
+        second_progress = LessonProgress.objects.get(user=self.student, lesson=second)
+        self.assertEqual(second_progress.status, LessonProgressStatus.COMPLETED)
+        self.assertFalse(LessonProgress.objects.filter(lesson=self.other_lesson).exists())
+
+        course_progress = CourseProgress.objects.get(user=self.student, course=self.course)
+        self.assertEqual((course_progress.completed_lessons, course_progress.total_watch_time), (1, 660))
+
+    def test_empty_batch_is_rejected(self):
+        response = self.client.post('/lesson-progress/bulk-update-progress/', {'events': []}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(PROGRESS_WRITE_BEHIND=True)
+class ProgressWriteBehindTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.student = User.objects.create(username='buffer_student', email='buffer_student@test.com')
+        self.course = Course.objects.create(name='Buffered Course')
+        chapter = Chapter.objects.create(course=self.course, name='Chapter')
+        self.lesson = Lesson.objects.create(chapter=chapter, name='Lesson', duration=10)
+        UserCourse.objects.create(user=self.student, course=self.course, status=CourseStatus.IN_PROGRESS)
+        self.client.force_authenticate(user=self.student)
+        # The shared Redis buffer is not available here; one in-process buffer stands in for it
+        patcher = patch('courses.services.progress_buffer._buffer', LocalProgressBuffer())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def heartbeat(self, watch_time, completion_percentage):
+        return self.client.post('/lesson-progress/update-progress/', {
+            'lesson_id': self.lesson.id, 'watch_time': watch_time, 'completion_percentage': completion_percentage
+        }, format='json')
+
+    def test_heartbeats_are_coalesced_until_flush(self):
+        self.assertEqual(self.heartbeat(30, 40).status_code, status.HTTP_202_ACCEPTED)
+        self.heartbeat(60, 35)
+        self.assertFalse(LessonProgress.objects.exists())
+
+        call_command('flush_progress_buffer', stdout=StringIO())
+        progress = LessonProgress.objects.get(user=self.student, lesson=self.lesson)
+        self.assertEqual((progress.watch_time, progress.completion_percentage), (60, 40))
+        self.assertEqual(CourseProgress.objects.get(user=self.student).total_watch_time, 60)
+
+    def test_completion_is_written_synchronously(self):
+        self.heartbeat(30, 40)
+        self.assertEqual(self.heartbeat(300, 95).status_code, status.HTTP_200_OK)
+        self.assertEqual(LessonProgress.objects.get().status, LessonProgressStatus.COMPLETED)
+
+        call_command('flush_progress_buffer', stdout=StringIO())
+        self.assertEqual(LessonProgress.objects.get().status, LessonProgressStatus.COMPLETED)
+
+    def test_claimed_heartbeat_does_not_undo_a_completion(self):
+        self.heartbeat(30, 40)
+        # The flusher has taken the batch when the completion arrives
+        entries = get_progress_buffer().claim()
+        self.assertEqual(self.heartbeat(300, 95).status_code, status.HTTP_200_OK)
+
+        call_command('flush_progress_buffer', stdout=StringIO())
+        self.assertEqual(len(entries), 1)
+        progress = LessonProgress.objects.get()
+        self.assertEqual((progress.status, progress.completion_percentage), (LessonProgressStatus.COMPLETED, 95))
+
+    def test_later_flush_with_an_older_heartbeat_keeps_the_watch_time(self):
+        self.heartbeat(120, 40)
+        call_command('flush_progress_buffer', stdout=StringIO())
+        # e.g. a retried request that reached the buffer after the newer one was flushed
+        self.heartbeat(60, 20)
+        call_command('flush_progress_buffer', stdout=StringIO())
+        progress = LessonProgress.objects.get()
+        self.assertEqual((progress.watch_time, progress.completion_percentage), (120, 40))
+
+    def test_write_behind_requires_redis(self):
+        # Reported by `manage.py check`/migrate at deploy time, not by every request
+        self.assertEqual([error.id for error in check_progress_buffer(None)], ['courses.E001'])
+        with override_settings(PROGRESS_WRITE_BEHIND=False):
+            self.assertEqual(check_progress_buffer(None), [])
+
+
+class RoleResolutionTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.teacher_role, _ = Role.objects.get_or_create(name='Teacher')
+        self.teacher = User.objects.create(username='role_teacher', email='role_teacher@test.com',
+                                           user_role=self.teacher_role)
+        self.app = Application.objects.create(name='Role App', client_type=Application.CLIENT_CONFIDENTIAL,
+                                              authorization_grant_type=Application.GRANT_PASSWORD)
+
+    def authenticate_with_token(self, user):
+        AccessToken.objects.create(user=user, application=self.app, token=f'token-{user.username}',
+                                   expires=timezone.now() + timedelta(hours=1), scope='read write')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer token-{user.username}')
+
+    def test_role_is_loaded_with_the_token(self):
+        self.authenticate_with_token(self.teacher)
+        # Token (with user and role) + forum listing; IsTeacher adds nothing
+        with self.assertNumQueries(2):
+            response = self.client.get('/forums/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_user_without_role_is_denied(self):
+        user = User.objects.create(username='no_role', email='no_role@test.com')
+        self.authenticate_with_token(user)
+        response = self.client.post('/courses/', {'name': 'Course'})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class PermissionMatrixTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.teacher_role, _ = Role.objects.get_or_create(name='Teacher')
+        self.teacher = User.objects.create(username='matrix_teacher', email='matrix_teacher@test.com',
+                                           user_role=self.teacher_role)
+        Permission.objects.create(role=self.teacher_role, method='GET', path='/forums/', module='forum')
+        Permission.objects.create(role=self.teacher_role, method='*', path='/courses/{id}/chapters/*',
+                                  module='course')
+
+    def test_matrix_matches_placeholders_and_wildcards(self):
+        matrix = permission_matrix.PermissionMatrix.load()
+        self.assertTrue(matrix.is_allowed('teacher', 'GET', '/forums/'))
+        self.assertTrue(matrix.is_allowed('teacher', 'HEAD', '/forums'))
+        self.assertFalse(matrix.is_allowed('teacher', 'POST', '/forums/'))
+        self.assertTrue(matrix.is_allowed('teacher', 'PATCH', '/courses/5/chapters/2/'))
+        self.assertFalse(matrix.is_allowed('teacher', 'GET', '/courses/5/'))
+        self.assertFalse(matrix.is_allowed('student', 'GET', '/forums/'))
+
+    @override_settings(PERMISSION_MATRIX_ENFORCED=True, PERMISSION_MATRIX_CHECK_INTERVAL=60)
+    def test_enforced_matrix_and_invalidation(self):
+        self.client.force_authenticate(self.teacher)
+        self.assertEqual(self.client.get('/forums/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/categories/').status_code, status.HTTP_403_FORBIDDEN)
+
+        # A Permission write reaches the cached matrix without waiting for the interval
+        with self.captureOnCommitCallbacks() as callbacks:
+            Permission.objects.create(role=self.teacher_role, method='GET', path='/categories/', module='category')
+        # Not before commit: a concurrent reload would still see the old rows
+        self.assertEqual(self.client.get('/categories/').status_code, status.HTTP_403_FORBIDDEN)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.client.get('/categories/').status_code, status.HTTP_200_OK)
+
+    def test_matrix_is_not_enforced_by_default(self):
+        self.client.force_authenticate(self.teacher)
+        self.assertEqual(self.client.get('/categories/').status_code, status.HTTP_200_OK)
+
+
+class AccessTokenCacheTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.teacher_role, _ = Role.objects.get_or_create(name='Teacher')
+        self.teacher = User.objects.create(username='cached_teacher', email='cached_teacher@test.com',
+                                           user_role=self.teacher_role)
+        self.app = Application.objects.create(name='Cache App', client_type=Application.CLIENT_CONFIDENTIAL,
+                                              authorization_grant_type=Application.GRANT_PASSWORD)
+        self.token = AccessToken.objects.create(user=self.teacher, application=self.app, token='cached-token',
+                                                expires=timezone.now() + timedelta(hours=1), scope='read write')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer cached-token')
+
+    def test_token_is_served_from_cache(self):
+        self.assertEqual(self.client.get('/forums/').status_code, status.HTTP_200_OK)
+        # Only the forum listing hits the database
+        with self.assertNumQueries(1):
+            response = self.client.get('/forums/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_cache_holds_no_secrets(self):
+        self.teacher.set_password('secret-pass')
+        self.teacher.save()
+        self.assertEqual(self.client.get('/forums/').status_code, status.HTTP_200_OK)
+        cached = caches['auth'].get(token_cache_key(self.token.token_checksum))
+        self.assertNotIn(self.teacher.password, repr(cached))
+        self.assertNotIn(self.app.client_secret, repr(cached))
+        self.assertNotIn('cached-token', repr(cached))
+
+        # The cached user is light but still serves the full profile
+        response = self.client.get('/users/current-user/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['email'], response.data['user_role']), ('cached_teacher@test.com', 'Teacher'))
+
+    def test_revoked_token_is_rejected(self):
+        self.assertEqual(self.client.get('/forums/').status_code, status.HTTP_200_OK)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.delete()
+        self.assertEqual(self.client.get('/forums/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_role_change_reaches_cached_token(self):
+        self.assertEqual(self.client.get('/forums/').status_code, status.HTTP_200_OK)
+        self.teacher.user_role, _ = Role.objects.get_or_create(name='Student')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.teacher.save()
+        self.assertEqual(self.client.post('/courses/', {'name': 'Course'}).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_last_login_update_leaves_cached_tokens_alone(self):
+        self.teacher.last_login = timezone.now()
+        # Only the UPDATE itself: no token, lecturer or catalog work
+        with self.captureOnCommitCallbacks() as callbacks, self.assertNumQueries(1):
+            self.teacher.save(update_fields=['last_login'])
+        self.assertEqual(callbacks, [])
+
+
+def make_signing_cert():
+    """RSA key and self-signed certificate standing in for one of Google's signing keys"""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'test-google')])
+    now = timezone.now()
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number()).not_valid_before(now - timedelta(days=1))
+            .not_valid_after(now + timedelta(days=1)).sign(key, hashes.SHA256()))
+    private_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+    return private_pem, cert.public_bytes(serialization.Encoding.PEM).decode()
+
+
+class FakeCertsSession:
+    def __init__(self, certs, max_age=3600):
+        self.certs = certs
+        self.max_age = max_age
+        self.calls = 0
+
+    def get(self, url, timeout=None):
+        self.calls += 1
+        response = MagicMock()
+        response.json.return_value = dict(self.certs)
+        response.headers = {'Cache-Control': f'public, max-age={self.max_age}, must-revalidate'}
+        return response
+
+
+class GoogleTokenVerifierTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.private_pem, cls.cert_pem = make_signing_cert()
+
+    def make_token(self, key_id='key-1', **claims):
+        from google.auth import crypt, jwt
+        now = int(timezone.now().timestamp())
+        payload = {'iss': 'https://accounts.google.com', 'aud': 'client-id', 'email': 'google@test.com',
+                   'iat': now, 'exp': now + 600, **claims}
+        return jwt.encode(crypt.RSASigner.from_string(self.private_pem, key_id=key_id), payload).decode()
+
+    def test_certs_are_fetched_once_and_reused(self):
+        session = FakeCertsSession({'key-1': self.cert_pem})
+        verifier = GoogleTokenVerifier('http://certs.local/', session=session)
+        for _ in range(3):
+            self.assertEqual(verifier.verify(self.make_token(), audience='client-id')['email'], 'google@test.com')
+        self.assertEqual(session.calls, 1)
+
+    def test_certs_are_refetched_after_max_age(self):
+        session = FakeCertsSession({'key-1': self.cert_pem}, max_age=0)
+        verifier = GoogleTokenVerifier('http://certs.local/', session=session)
+        verifier.verify(self.make_token(), audience='client-id')
+        verifier.verify(self.make_token(), audience='client-id')
+        self.assertEqual(session.calls, 2)
+
+    def test_unknown_key_triggers_one_refresh(self):
+        session = FakeCertsSession({'key-1': self.cert_pem})
+        verifier = GoogleTokenVerifier('http://certs.local/', session=session, refresh_interval=0)
+        verifier.verify(self.make_token(), audience='client-id')
+        # Google rotated its keys
+        session.certs = {'key-2': self.cert_pem}
+        self.assertEqual(verifier.verify(self.make_token(key_id='key-2'), audience='client-id')['aud'], 'client-id')
+        self.assertEqual(session.calls, 2)
+
+    def test_wrong_audience_and_issuer_are_rejected(self):
+        verifier = GoogleTokenVerifier('http://certs.local/', session=FakeCertsSession({'key-1': self.cert_pem}))
+        with self.assertRaises(ValueError):
+            verifier.verify(self.make_token(), audience='other-client')
+        with self.assertRaises(ValueError):
+            verifier.verify(self.make_token(iss='https://evil.example.com'), audience='client-id')
+
+
+class PurgeExpiredTokensTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='token_owner', email='token_owner@test.com')
+        self.app = Application.objects.create(name='Purge App', client_type=Application.CLIENT_CONFIDENTIAL,
+                                              authorization_grant_type=Application.GRANT_PASSWORD)
+
+    def create_token(self, name, expires_in, with_refresh=False):
+        token = AccessToken.objects.create(user=self.user, application=self.app, token=name, scope='read',
+                                           expires=timezone.now() + expires_in)
+        if with_refresh:
+            RefreshToken.objects.create(user=self.user, application=self.app, token=f'refresh-{name}',
+                                        access_token=token)
+        return token
+
+    def test_expired_tokens_are_purged_in_batches(self):
+        for i in range(5):
+            self.create_token(f'expired-{i}', -timedelta(hours=1))
+        live = self.create_token('live', timedelta(hours=1))
+        refreshable = self.create_token('refreshable', -timedelta(hours=1), with_refresh=True)
+        stale = self.create_token('stale', -timedelta(days=60), with_refresh=True)
+
+        out = StringIO()
+        call_command('purge_expired_tokens', batch_size=2, sleep=0, stdout=out)
+
+        self.assertEqual(set(AccessToken.objects.values_list('pk', flat=True)), {live.pk, refreshable.pk})
+        self.assertEqual(list(RefreshToken.objects.values_list('token', flat=True)), ['refresh-refreshable'])
+        self.assertIn('Deleted 1 refresh tokens', out.getvalue())
+        self.assertIn('Deleted 6 access tokens', out.getvalue())
+        self.assertFalse(AccessToken.objects.filter(pk=stale.pk).exists())
+
+    def test_dry_run_keeps_rows(self):
+        self.create_token('expired', -timedelta(hours=1))
+        out = StringIO()
+        call_command('purge_expired_tokens', dry_run=True, stdout=out)
+        self.assertIn('1 access tokens would be deleted', out.getvalue())
+        self.assertEqual(AccessToken.objects.count(), 1)
+
+
+class ConnectionProfileTests(TestCase):
+    def test_profiles(self):
+        self.assertEqual(connection_profile('default')['CONN_MAX_AGE'], 0)
+
+        persistent = connection_profile('persistent', conn_max_age=120)
+        self.assertEqual((persistent['CONN_MAX_AGE'], persistent['CONN_HEALTH_CHECKS']), (120, True))
+        self.assertFalse(persistent['DISABLE_SERVER_SIDE_CURSORS'])
+        self.assertTrue(connection_profile('pgbouncer')['DISABLE_SERVER_SIDE_CURSORS'])
+
+        with self.assertRaises(ValueError):
+            connection_profile('bogus')
+
+
+class PasswordResetTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='forgetful', email='forgetful@test.com', password='old-pass')
+        caches['auth'].clear()
+
+    def test_otp_is_bound_to_the_email(self):
+        caches['auth'].set('otp:forgetful@test.com', '123456')
+        response = self.client.post('/verify-otp/', {'email': 'other@test.com', 'otp': '123456'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post('/verify-otp/', {'otp': '123456'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_malformed_input_is_rejected(self):
+        caches['auth'].set('otp:forgetful@test.com', '123456')
+        response = self.client.post('/forget-password/', {'email': ['forgetful@test.com']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post('/verify-otp/', {'email': 'forgetful@test.com', 'otp': '12345é'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post('/verify-otp/', {'email': {'a': 1}, 'otp': 123456}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post('/reset-password/', {'email': 7, 'password': 'x'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(AUTH_RATE_LIMITS={**settings.AUTH_RATE_LIMITS, 'otp_verify_email': (2, 600)})
+    def test_otp_guesses_are_rate_limited(self):
+        caches['auth'].set('otp:forgetful@test.com', '123456')
+        for guess in ('000000', '111111'):
+            response = self.client.post('/verify-otp/', {'email': 'forgetful@test.com', 'otp': guess})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        # Even the right code is refused once the limit is reached
+        response = self.client.post('/verify-otp/', {'email': 'forgetful@test.com', 'otp': '123456'})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+
+    @override_settings(AUTH_RATE_LIMITS={**settings.AUTH_RATE_LIMITS, 'otp_verify_ip': (2, 3600)})
+    def test_spoofed_forwarded_for_does_not_reset_the_ip_limit(self):
+        for i in range(2):
+            response = self.client.post('/verify-otp/', {'email': f'guess{i}@test.com', 'otp': '000000'},
+                                        HTTP_X_FORWARDED_FOR=f'203.0.113.{i}')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post('/verify-otp/', {'email': 'guess9@test.com', 'otp': '000000'},
+                                    HTTP_X_FORWARDED_FOR='203.0.113.9')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_otp_emails_are_rate_limited_before_enqueueing(self):
+        for _ in range(3):
+            self.client.post('/forget-password/', {'email': 'forgetful@test.com'})
+        response = self.client.post('/forget-password/', {'email': 'FORGETFUL@test.com'})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(EmailOutbox.objects.count(), 3)
+
+    def test_reset_flow_uses_the_shared_auth_cache(self):
+        from django.core import mail
+        self.client.post('/forget-password/', {'email': 'forgetful@test.com'})
+        call_command('send_outbox_emails', stdout=StringIO())
+        otp = mail.outbox[-1].body.split('Your OTP code is: ')[1][:6]
+        self.assertEqual(caches['auth'].get('otp:forgetful@test.com'), otp)
+        self.assertIsNone(cache.get('otp:forgetful@test.com'))
+
+        response = self.client.post('/verify-otp/', {'email': 'Forgetful@test.com', 'otp': otp})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post('/reset-password/', {'email': 'forgetful@test.com', 'password': 'new-pass'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('new-pass'))
+
+
+@override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2, EMAIL_OUTBOX_RECIPIENT_LIMIT=2)
+class EmailOutboxTests(TestCase):
+    def test_forget_password_only_enqueues(self):
+        from django.core import mail
+        response = APIClient().post('/forget-password/', {'email': 'queued@test.com'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(EmailOutbox.objects.get().status, EmailStatus.PENDING)
+
+        out = StringIO()
+        call_command('send_outbox_emails', stdout=out)
+        self.assertEqual(mail.outbox[0].to, ['queued@test.com'])
+        self.assertEqual(EmailOutbox.objects.get().status, EmailStatus.SENT)
+        self.assertIn('Sent 1', out.getvalue())
+
+    def test_failures_back_off_then_fail(self):
+        email = mailer.enqueue_email('broken@test.com', 'Subject', 'Body')
+        with patch('courses.services.mailer.EmailMessage.send', side_effect=OSError('SMTP down')):
+            mailer.deliver_pending()
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts, email.last_error), (EmailStatus.PENDING, 1, 'SMTP down'))
+            self.assertGreater(email.next_attempt_at, timezone.now())
+
+            # Not due yet
+            self.assertEqual(mailer.deliver_pending(), (0, 0, 0, 0))
+            EmailOutbox.objects.update(next_attempt_at=timezone.now())
+            self.assertEqual(mailer.deliver_pending(), (0, 0, 1, 0))
+        email.refresh_from_db()
+        self.assertEqual(email.status, EmailStatus.FAILED)
+
+    def test_unreachable_smtp_server_counts_an_attempt(self):
+        email = mailer.enqueue_email('offline@test.com', 'Subject', 'Body')
+        with patch('django.core.mail.backends.locmem.EmailBackend.open',
+                   side_effect=ConnectionRefusedError('Connection refused'), create=True):
+            out = StringIO()
+            call_command('send_outbox_emails', stdout=out)
+        self.assertIn('retrying 1', out.getvalue())
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (EmailStatus.PENDING, 1))
+        self.assertIn('Connection refused', email.last_error)
+        self.assertGreater(email.next_attempt_at, timezone.now())
+
+    def test_recipient_rate_limit_defers_extra_emails(self):
+        from django.core import mail
+        for i in range(3):
+            mailer.enqueue_email('busy@test.com', f'Subject {i}', 'Body')
+        mailer.enqueue_email('calm@test.com', 'Subject', 'Body')
+
+        self.assertEqual(mailer.deliver_pending(), (3, 0, 0, 1))
+        self.assertEqual(len(mail.outbox), 3)
+        deferred = EmailOutbox.objects.get(status=EmailStatus.PENDING)
+        self.assertEqual(deferred.to_email, 'busy@test.com')
+        self.assertGreater(deferred.next_attempt_at, timezone.now())
+
+    def test_otp_mail_skips_the_recipient_limit_and_expires(self):
+        from django.core import mail
+        for i in range(3):
+            mailer.enqueue_email('busy@test.com', f'Receipt {i}', 'Body')
+        mailer.enqueue_email('busy@test.com', 'OTP', 'Body', expires_in=180)
+        stale = mailer.enqueue_email('busy@test.com', 'Old OTP', 'Body', expires_in=180)
+        EmailOutbox.objects.filter(pk=stale.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        # Receipt 2 is deferred, the fresh OTP goes out, the stale one is dropped unsent
+        self.assertEqual(mailer.deliver_pending(), (3, 0, 1, 1))
+        self.assertCountEqual([m.subject for m in mail.outbox], ['Receipt 0', 'Receipt 1', 'OTP'])
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, EmailStatus.EXPIRED)
+
+    @override_settings(DEFAULT_FROM_EMAIL='courses@school.test')
+    def test_claimed_emails_are_leased_and_sent_outside_the_transaction(self):
+        email = mailer.enqueue_email('leased@test.com', 'Subject', 'Body')
+        self.assertEqual(email.from_email, 'courses@school.test')
+
+        claimed, deferred, expired = mailer.claim_batch(10, timezone.now())
+        self.assertEqual(([e.pk for e in claimed], deferred, expired), ([email.pk], [], []))
+        email.refresh_from_db()
+        self.assertEqual(email.attempts, 1)
+        self.assertGreater(email.next_attempt_at, timezone.now())
+        # Another worker finds nothing due while the lease runs
+        self.assertEqual(mailer.deliver_pending(), (0, 0, 0, 0))
+
+        # TestCase already wraps the test in atomic blocks; sending must not open another one
+        depth = len(connection.atomic_blocks)
+        depths = []
+        with patch('courses.services.mailer.EmailMessage.send', autospec=True,
+                   side_effect=lambda message: depths.append(len(connection.atomic_blocks))):
+            EmailOutbox.objects.update(next_attempt_at=timezone.now())
+            self.assertEqual(mailer.deliver_pending(), (1, 0, 0, 0))
+        self.assertEqual(depths, [depth])
+
+
+class FailingUploadBackend:
+    def upload(self, path, folder):
+        raise ConnectionError('storage unavailable')
+
+
+class RecordingUploadBackend:
+    """Notes how many atomic blocks are open while the network call would run"""
+    atomic_depths = []
+    during_upload = None
+
+    def upload(self, path, folder):
+        self.atomic_depths.append(len(connection.atomic_blocks))
+        if self.during_upload:
+            self.during_upload()
+        return f'/media/{folder}/{os.path.basename(path)}'
+
+
+class BackgroundUploadTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        overrides = override_settings(
+            UPLOAD_BACKEND='courses.services.uploads.LocalBackend',
+            UPLOAD_STAGING_DIR=os.path.join(self.tmp, 'staging'),
+            UPLOAD_LOCAL_DIR=os.path.join(self.tmp, 'media'),
+            UPLOAD_MAX_ATTEMPTS=2,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.user = User.objects.create_user(username='uploader', email='uploader@test.com', password='pass')
+
+    def avatar_file(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        return SimpleUploadedFile('me.png', b'\x89PNG fake image', content_type='image/png')
+
+    def test_avatar_is_staged_then_uploaded_by_the_worker(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.patch('/users/current-user/', {'avatar': self.avatar_file()}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        upload = PendingUpload.objects.get()
+        self.assertTrue(os.path.exists(upload.staged_path))
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.avatar)
+
+        call_command('process_uploads', stdout=StringIO())
+        upload.refresh_from_db()
+        self.user.refresh_from_db()
+        self.assertEqual(upload.status, UploadStatus.DONE)
+        self.assertFalse(os.path.exists(upload.staged_path))
+        self.assertTrue(upload.result_url.startswith('/media/avatars/'))
+        self.assertIn(str(self.user.avatar), upload.result_url)
+
+    def test_new_upload_supersedes_a_pending_one(self):
+        self.client.force_authenticate(self.user)
+        self.client.patch('/users/current-user/', {'avatar': self.avatar_file()}, format='multipart')
+        first = PendingUpload.objects.get()
+        self.client.patch('/users/current-user/', {'avatar': self.avatar_file()}, format='multipart')
+        self.assertEqual(PendingUpload.objects.exclude(pk=first.pk).count(), 1)
+        self.assertFalse(PendingUpload.objects.filter(pk=first.pk).exists())
+        self.assertFalse(os.path.exists(first.staged_path))
+
+    def stage(self, name):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as staged:
+            staged.write(b'image')
+        return path
+
+    def test_upload_runs_outside_any_transaction(self):
+        uploads.enqueue_upload(self.user, 'avatar', self.stage('outside.png'), 'avatars')
+        RecordingUploadBackend.atomic_depths = []
+        baseline = len(connection.atomic_blocks)  # the test case's own transaction
+        with override_settings(UPLOAD_BACKEND='courses.tests.RecordingUploadBackend'):
+            self.assertEqual(uploads.process_pending(), (1, 0, 0))
+        self.assertEqual(RecordingUploadBackend.atomic_depths, [baseline])
+
+    def test_upload_replaced_while_in_flight_is_not_applied(self):
+        uploads.enqueue_upload(self.user, 'avatar', self.stage('old.png'), 'avatars')
+        newer_path = self.stage('new.png')
+        RecordingUploadBackend.during_upload = staticmethod(
+            lambda: uploads.enqueue_upload(self.user, 'avatar', newer_path, 'avatars'))
+        self.addCleanup(setattr, RecordingUploadBackend, 'during_upload', None)
+        with override_settings(UPLOAD_BACKEND='courses.tests.RecordingUploadBackend'):
+            self.assertEqual(uploads.process_pending(), (0, 0, 0))
+
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.avatar)
+        self.assertEqual(PendingUpload.objects.get().staged_path, newer_path)
+
+    def test_failed_uploads_are_retried_then_given_up(self):
+        with open(os.path.join(self.tmp, 'staged.png'), 'wb') as staged:
+            staged.write(b'image')
+        upload = uploads.enqueue_upload(self.user, 'avatar', staged.name, 'avatars')
+
+        with override_settings(UPLOAD_BACKEND='courses.tests.FailingUploadBackend'):
+            self.assertEqual(uploads.process_pending(), (0, 1, 0))
+            PendingUpload.objects.update(next_attempt_at=timezone.now())
+            self.assertEqual(uploads.process_pending(), (0, 0, 1))
+
+        upload.refresh_from_db()
+        self.assertEqual((upload.status, upload.last_error), (UploadStatus.FAILED, 'storage unavailable'))
+        self.assertFalse(os.path.exists(staged.name))
+
+
+class StandInMomoHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the MoMo API; answers from the server's `responses` script"""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.received.append(body)
+        delay, code, *content = self.server.responses.pop(0) if self.server.responses else (0, 200)
+        time.sleep(delay)
+        payload = content[0] if content else json.dumps(
+            {'payUrl': f"http://momo.test/pay/{body['orderId']}", 'resultCode': 0}).encode()
+        try:
+            self.send_response(code)
+            self.send_header('Content-Type', 'text/html' if content else 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class MomoGatewayTests(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInMomoHandler)
+        self.server.received = []
+        self.server.responses = []
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def gateway(self, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        return momo.MomoGateway(self.base_url, **kwargs)
+
+    def test_retries_reuse_the_request_id(self):
+        # Read timeout, then a 503, then success
+        self.server.responses = [(0.5, 200), (0, 503)]
+        result = self.gateway(read_timeout=0.2).create_payment('order-1', 'request-1', 50000, 7)
+
+        self.assertEqual(result['payUrl'], 'http://momo.test/pay/order-1')
+        self.assertEqual(len(self.server.received), 3)
+        self.assertEqual({body['requestId'] for body in self.server.received}, {'request-1'})
+
+    def test_circuit_breaker_fails_fast(self):
+        self.server.responses = [(0, 503)] * 10
+        gateway = self.gateway(max_retries=0, breaker=momo.CircuitBreaker(failure_threshold=2, reset_timeout=60))
+        for _ in range(2):
+            with self.assertRaises(momo.GatewayUnavailable):
+                gateway.create_payment(str(uuid.uuid4()), str(uuid.uuid4()), 50000, 7)
+
+        with self.assertRaises(momo.GatewayUnavailable):
+            gateway.create_payment('order-blocked', 'request-blocked', 50000, 7)
+        self.assertEqual(len(self.server.received), 2)
+
+    def test_half_open_breaker_closes_after_a_success(self):
+        breaker = momo.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        self.server.responses = [(0, 503)]
+        gateway = self.gateway(max_retries=0, breaker=breaker)
+        with self.assertRaises(momo.GatewayUnavailable):
+            gateway.create_payment('order-1', 'request-1', 50000, 7)
+        self.assertEqual(gateway.create_payment('order-2', 'request-2', 50000, 7)['resultCode'], 0)
+        self.assertIsNone(breaker.opened_at)
+
+    def test_non_json_answer_in_half_open_state_reopens_the_breaker(self):
+        breaker = momo.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        self.server.responses = [(0, 503), (0, 403, b'<html>Forbidden</html>')]
+        gateway = self.gateway(max_retries=0, breaker=breaker)
+        with self.assertRaises(momo.GatewayUnavailable):
+            gateway.create_payment('order-1', 'request-1', 50000, 7)
+
+        # The trial call gets an HTML page: a gateway error, not a stuck trial
+        with self.assertRaises(momo.GatewayUnavailable):
+            gateway.create_payment('order-2', 'request-2', 50000, 7)
+        self.assertFalse(breaker.trial_running)
+        self.assertEqual(gateway.create_payment('order-3', 'request-3', 50000, 7)['resultCode'], 0)
+
+    def test_async_variant(self):
+        result = asyncio.run(self.gateway().acreate_payment('order-async', 'request-async', 50000, 7))
+        self.assertEqual(result['payUrl'], 'http://momo.test/pay/order-async')
+
+
+def signed_momo_result(**values):
+    data = {
+        'partnerCode': 'MOMO', 'orderInfo': 'pay with MoMo', 'orderType': 'momo_wallet', 'payType': 'qr',
+        'message': 'Successful.', 'requestId': 'request-1', 'responseTime': 1700000000000, 'amount': 50000,
+        'resultCode': 0, 'transId': 4100000001, **values
+    }
+    raw = 'accessKey=' + momo.accessKey + ''.join(
+        f'&{field}={data.get(field)}' for field in momo.RESULT_SIGNATURE_FIELDS)
+    data['signature'] = hmac.new(momo.secretKey.encode(), raw.encode(), hashlib.sha256).hexdigest()
+    return data
+
+
+class MomoIPNTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.student = User.objects.create(username='ipn_student', email='ipn_student@test.com')
+        self.course = Course.objects.create(name='IPN Course', price=50000, image='sample')
+        self.enrollment = UserCourse.objects.create(user=self.student, course=self.course)
+        self.payment = Payment.objects.create(id=str(uuid.uuid4()), user=self.student, course=self.course,
+                                              amount=50000)
+
+    def ipn(self, **values):
+        data = signed_momo_result(orderId=self.payment.id, extraData=str(self.enrollment.id), **values)
+        return self.client.post('/payment/momo/ipn/', data, format='json')
+
+    def test_success_is_applied_once(self):
+        self.assertEqual(self.ipn().data['message'], 'Payment success')
+        self.payment.refresh_from_db()
+        self.enrollment.refresh_from_db()
+        self.assertEqual(self.payment.status, PaymentStatus.SUCCESS)
+        self.assertEqual(self.enrollment.status, CourseStatus.IN_PROGRESS)
+
+        # A retried IPN is one ledger lookup
+        with self.assertNumQueries(1):
+            response = self.ipn()
+        self.assertEqual(response.data['message'], 'Payment already processed')
+        self.assertEqual(PaymentNotification.objects.count(), 1)
+
+    def test_failure_releases_the_student_seat(self):
+        self.course.refresh_from_db()
+        self.assertEqual(self.course.student_count, 1)
+
+        self.assertEqual(self.ipn(resultCode=1006, transId=0).data['message'], 'Payment failed')
+        self.enrollment.refresh_from_db()
+        self.course.refresh_from_db()
+        self.assertEqual(self.enrollment.status, CourseStatus.PAYMENT_FAILED)
+        self.assertEqual(self.course.student_count, 0)
+
+    def test_late_result_does_not_override_a_final_payment(self):
+        self.ipn()
+        # A different transaction for an order that is already settled
+        self.assertEqual(self.ipn(resultCode=1006, transId=4100000002).data['message'], 'Payment already processed')
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, PaymentStatus.SUCCESS)
+
+    def test_invalid_signature_is_rejected(self):
+        data = signed_momo_result(orderId=self.payment.id, extraData=str(self.enrollment.id))
+        data['amount'] = 1
+        response = self.client.post('/payment/momo/ipn/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(PaymentNotification.objects.exists())
+
+    def test_callback_after_ipn_only_redirects(self):
+        self.ipn()
+        data = signed_momo_result(orderId=self.payment.id, extraData=str(self.enrollment.id))
+        response = self.client.get('/payment/momo/callback/', data)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith('status=success'))
+        self.assertEqual(PaymentNotification.objects.count(), 1)
+
+    def second_order(self):
+        return Payment.objects.create(id=str(uuid.uuid4()), user=self.student, course=self.course, amount=50000)
+
+    def assert_activated_once(self):
+        self.enrollment.refresh_from_db()
+        self.course.refresh_from_db()
+        self.assertEqual(self.enrollment.status, CourseStatus.IN_PROGRESS)
+        self.assertEqual(self.course.student_count, 1)
+        self.assertEqual(OutboxEvent.objects.filter(event_type=outbox.ENROLLMENT_ACTIVATED).count(), 1)
+
+    def test_paid_order_after_a_failed_one_activates_the_enrollment(self):
+        retry = self.second_order()
+        momo.apply_payment_result(self.payment.pk, self.enrollment.pk, 0, 1005, 'ipn')
+        self.enrollment.refresh_from_db()
+        # The second order is still open: the enrollment waits for it
+        self.assertEqual(self.enrollment.status, CourseStatus.PENDING)
+
+        self.assertEqual(momo.apply_payment_result(retry.pk, self.enrollment.pk, 4100000009, 0, 'ipn'), momo.APPLIED)
+        self.assert_activated_once()
+
+    def test_paid_order_reopens_a_payment_failed_enrollment(self):
+        momo.apply_payment_result(self.payment.pk, self.enrollment.pk, 0, 1005, 'ipn')
+        self.enrollment.refresh_from_db()
+        self.assertEqual(self.enrollment.status, CourseStatus.PAYMENT_FAILED)
+
+        retry = self.second_order()
+        momo.apply_payment_result(retry.pk, self.enrollment.pk, 4100000009, 0, 'ipn')
+        self.assert_activated_once()
+
+    def test_failed_order_after_a_paid_one_changes_nothing(self):
+        retry = self.second_order()
+        momo.apply_payment_result(retry.pk, self.enrollment.pk, 4100000009, 0, 'ipn')
+        momo.apply_payment_result(self.payment.pk, self.enrollment.pk, 0, 1005, 'ipn')
+        self.assert_activated_once()
+
+    def test_reconciler_settles_mixed_orders_of_one_enrollment(self):
+        retry = self.second_order()
+        self.assertEqual(momo.settle_payments({self.payment.pk: (1005, None), retry.pk: (0, 4100000009)},
+                                              'reconcile'), (1, 1))
+        self.assert_activated_once()
+
+    def test_activation_side_effects_run_in_the_outbox_worker(self):
+        self.ipn()
+        self.ipn()
+        # The webhook only records the event
+        self.assertEqual(OutboxEvent.objects.filter(event_type=outbox.ENROLLMENT_ACTIVATED).count(), 1)
+        self.assertFalse(CourseProgress.objects.exists())
+        self.assertFalse(EmailOutbox.objects.exists())
+
+        call_command('process_outbox_events', stdout=StringIO())
+        progress = CourseProgress.objects.get(user=self.student, course=self.course)
+        self.assertEqual(progress.total_lessons, self.course.lessons_count)
+        receipt = EmailOutbox.objects.get(to_email='ipn_student@test.com')
+        self.assertIn(self.payment.id, receipt.body)
+        self.assertIsNotNone(OutboxEvent.objects.get().processed_at)
+
+        # Nothing is left to do on the next run
+        call_command('process_outbox_events', stdout=StringIO())
+        self.assertEqual(EmailOutbox.objects.count(), 1)
+
+    def test_failed_outbox_batch_is_retried(self):
+        self.ipn()
+        with patch.dict(outbox.HANDLERS, {outbox.ENROLLMENT_ACTIVATED: MagicMock(side_effect=RuntimeError('down'))}):
+            self.assertEqual(outbox.process_pending(), (0, 1))
+        event = OutboxEvent.objects.get()
+        self.assertIsNone(event.processed_at)
+        self.assertEqual((event.attempts, event.last_error), (1, 'down'))
+
+        self.assertEqual(outbox.process_pending(), (1, 0))
+        self.assertTrue(CourseProgress.objects.filter(user=self.student, course=self.course).exists())
+
+
+class PaymentReconciliationTests(TestCase):
+    def setUp(self):
+        self.course = Course.objects.create(name='Reconciled Course', price=50000)
+        self.answers = {}
+        self.payments = {}
+        for name in ('paid', 'declined', 'processing', 'fresh'):
+            student = User.objects.create(username=f'reconcile_{name}', email=f'{name}@test.com')
+            UserCourse.objects.create(user=student, course=self.course)
+            self.payments[name] = Payment.objects.create(id=str(uuid.uuid4()), user=student, course=self.course,
+                                                         amount=50000)
+        Payment.objects.exclude(pk=self.payments['fresh'].pk).update(created_at=timezone.now() - timedelta(hours=1))
+
+    def query_payment(self, order_id, request_id):
+        answer = self.answers[order_id]
+        if isinstance(answer, Exception):
+            raise answer
+        return {'orderId': order_id, 'resultCode': answer, 'transId': 4200000000 + answer}
+
+    def reconcile(self):
+        out = StringIO()
+        with patch('courses.services.momo.MomoGateway.query_payment', side_effect=self.query_payment) as query:
+            call_command('reconcile_payments', batch_size=2, stdout=out)
+        return query, out.getvalue()
+
+    def enrollment_status(self, name):
+        payment = self.payments[name]
+        return UserCourse.objects.get(user_id=payment.user_id, course=self.course).status
+
+    def test_stale_payments_are_settled(self):
+        self.answers = {self.payments['paid'].pk: 0, self.payments['declined'].pk: 1006,
+                        self.payments['processing'].pk: 7000}
+        query, output = self.reconcile()
+
+        # Fresh payments are left to their IPN
+        self.assertEqual(query.call_count, 3)
+        self.assertIn('Checked 3 payments', output)
+        self.assertIn('1 paid, 1 failed, 1 still pending', output)
+
+        statuses = dict(Payment.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses[self.payments['paid'].pk], PaymentStatus.SUCCESS)
+        self.assertEqual(statuses[self.payments['declined'].pk], PaymentStatus.FAILED)
+        self.assertEqual(statuses[self.payments['processing'].pk], PaymentStatus.PENDING)
+        self.assertEqual(self.enrollment_status('paid'), CourseStatus.IN_PROGRESS)
+        self.assertEqual(self.enrollment_status('declined'), CourseStatus.PAYMENT_FAILED)
+        self.assertEqual(self.enrollment_status('processing'), CourseStatus.PENDING)
+
+        self.course.refresh_from_db()
+        self.assertEqual(self.course.student_count, 3)
+        self.assertEqual(OutboxEvent.objects.filter(event_type=outbox.ENROLLMENT_ACTIVATED).count(), 1)
+
+        # A late IPN for a reconciled order changes nothing
+        self.assertEqual(momo.apply_payment_result(self.payments['paid'].pk, '0', 4200000000, 0, 'ipn'),
+                         momo.DUPLICATE)
+
+    def test_unanswered_queries_stay_pending(self):
+        self.answers = {self.payments['paid'].pk: momo.GatewayUnavailable('timeout'),
+                        self.payments['declined'].pk: 13, self.payments['processing'].pk: 1000}
+        _, output = self.reconcile()
+
+        self.assertIn('0 paid, 0 failed, 2 still pending, 1 not answered', output)
+        self.assertEqual(Payment.objects.filter(status=PaymentStatus.PENDING).count(), 4)
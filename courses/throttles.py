@@ -0,0 +1,74 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+
+
+def hit(key, limit, window):
+    """
+    Count one request against `limit` per `window` seconds; returns (allowed, retry_after).
+    Fixed windows counted with an atomic cache increment, so concurrent workers cannot
+    over-admit, and each counter expires with its window.
+    """
+    cache = caches['auth']
+    now = time.time()
+    key = f'ratelimit:{key}:{int(now // window)}'
+    if cache.add(key, 1, timeout=window):
+        count = 1
+    else:
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # Expired between add() and incr()
+            cache.add(key, 1, timeout=window)
+            count = 1
+    return count <= limit, window - now % window
+
+
+class AuthRateThrottle(BaseThrottle):
+    """Limits from settings.AUTH_RATE_LIMITS[scope] = (requests, seconds)"""
+    scope = None
+
+    def get_ident_key(self, request):
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        ident = self.get_ident_key(request)
+        if not ident:
+            return True
+        limit, window = settings.AUTH_RATE_LIMITS[self.scope]
+        digest = hashlib.sha1(ident.encode('utf-8')).hexdigest()
+        allowed, self.retry_after = hit(f'{self.scope}:{digest}', limit, window)
+        return allowed
+
+    def wait(self):
+        return self.retry_after
+
+
+class EmailRateThrottle(AuthRateThrottle):
+    def get_ident_key(self, request):
+        email = request.data.get('email')
+        return email.strip().lower() if isinstance(email, str) else None
+
+
+class IPRateThrottle(AuthRateThrottle):
+    def get_ident_key(self, request):
+        return self.get_ident(request)
+
+
+class OTPSendEmailThrottle(EmailRateThrottle):
+    scope = 'otp_send_email'
+
+
+class OTPSendIPThrottle(IPRateThrottle):
+    scope = 'otp_send_ip'
+
+
+class OTPVerifyEmailThrottle(EmailRateThrottle):
+    scope = 'otp_verify_email'
+
+
+class OTPVerifyIPThrottle(IPRateThrottle):
+    scope = 'otp_verify_ip'
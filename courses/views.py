@@ -5,40 +5,61 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
 from rest_framework.views import APIView
-import hmac, hashlib
+import hmac
 from courses.models import Category, Course, User, Role, UserCourse, Forum, Comment, Chapter, Lesson, CourseStatus, \
-    Payment, PaymentStatus, Topic, LessonProgress, LessonProgressStatus, CourseProgress
-from .perms import IsAdmin, IsStudent, IsTeacher, IsTeacherOrAdmin
-from .services.momo import create_momo_payment, update_status_user_course
+    Topic, LessonProgress, LessonProgressStatus, CourseProgress
+from .perms import IsAdmin, IsStudent, IsTeacher, IsTeacherOrAdmin, PermissionMatrixMixin
+from .throttles import OTPSendEmailThrottle, OTPSendIPThrottle, OTPVerifyEmailThrottle, OTPVerifyIPThrottle
+from .services import momo, reconciliation
+from .services.momo import GatewayUnavailable, apply_payment_result, create_momo_payment, verify_result_signature
+from .services import course_detail
+from .services import progress as progress_service
+from .services import progress_buffer
+from .services import tokens
+from .services import mailer
 from rest_framework.exceptions import PermissionDenied
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 from django.db.models import Prefetch
 from courses import serializers, paginators
-from django.core.cache import cache
-from django.core.mail import send_mail
-import random
+from courses import cache as catalog_cache
+from django.core.cache import caches
+import secrets
 from .social_auth import verify_google_token
-from oauth2_provider.models import Application, AccessToken, RefreshToken
+from oauth2_provider.settings import oauth2_settings
 from django.utils import timezone
-from oauthlib.common import generate_token
 from django.conf import settings
+import logging
 
+auth_logger = logging.getLogger('courses.auth')
+# OTPs and reset verification must be shared by all workers
+auth_cache = caches['auth']
 
-class CategoryViewSet(viewsets.ViewSet, generics.ListAPIView):
+
+class CategoryViewSet(PermissionMatrixMixin, viewsets.ViewSet, generics.ListAPIView):
     queryset = Category.objects.filter(active=True)
     serializer_class = serializers.CategorySerializer
 
+    def list(self, request, *args, **kwargs):
+        return catalog_cache.cached_response(request, catalog_cache.CATEGORIES,
+                                             lambda: super(CategoryViewSet, self).list(request, *args, **kwargs))
+
 
-class TeacherViewSet(viewsets.ViewSet, generics.ListAPIView):
+class TeacherViewSet(PermissionMatrixMixin, viewsets.ViewSet, generics.ListAPIView):
     queryset = User.objects.filter(user_role__name__iexact="Teacher")
     serializer_class = serializers.TeacherSerializer
 
+    def list(self, request, *args, **kwargs):
+        return catalog_cache.cached_response(request, catalog_cache.TEACHERS,
+                                             lambda: super(TeacherViewSet, self).list(request, *args, **kwargs))
+
 
-class CourseViewSet(viewsets.ModelViewSet):
+class CourseViewSet(PermissionMatrixMixin, viewsets.ModelViewSet):
     queryset = Course.objects.filter(active=True)
     serializer_class = serializers.CourseSerializer
     pagination_class = paginators.CoursePagination
+    # Query params the public listing depends on, used as the response cache key
+    cache_query_params = ('lecturer', 'category', 'min_price', 'max_price', 'level', 'page', 'pagination', 'cursor')
 
     def get_permissions(self):
         if self.request.method in ('POST', 'PUT', 'PATCH', 'DELETE'):
@@ -51,7 +72,7 @@ class CourseViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         queryset = self.queryset
         if self.action == 'list':
-            queryset = queryset.select_related('lecturer', 'category').annotate(total_student_count=Count('user_course'))
+            queryset = queryset.select_related('lecturer', 'category')
 
         request = self.request
 
@@ -78,6 +99,11 @@ class CourseViewSet(viewsets.ModelViewSet):
 
         return queryset.order_by('-id')
 
+    def list(self, request, *args, **kwargs):
+        return catalog_cache.cached_response(request, catalog_cache.COURSES,
+                                             lambda: super(CourseViewSet, self).list(request, *args, **kwargs),
+                                             params=self.cache_query_params)
+
     @action(methods=['get'], detail=True, url_path='forum')
     def get_forum(self, request, pk=None):
         course = self.get_object()
@@ -103,27 +129,25 @@ class CourseViewSet(viewsets.ModelViewSet):
 
     @action(methods=['get'], detail=False, url_path='top')
     def get_courses_top(self, request, pk=None):
-        top_courses = Course.objects.filter(active=True).annotate(student_count=Count('user_course')).select_related('lecturer', 'category').order_by('-student_count')[:3]
-        return Response(serializers.CourseSerializer(top_courses, many=True).data, status=status.HTTP_200_OK)
+        def build():
+            top_courses = Course.objects.filter(active=True).select_related('lecturer', 'category').order_by('-student_count')[:3]
+            return Response(serializers.CourseSerializer(top_courses, many=True).data, status=status.HTTP_200_OK)
+
+        return catalog_cache.cached_response(request, catalog_cache.COURSES, build)
 
     @action(methods=['get'], detail=True, url_path='detail')
     def get_course_detail(self, request, pk=None):
         try:
-            course = self.get_object()
-            # Optimize queries with select_related and prefetch_related
-            course = Course.objects.select_related('lecturer', 'lecturer__user_role', 'category').prefetch_related(
-                'chapters__lessons__documents'
-            ).get(pk=pk)
-
-            serializer = serializers.CourseDetailSerializer(course, context={'request': request})
-            return Response(serializer.data, status=status.HTTP_200_OK)
-        except Course.DoesNotExist:
+            # One cache read for the syllabus plus one indexed enrollment lookup
+            data = course_detail.get_course_detail(pk, request.user)
+            return Response(data, status=status.HTTP_200_OK)
+        except (Course.DoesNotExist, ValueError):
             return Response({"detail": "Course not found"}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({"detail": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class ChapterViewSet(viewsets.ModelViewSet):
+class ChapterViewSet(PermissionMatrixMixin, viewsets.ModelViewSet):
     serializer_class = serializers.ChapterSerializer
     pagination_class = paginators.ChapterPagination
     queryset = Chapter.objects.all()
@@ -134,7 +158,7 @@ class ChapterViewSet(viewsets.ModelViewSet):
         return [permissions.IsAuthenticated()]
 
 
-class LessonViewSet(viewsets.ModelViewSet):
+class LessonViewSet(PermissionMatrixMixin, viewsets.ModelViewSet):
     serializer_class = serializers.LessonSerializer
     pagination_class = paginators.LessonPagination
     queryset = Lesson.objects.all()
@@ -145,7 +169,7 @@ class LessonViewSet(viewsets.ModelViewSet):
         return [permissions.IsAuthenticated()]
 
 
-class UserViewSet(viewsets.ViewSet, generics.CreateAPIView):
+class UserViewSet(PermissionMatrixMixin, viewsets.ViewSet, generics.CreateAPIView):
     queryset = User.objects.filter(is_active=True)
     serializer_class = serializers.UserSerializer
     parser_classes = [parsers.JSONParser, parsers.MultiPartParser]
@@ -205,7 +229,8 @@ class UserViewSet(viewsets.ViewSet, generics.CreateAPIView):
     @action(methods=['get', 'patch'], url_path='current-user', detail=False,
             permission_classes=[permissions.IsAuthenticated])
     def get_current_user(self, request):
-        user = request.user
+        # request.user từ cache token chỉ có vài cột; hồ sơ đầy đủ thì đọc lại một lần
+        user = User.objects.select_related('user_role').get(pk=request.user.pk)
         if request.method == 'PATCH':
             serializer = serializers.UserUpdateSerializer(user, data=request.data, partial=True)
             if serializer.is_valid():
@@ -217,13 +242,14 @@ class UserViewSet(viewsets.ViewSet, generics.CreateAPIView):
         return Response(serializers.UserSerializer(user).data)
 
 
-class UserCourseViewSet(viewsets.ViewSet, generics.ListAPIView, generics.RetrieveAPIView):
+class UserCourseViewSet(PermissionMatrixMixin, viewsets.ViewSet, generics.ListAPIView, generics.RetrieveAPIView):
     serializer_class = serializers.UserCourseSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = paginators.EnrollmentPagination
 
     def get_queryset(self):
         user = self.request.user
-        course_qs = Course.objects.select_related('lecturer', 'category').annotate(total_student_count=Count('user_course'))
+        course_qs = Course.objects.select_related('lecturer', 'category')
         queryset = UserCourse.objects.prefetch_related(
             Prefetch('course', queryset=course_qs)
         )
@@ -239,7 +265,36 @@ class UserCourseViewSet(viewsets.ViewSet, generics.ListAPIView, generics.Retriev
         serializer.is_valid(raise_exception=True)
 
         user_course = serializer.save()
-        pay_url = create_momo_payment(user, user_course.course.price, user_course.id, user_course.course.id)
+        if not serializer.created:
+            # Bấm đăng ký lần nữa khi đang chờ thanh toán: dùng lại link MoMo, không tạo đơn mới
+            pay_url = momo.get_cached_pay_url(user_course.id)
+            if pay_url:
+                return Response({'payUrl': pay_url}, status=status.HTTP_200_OK)
+
+            # Link đã hết hạn trong cache: hỏi MoMo về đơn cũ trước, đơn còn mở thì dùng lại
+            order = reconciliation.open_order(user.id, user_course.course_id)
+            if order is not None:
+                if order.pay_url:
+                    return Response({'payUrl': order.pay_url}, status=status.HTTP_200_OK)
+                return Response({'detail': 'Đơn thanh toán trước đó vẫn đang được xử lý, vui lòng thử lại sau.'},
+                                status=status.HTTP_409_CONFLICT)
+            user_course.refresh_from_db(fields=['status'])
+            if user_course.status == CourseStatus.PAYMENT_FAILED:
+                # Đơn cũ đã hết hạn/thất bại: đăng ký chờ thanh toán lại với đơn mới
+                user_course.status = CourseStatus.PENDING
+                user_course.save(update_fields=['status', 'updated_at'])
+            elif user_course.status != CourseStatus.PENDING:
+                # Đơn cũ đã được thanh toán trong lúc chờ
+                return Response({'detail': 'Bạn đã đăng ký khóa học này rồi.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            pay_url = create_momo_payment(user, user_course.course.price, user_course.id, user_course.course.id)
+        except GatewayUnavailable:
+            return Response({'detail': 'Cổng thanh toán MoMo đang gián đoạn, vui lòng thử lại sau.'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if not pay_url:
+            # MoMo từ chối tạo đơn: payment và enrollment đã được chuyển sang thất bại
+            return Response({'detail': 'MoMo không tạo được đơn thanh toán.'}, status=status.HTTP_502_BAD_GATEWAY)
 
         return Response({'payUrl': pay_url}, status=status.HTTP_201_CREATED)
 
@@ -253,46 +308,24 @@ class UserCourseViewSet(viewsets.ViewSet, generics.ListAPIView, generics.Retriev
 class MomoIPNViewSet(APIView):
     def post(self, request, *args, **kwargs):
         data = request.data
-        user_course_id = data['extraData']
-        payment_id = data['orderId']
-
-        raw_signature = (
-            f"accessKey=F8BBA842ECF85"
-            f"&amount={data['amount']}"
-            f"&extraData={data['extraData']}"
-            f"&message={data['message']}"
-            f"&orderId={data['orderId']}"
-            f"&orderInfo={data['orderInfo']}"
-            f"&orderType={data['orderType']}"
-            f"&partnerCode={data['partnerCode']}"
-            f"&payType={data['payType']}"
-            f"&requestId={data['requestId']}"
-            f"&responseTime={data['responseTime']}"
-            f"&resultCode={data['resultCode']}"
-            f"&transId={data['transId']}"
-        )
-
-        signature = hmac.new(bytes('K951B6PE1waDMi640xX08PD3vg6EkVlz', 'utf-8'),
-                     bytes(raw_signature, 'utf-8'),
-                     hashlib.sha256).hexdigest()
 
         # xác thực chữ
-        if signature != data.get("signature"):
+        if not verify_result_signature(data):
             return Response({"message": "Invalid signature"}, status=status.HTTP_400_BAD_REQUEST)
-        payment = Payment.objects.get(id=payment_id)
+
+        result_code = int(data['resultCode'])
+        outcome = apply_payment_result(data['orderId'], data['extraData'], data.get('transId'), result_code, 'ipn')
+        if outcome == momo.NOT_FOUND:
+            return Response({"message": "Payment not found"}, status=status.HTTP_404_NOT_FOUND)
+        if outcome != momo.APPLIED:
+            # MoMo gửi lại IPN: đã xử lý rồi, chỉ xác nhận
+            return Response({"message": "Payment already processed"}, status=status.HTTP_200_OK)
 
         # thanh toán thành công
-        if data["resultCode"] == 0:
-            update_status_user_course(user_course_id, CourseStatus.IN_PROGRESS)
-            payment.status = PaymentStatus.SUCCESS
-            payment.save()
+        if result_code == 0:
             return Response({"message": "Payment success"}, status=status.HTTP_200_OK)
         # thanh toán thất bại
-        else:
-            update_status_user_course(user_course_id, CourseStatus.PAYMENT_FAILED)
-            payment.status = PaymentStatus.FAILED
-            payment.save()
-            return Response({"message": "Payment failed"}, status=status.HTTP_200_OK)
+        return Response({"message": "Payment failed"}, status=status.HTTP_200_OK)
 
 
 from django.shortcuts import redirect
@@ -306,43 +339,16 @@ class MomoCallbackView(APIView):
         if not user_course_id or not payment_id:
             return redirect(f'{settings.FRONTEND_URL}/my-courses/?status=error')
 
-        raw_signature = (
-            f"accessKey=F8BBA842ECF85"
-            f"&amount={data.get('amount')}"
-            f"&extraData={data.get('extraData')}"
-            f"&message={data.get('message')}"
-            f"&orderId={data.get('orderId')}"
-            f"&orderInfo={data.get('orderInfo')}"
-            f"&orderType={data.get('orderType')}"
-            f"&partnerCode={data.get('partnerCode')}"
-            f"&payType={data.get('payType')}"
-            f"&requestId={data.get('requestId')}"
-            f"&responseTime={data.get('responseTime')}"
-            f"&resultCode={data.get('resultCode')}"
-            f"&transId={data.get('transId')}"
-        )
-
-        signature = hmac.new(bytes('K951B6PE1waDMi640xX08PD3vg6EkVlz', 'utf-8'),
-                     bytes(raw_signature, 'utf-8'),
-                     hashlib.sha256).hexdigest()
-
-        if signature != data.get("signature"):
+        if not verify_result_signature(data):
              return redirect(f'{settings.FRONTEND_URL}/my-courses/?status=invalid_signature')
 
-        try:
-            payment = Payment.objects.get(id=payment_id)
-            if data.get("resultCode") == '0':
-                update_status_user_course(user_course_id, CourseStatus.IN_PROGRESS)
-                payment.status = PaymentStatus.SUCCESS
-                payment.save()
-                return redirect(f'{settings.FRONTEND_URL}/my-courses/?status=success')
-            else:
-                update_status_user_course(user_course_id, CourseStatus.PAYMENT_FAILED)
-                payment.status = PaymentStatus.FAILED
-                payment.save()
-                return redirect(f'{settings.FRONTEND_URL}/my-courses/?status=failed')
-        except Payment.DoesNotExist:
+        result_code = int(data.get('resultCode'))
+        outcome = apply_payment_result(payment_id, user_course_id, data.get('transId'), result_code, 'callback')
+        if outcome == momo.NOT_FOUND:
             return redirect(f'{settings.FRONTEND_URL}/my-courses/?status=not_found')
+        if result_code == 0:
+            return redirect(f'{settings.FRONTEND_URL}/my-courses/?status=success')
+        return redirect(f'{settings.FRONTEND_URL}/my-courses/?status=failed')
 
 
 
@@ -373,7 +379,7 @@ class CanAccessForum(permissions.BasePermission):
             
         return False
 
-class ForumViewSet(viewsets.ViewSet, generics.ListCreateAPIView):
+class ForumViewSet(PermissionMatrixMixin, viewsets.ViewSet, generics.ListCreateAPIView):
     serializer_class = serializers.ForumSerializer
     permission_classes = [CanAccessForum]
 
@@ -420,9 +426,10 @@ class ForumViewSet(viewsets.ViewSet, generics.ListCreateAPIView):
             
         serializer.save(user=self.request.user)
 
-class TopicViewSet(viewsets.ModelViewSet):
+class TopicViewSet(PermissionMatrixMixin, viewsets.ModelViewSet):
     serializer_class = serializers.TopicSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = paginators.TopicPagination
 
     def get_queryset(self):
         forum_id = self.request.query_params.get('forum_id')
@@ -483,9 +490,10 @@ class TopicViewSet(viewsets.ModelViewSet):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class CommentViewSet(viewsets.ModelViewSet):
+class CommentViewSet(PermissionMatrixMixin, viewsets.ModelViewSet):
     serializer_class = serializers.CommentSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = paginators.CommentPagination
 
     def get_queryset(self):
         topic_id = self.request.query_params.get('topic_id')
@@ -514,7 +522,7 @@ class CommentViewSet(viewsets.ModelViewSet):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class LessonProgressViewSet(viewsets.GenericViewSet):
+class LessonProgressViewSet(PermissionMatrixMixin, viewsets.GenericViewSet):
     serializer_class = serializers.LessonProgressSerializer
     permission_classes = [permissions.IsAuthenticated]
 
@@ -580,20 +588,21 @@ class LessonProgressViewSet(viewsets.GenericViewSet):
         if not user_course and not is_lecturer:
             return Response({"error": "You are not enrolled in this course"}, status=status.HTTP_403_FORBIDDEN)
         
+        # Determine progress status based on completion percentage
+        progress_status = progress_service.progress_status_for(completion_percentage)
+
+        if settings.PROGRESS_WRITE_BEHIND:
+            if progress_status != LessonProgressStatus.COMPLETED:
+                return self.buffer_lesson_progress(request, lesson, progress_status, watch_time, completion_percentage)
+            # Transition to COMPLETED is written synchronously; the older buffered heartbeat is dropped
+            progress_buffer.get_progress_buffer().discard(request.user.id, lesson.id)
+
         # Get or create lesson progress
         lesson_progress, created = LessonProgress.objects.get_or_create(
             user=request.user,
             lesson=lesson
         )
         
-        # Determine progress status based on completion percentage
-        if completion_percentage >= 90:
-            progress_status = LessonProgressStatus.COMPLETED
-        elif completion_percentage > 0:
-            progress_status = LessonProgressStatus.IN_PROGRESS
-        else:
-            progress_status = LessonProgressStatus.NOT_STARTED
-        
         # Update progress
         serializer = serializers.LessonProgressUpdateSerializer(lesson_progress, data={
             'status': progress_status,
@@ -607,6 +616,84 @@ class LessonProgressViewSet(viewsets.GenericViewSet):
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @swagger_auto_schema(
+        operation_summary="Cập nhật tiến độ nhiều bài học",
+        operation_description="Nhận nhiều heartbeat tiến độ (lesson_id, watch_time, completion_percentage, client_ts) "
+                              "trong một request, ví dụ khi ứng dụng di động gửi bù dữ liệu đã lưu tạm",
+        request_body=serializers.LessonProgressBatchSerializer,
+        responses={
+            200: openapi.Response(
+                description="Kết quả cập nhật",
+                schema=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        'updated': openapi.Schema(type=openapi.TYPE_ARRAY, items=openapi.Schema(type=openapi.TYPE_INTEGER)),
+                        'rejected': openapi.Schema(type=openapi.TYPE_ARRAY, items=openapi.Schema(type=openapi.TYPE_OBJECT))
+                    }
+                )
+            ),
+            400: openapi.Response(description="Dữ liệu không hợp lệ")
+        }
+    )
+    @action(methods=['post'], detail=False, url_path='bulk-update-progress')
+    def bulk_update_lesson_progress(self, request):
+        """Apply a batch of progress heartbeats, validating enrollment once per course"""
+        serializer = serializers.LessonProgressBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        events = progress_service.coalesce_events(serializer.validated_data['events'])
+
+        lessons = Lesson.objects.filter(pk__in=events).values_list(
+            'pk', 'chapter__course_id', 'chapter__course__lecturer_id')
+        course_by_lesson = {lesson_id: course_id for lesson_id, course_id, _ in lessons}
+        allowed_courses = {course_id for _, course_id, lecturer_id in lessons if lecturer_id == request.user.id}
+        allowed_courses.update(UserCourse.objects.filter(
+            user=request.user,
+            course_id__in=set(course_by_lesson.values()) - allowed_courses,
+            status__in=[CourseStatus.IN_PROGRESS, CourseStatus.COMPLETE]
+        ).values_list('course_id', flat=True))
+
+        rejected = []
+        for lesson_id in list(events):
+            if lesson_id not in course_by_lesson:
+                rejected.append({'lesson_id': lesson_id, 'error': 'Lesson not found'})
+            elif course_by_lesson[lesson_id] not in allowed_courses:
+                rejected.append({'lesson_id': lesson_id, 'error': 'You are not enrolled in this course'})
+            else:
+                continue
+            del events[lesson_id]
+
+        updated = list(events)
+        if settings.PROGRESS_WRITE_BEHIND:
+            buffer = progress_buffer.get_progress_buffer()
+            for lesson_id, event in list(events.items()):
+                if progress_service.progress_status_for(event['completion_percentage']) == LessonProgressStatus.COMPLETED:
+                    buffer.discard(request.user.id, lesson_id)
+                    continue
+                progress_buffer.buffer_heartbeat(request.user.id, lesson_id, course_by_lesson[lesson_id],
+                                                 event['watch_time'], event['completion_percentage'],
+                                                 event.get('client_ts') or timezone.now())
+                del events[lesson_id]
+
+        progress_service.apply_lesson_progress(request.user.id, events, course_by_lesson)
+        return Response({'updated': updated, 'rejected': rejected}, status=status.HTTP_200_OK)
+
+    def buffer_lesson_progress(self, request, lesson, progress_status, watch_time, completion_percentage):
+        """Write-behind path: validate, coalesce in the progress buffer and answer without touching the DB"""
+        serializer = serializers.LessonProgressUpdateSerializer(data={
+            'status': progress_status,
+            'watch_time': watch_time,
+            'completion_percentage': completion_percentage
+        })
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        now = timezone.now()
+        progress_buffer.buffer_heartbeat(request.user.id, lesson.id, lesson.chapter.course_id,
+                                         serializer.validated_data['watch_time'],
+                                         serializer.validated_data['completion_percentage'], now)
+        pending = LessonProgress(user=request.user, lesson=lesson, last_watched_at=now, **serializer.validated_data)
+        return Response(serializers.LessonProgressSerializer(pending).data, status=status.HTTP_202_ACCEPTED)
+
     @swagger_auto_schema(
         operation_summary="Lấy tiến độ khóa học",
         operation_description="Lấy tiến độ học tập của user trong một khóa học cụ thể",
@@ -679,7 +766,7 @@ class LessonProgressViewSet(viewsets.GenericViewSet):
         }, status=status.HTTP_200_OK)
 
 
-class EnrolledCoursesViewSet(viewsets.ReadOnlyModelViewSet):
+class EnrolledCoursesViewSet(PermissionMatrixMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = serializers.EnrolledCourseSerializer
     permission_classes = [permissions.IsAuthenticated]
 
@@ -696,62 +783,79 @@ class EnrolledCoursesViewSet(viewsets.ReadOnlyModelViewSet):
         return UserCourse.objects.filter(
             user=user,
             status__in=[CourseStatus.IN_PROGRESS, CourseStatus.COMPLETE]
-        ).select_related('course', 'course__lecturer', 'course__category') \
+        ).select_related('course', 'course__lecturer', 'course__lecturer__user_role', 'course__category') \
          .prefetch_related(
              course_progress_prefetch,
              'course__chapters__lessons__documents'
          )
 
 class ForgotPasswordView(APIView):
-    def post(self, request):
-        email = request.data.get("email")
-        if not email:
-            return Response({"error": "Email is required"}, status=400)
-
-        otp = str(random.randint(100000, 999999))
-        cache.set(otp, email, timeout=180)
+    # IP trước để email không bị tính khi IP đã vượt giới hạn
+    throttle_classes = [OTPSendIPThrottle, OTPSendEmailThrottle]
 
-        send_mail(
+    def post(self, request):
+        serializer = serializers.PasswordResetEmailSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({"error": "A valid email is required"}, status=400)
+
+        email = serializer.validated_data["email"]
+        otp = f"{secrets.randbelow(1000000):06d}"
+        # Một OTP cho mỗi email; gửi lại sẽ thay OTP cũ
+        auth_cache.set(f"otp:{email}", otp, timeout=180)
+
+        # Gửi qua outbox: `manage.py send_outbox_emails` giao mail, request không chờ SMTP
+        mailer.enqueue_email(
+            email,
             "Reset your password",
             f"Your OTP code is: {otp}. It will expire in 3 minutes.",
-            "no-reply@example.com",
-            [email],
+            # Hết hạn cùng OTP: mail gửi trễ hơn thì vô dụng
+            expires_in=180,
         )
 
         return Response({"message": "OTP sent to email"}, status=200)
 
 class VerifyOTPView(APIView):
-    def post(self, request):
-        otp = request.data.get("otp")
-        email = cache.get(otp)
+    throttle_classes = [OTPVerifyIPThrottle, OTPVerifyEmailThrottle]
 
-        if email is None:
+    def post(self, request):
+        serializer = serializers.VerifyOTPSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({"success": False, "message": "Email and a 6-digit OTP are required"}, status=400)
+
+        email = serializer.validated_data["email"]
+        otp = serializer.validated_data["otp"]
+        expected = auth_cache.get(f"otp:{email}")
+        if expected is None or not hmac.compare_digest(expected.encode(), otp.encode()):
             return Response({"success": False, "message": "Invalid or expired OTP"}, status=400)
 
         # ✅ Lưu trạng thái verify = True theo email
-        cache.set(f"verified:{email}", True, timeout=300)  # hết hạn sau 5 phút
-        cache.delete(otp)
+        auth_cache.set(f"verified:{email}", True, timeout=300)  # hết hạn sau 5 phút
+        auth_cache.delete(f"otp:{email}")
 
         return Response({"success": True, "message": "OTP verified. You can reset your password now."}, status=200)
 
 
 class ResetPasswordView(APIView):
     def post(self, request):
-        email = request.data.get("email")
-        new_password = request.data.get("password")
+        serializer = serializers.ResetPasswordSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({"success": False, "message": "Email and password are required"}, status=400)
+
+        email = serializer.validated_data["email"]
+        new_password = serializer.validated_data["password"]
 
-        is_verified = cache.get(f"verified:{email}", False)
+        is_verified = auth_cache.get(f"verified:{email}", False)
 
         if not is_verified:
             return Response({"success": False, "message": "OTP not verified or expired"}, status=400)
 
         try:
-            user = User.objects.get(email=email)
+            user = User.objects.get(email__iexact=email)
             user.set_password(new_password)
             user.save()
 
             # ✅ Sau khi reset thì xóa trạng thái verify
-            cache.delete(f"verified:{email}")
+            auth_cache.delete(f"verified:{email}")
 
             return Response({"success": True, "message": "Password reset successfully"}, status=200)
 
@@ -775,83 +879,57 @@ class GoogleLoginView(APIView):
         responses={200: openapi.Response(description="Login thành công")}
     )
     def post(self, request):
-        with open('google_login_debug.log', 'a', encoding='utf-8') as f:
-            token = request.data.get('token')
-            f.write(f"\n--- New Login Attempt ---\n")
-            f.write(f"Token (start): {token[:20]}...\n")
-            
-            if not token:
-                f.write("Error: Token is required\n")
-                return Response({"error": "Token is required"}, status=status.HTTP_400_BAD_REQUEST)
-
-            user_data = verify_google_token(token)
-            if "error" in user_data:
-                f.write(f"Token verification failed: {user_data['error']}\n")
-                return Response({"error": f"Invalid Google token: {user_data['error']}"}, status=status.HTTP_400_BAD_REQUEST)
-
-            email = user_data.get('email')
-            first_name = user_data.get('given_name', '')
-            last_name = user_data.get('family_name', '')
-            
-            f.write(f"Verified email: {email}\n")
+        token = request.data.get('token')
+        if not token:
+            auth_logger.info('google_login_rejected', extra={'reason': 'missing_token'})
+            return Response({"error": "Token is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-            try:
-                user, created = User.objects.get_or_create(email=email, defaults={
-                    'username': email,
-                    'first_name': first_name,
-                    'last_name': last_name,
-                    'is_active': True
-                })
-                f.write(f"User {'created' if created else 'found'} (ID: {user.id})\n")
-            except Exception as e:
-                f.write(f"User get_or_create error: {str(e)}\n")
-                return Response({"error": f"Database error: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)
-
-            if created:
-                user.set_unusable_password()
-                student_role = Role.objects.filter(name__iexact="Student").first()
-                if student_role:
-                    user.userRole = student_role
-                    f.write("Assigned Student role\n")
-                else:
-                    f.write("WARNING: Student role not found\n")
-                user.save()
-
-            app = Application.objects.first()
-            if not app:
-                f.write("ERROR: No OAuth2 Application configured\n")
-                return Response({"error": "No OAuth2 Application configured in backend"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        user_data = verify_google_token(token)
+        if "error" in user_data:
+            auth_logger.info('google_login_rejected', extra={'reason': 'invalid_token'})
+            return Response({"error": f"Invalid Google token: {user_data['error']}"}, status=status.HTTP_400_BAD_REQUEST)
 
-            try:
-                AccessToken.objects.filter(user=user, application=app).delete()
-                access_token = generate_token()
-                refresh_token = generate_token()
-                expires = timezone.now() + timezone.timedelta(seconds=36000)
-
-                token_obj = AccessToken.objects.create(
-                    user=user,
-                    application=app,
-                    token=access_token,
-                    expires=expires,
-                    scope='read write'
-                )
+        email = user_data.get('email')
+        first_name = user_data.get('given_name', '')
+        last_name = user_data.get('family_name', '')
 
-                RefreshToken.objects.create(
-                    user=user,
-                    application=app,
-                    token=refresh_token,
-                    access_token=token_obj
-                )
-                f.write("Tokens generated successfully\n")
-            except Exception as e:
-                f.write(f"Token generation error: {str(e)}\n")
-                return Response({"error": f"Token generation error: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        try:
+            user, created = User.objects.get_or_create(email=email, defaults={
+                'username': email,
+                'first_name': first_name,
+                'last_name': last_name,
+                'is_active': True
+            })
+        except Exception as e:
+            auth_logger.exception('google_login_user_error')
+            return Response({"error": f"Database error: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if created:
+            user.set_unusable_password()
+            student_role = Role.objects.filter(name__iexact="Student").first()
+            if student_role:
+                user.user_role = student_role
+            else:
+                auth_logger.warning('google_login_student_role_missing', extra={'user_id': user.id})
+            user.save()
 
-            return Response({
-                "access_token": access_token,
-                "refresh_token": refresh_token,
-                "expires_in": 36000,
-                "token_type": "Bearer",
-                "scope": "read write",
-                "user": serializers.UserSerializer(user).data
-            }, status=status.HTTP_200_OK)
+        app = tokens.get_login_application()
+        if not app:
+            auth_logger.error('google_login_no_application')
+            return Response({"error": "No OAuth2 Application configured in backend"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        try:
+            access_token, refresh_token = tokens.issue_tokens(user, app)
+        except Exception as e:
+            auth_logger.exception('google_login_token_error', extra={'user_id': user.id})
+            return Response({"error": f"Token generation error: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        auth_logger.info('google_login_succeeded', extra={'user_id': user.id, 'user_created': created})
+        return Response({
+            "access_token": access_token.token,
+            "refresh_token": refresh_token.token,
+            "expires_in": oauth2_settings.ACCESS_TOKEN_EXPIRE_SECONDS,
+            "token_type": "Bearer",
+            "scope": "read write",
+            "user": serializers.UserSerializer(user).data
+        }, status=status.HTTP_200_OK)
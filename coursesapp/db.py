@@ -0,0 +1,40 @@
+"""
+Database connection profiles, selected with the DB_CONN_MODE env var.
+
+default     a new connection per request (Django's CONN_MAX_AGE=0)
+persistent  connections are reused for DB_CONN_MAX_AGE seconds and health-checked before reuse
+pgbouncer   persistent connections to a transaction-mode pooler (e.g. Supabase on port 6543):
+            no server-side cursors; prepared statements are already off with psycopg 3 on Django 4.2
+pool        psycopg 3 connection pool inside each worker (Django >= 5.1); falls back to persistent
+"""
+import warnings
+
+import django
+
+MODES = ('default', 'persistent', 'pgbouncer', 'pool')
+
+
+def connection_profile(mode, conn_max_age=60, pool_min_size=2, pool_max_size=10, pool_timeout=10):
+    """Settings to merge into a DATABASES entry for the given mode"""
+    if mode not in MODES:
+        raise ValueError(f"DB_CONN_MODE must be one of {', '.join(MODES)}, got {mode!r}")
+
+    if mode == 'pool' and django.VERSION < (5, 1):
+        warnings.warn('DB_CONN_MODE=pool needs Django 5.1+, using persistent connections instead')
+        mode = 'persistent'
+
+    if mode == 'default':
+        return {'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': False, 'DISABLE_SERVER_SIDE_CURSORS': False, 'OPTIONS': {}}
+    if mode == 'pool':
+        return {
+            'CONN_MAX_AGE': 0,
+            'CONN_HEALTH_CHECKS': False,
+            'DISABLE_SERVER_SIDE_CURSORS': False,
+            'OPTIONS': {'pool': {'min_size': pool_min_size, 'max_size': pool_max_size, 'timeout': pool_timeout}},
+        }
+    return {
+        'CONN_MAX_AGE': conn_max_age,
+        'CONN_HEALTH_CHECKS': True,
+        'DISABLE_SERVER_SIDE_CURSORS': mode == 'pgbouncer',
+        'OPTIONS': {},
+    }
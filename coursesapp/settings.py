@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 from pathlib import Path
 import os
 from dotenv import load_dotenv
+from coursesapp.db import connection_profile
 
 # Load environment variables
 load_dotenv()
@@ -89,19 +90,135 @@ TEMPLATES = [
     },
 ]
 
-CACHES = {
-    "default": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
-        "LOCATION": "unique-snowflake",
+# Shared Redis cache when REDIS_URL is set, per-process memory otherwise (tests, local development).
+# "default" holds API caches (catalog, course detail, permission matrix, progress buffer);
+# "auth" holds OTPs, password-reset verification and validated OAuth2 tokens.
+REDIS_URL = os.getenv('REDIS_URL', '')
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+
+
+def cache_backend(key_prefix, location):
+    if not REDIS_URL:
+        return {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": location,
+            "KEY_PREFIX": key_prefix,
+        }
+    return {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": REDIS_URL,
+        "KEY_PREFIX": key_prefix,
+        "OPTIONS": {
+            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            # One pool per alias and process, shared by all threads of the worker
+            "CONNECTION_POOL_KWARGS": {"max_connections": REDIS_MAX_CONNECTIONS, "retry_on_timeout": True},
+            "SOCKET_CONNECT_TIMEOUT": 2,
+            "SOCKET_TIMEOUT": 2,
+        },
     }
+
+
+CACHES = {
+    "default": cache_backend("api", "api-cache"),
+    "auth": cache_backend("auth", "auth-cache"),
+}
+
+# Seconds a public catalog response (courses, categories, teachers) stays cached
+CATALOG_CACHE_TIMEOUT = int(os.getenv('CATALOG_CACHE_TIMEOUT', 120))
+# Course detail documents are invalidated on change, the timeout only bounds memory
+COURSE_DETAIL_CACHE_TIMEOUT = int(os.getenv('COURSE_DETAIL_CACHE_TIMEOUT', 86400))
+
+# Coalesce lesson-progress heartbeats in Redis and write them with `manage.py flush_progress_buffer` (needs REDIS_URL)
+PROGRESS_WRITE_BEHIND = os.getenv('PROGRESS_WRITE_BEHIND', 'False') == 'True'
+
+OAUTH2_PROVIDER = {
+    'SCOPES': {'read': 'Read scope', 'write': 'Write scope', },
+    'OAUTH2_VALIDATOR_CLASS': 'courses.oauth2_validators.RoleAwareOAuth2Validator',
+    # How long a refresh token survives its access token before purge_expired_tokens removes it
+    'REFRESH_TOKEN_EXPIRE_SECONDS': int(os.getenv('REFRESH_TOKEN_EXPIRE_SECONDS', 30 * 24 * 3600)),
+}
+AUTHENTICATION_BACKENDS = ['courses.backends.RoleAwareModelBackend']
+# Seconds a validated access token (with its user and role) is served from the cache
+OAUTH2_TOKEN_CACHE_TIMEOUT = int(os.getenv('OAUTH2_TOKEN_CACHE_TIMEOUT', 60))
+
+# (requests, seconds) per client for the password-reset endpoints, counted in the auth cache
+AUTH_RATE_LIMITS = {
+    'otp_send_email': (3, 600),
+    'otp_send_ip': (20, 3600),
+    'otp_verify_email': (5, 600),
+    'otp_verify_ip': (30, 3600),
 }
 
-OAUTH2_PROVIDER = {'SCOPES': {'read': 'Read scope', 'write': 'Write scope', }}
-REST_FRAMEWORK = {'DEFAULT_AUTHENTICATION_CLASSES': (
-    'oauth2_provider.contrib.rest_framework.OAuth2Authentication',
-    'rest_framework.authentication.TokenAuthentication',
-    'rest_framework.authentication.SessionAuthentication',
-)}
+DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'no-reply@example.com')
+
+# Email outbox delivered by `manage.py send_outbox_emails`
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', 5))
+# Retry after 30s, 60s, 120s ... capped at 15 minutes
+EMAIL_OUTBOX_BACKOFF = int(os.getenv('EMAIL_OUTBOX_BACKOFF', 30))
+EMAIL_OUTBOX_MAX_BACKOFF = int(os.getenv('EMAIL_OUTBOX_MAX_BACKOFF', 900))
+# At most EMAIL_OUTBOX_RECIPIENT_LIMIT emails per recipient every EMAIL_OUTBOX_RECIPIENT_WINDOW seconds.
+# Expiring mail (OTP) is not counted nor deferred: AUTH_RATE_LIMITS['otp_send_email'] already limits it
+EMAIL_OUTBOX_RECIPIENT_LIMIT = int(os.getenv('EMAIL_OUTBOX_RECIPIENT_LIMIT', 5))
+EMAIL_OUTBOX_RECIPIENT_WINDOW = int(os.getenv('EMAIL_OUTBOX_RECIPIENT_WINDOW', 3600))
+# A worker has this many seconds to send a claimed batch before another worker may take it over
+EMAIL_OUTBOX_LEASE = int(os.getenv('EMAIL_OUTBOX_LEASE', 300))
+
+# Background image uploads (`manage.py process_uploads`); the staging dir must be shared with the worker
+UPLOAD_BACKEND = os.getenv('UPLOAD_BACKEND', 'courses.services.uploads.CloudinaryBackend')
+UPLOAD_STAGING_DIR = os.getenv('UPLOAD_STAGING_DIR', str(BASE_DIR / 'upload_staging'))
+# Used by courses.services.uploads.LocalBackend only
+UPLOAD_LOCAL_DIR = os.getenv('UPLOAD_LOCAL_DIR', str(BASE_DIR / 'media'))
+UPLOAD_LOCAL_URL = os.getenv('UPLOAD_LOCAL_URL', '/media/')
+UPLOAD_MAX_ATTEMPTS = int(os.getenv('UPLOAD_MAX_ATTEMPTS', 5))
+UPLOAD_BACKOFF = int(os.getenv('UPLOAD_BACKOFF', 30))
+UPLOAD_MAX_BACKOFF = int(os.getenv('UPLOAD_MAX_BACKOFF', 900))
+# A worker has this many seconds to finish a claimed upload before another worker may take it over
+UPLOAD_LEASE = int(os.getenv('UPLOAD_LEASE', 300))
+
+# Outbox events (`manage.py process_outbox_events`) are dropped after this many failed runs
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 10))
+
+# Google ID tokens are verified locally against these signing certificates (PEM by key id)
+GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
+GOOGLE_CERTS_URL = os.getenv('GOOGLE_CERTS_URL', 'https://www.googleapis.com/oauth2/v1/certs')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'courses.log_handlers.JsonFormatter'},
+    },
+    'handlers': {
+        'auth': {
+            'class': 'courses.log_handlers.NonBlockingHandler',
+            'formatter': 'json',
+            'filename': os.getenv('AUTH_LOG_FILE') or None,
+        },
+    },
+    'loggers': {
+        # Google login trail (former google_login_debug.log); AUTH_LOG_LEVEL=INFO to follow every attempt
+        'courses.auth': {
+            'handlers': ['auth'],
+            'level': os.getenv('AUTH_LOG_LEVEL', 'WARNING'),
+            'propagate': False,
+        },
+    },
+}
+
+# Enforce the Permission table (role, method, path) in addition to the views' own checks
+PERMISSION_MATRIX_ENFORCED = os.getenv('PERMISSION_MATRIX_ENFORCED', 'False') == 'True'
+# Seconds a worker trusts its compiled matrix before re-reading the shared version key
+PERMISSION_MATRIX_CHECK_INTERVAL = float(os.getenv('PERMISSION_MATRIX_CHECK_INTERVAL', 1))
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': (
+        'oauth2_provider.contrib.rest_framework.OAuth2Authentication',
+        'rest_framework.authentication.TokenAuthentication',
+        'rest_framework.authentication.SessionAuthentication',
+    ),
+    # Reverse proxies in front of the app. Throttles trust only that many X-Forwarded-For hops
+    # (0 = REMOTE_ADDR); left unset, DRF would take a client-supplied header at face value
+    'NUM_PROXIES': int(os.getenv('NUM_PROXIES', 0)),
+}
 
 
 
@@ -120,6 +237,12 @@ DATABASES = {
         'PASSWORD': os.getenv('DB_PASSWORD', ''),
         'HOST': os.getenv('DB_HOST', 'localhost'),
         'PORT': os.getenv('DB_PORT', '5432'),
+        **connection_profile(
+            os.getenv('DB_CONN_MODE', 'default'),
+            conn_max_age=int(os.getenv('DB_CONN_MAX_AGE', 60)),
+            pool_min_size=int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+            pool_max_size=int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+        ),
     }
 }
 
@@ -179,3 +302,15 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 BACKEND_URL = os.getenv('BACKEND_URL', 'http://localhost:8000')
 FRONTEND_URL = os.getenv('FRONTEND_URL', 'http://localhost:3000')
 MOMO_IPN_URL = os.getenv('MOMO_IPN_URL', 'http://localhost:8080')
+MOMO_API_URL = os.getenv('MOMO_API_URL', 'https://test-payment.momo.vn/v2/gateway/api')
+# Seconds; a slow gateway must not hold a worker
+MOMO_CONNECT_TIMEOUT = float(os.getenv('MOMO_CONNECT_TIMEOUT', 3.05))
+MOMO_READ_TIMEOUT = float(os.getenv('MOMO_READ_TIMEOUT', 10))
+MOMO_MAX_RETRIES = int(os.getenv('MOMO_MAX_RETRIES', 2))
+# Fail fast for MOMO_BREAKER_RESET seconds after MOMO_BREAKER_THRESHOLD consecutive failed calls
+MOMO_BREAKER_THRESHOLD = int(os.getenv('MOMO_BREAKER_THRESHOLD', 5))
+MOMO_BREAKER_RESET = int(os.getenv('MOMO_BREAKER_RESET', 30))
+# `manage.py reconcile_payments` asks MoMo about payments still PENDING after this many seconds
+MOMO_RECONCILE_AFTER = int(os.getenv('MOMO_RECONCILE_AFTER', 1800))
+# How long a payUrl is handed out again to a repeated enrollment request (keep it under MoMo's order expiry)
+MOMO_PAY_URL_TIMEOUT = int(os.getenv('MOMO_PAY_URL_TIMEOUT', 600))